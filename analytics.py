@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""Appointment and availability aggregates for utilization reports.
+
+Counts are kept per doctor, per specialization and overall. Appointments
+are counted per day and status, with running totals per month and
+weekday, so a sum over any date range reads whole months from the totals
+and only walks the days of the partial months at either end. Available
+slots are never expanded day by day: a range holds a known number of
+each weekday, times the weekly slot counts, plus the changes that date
+overrides make.
+
+Every update states the new value of a record rather than a change, so
+writes replayed on top of a rebuild that already saw them are harmless.
+`build` recomputes everything from scratch.
+"""
+import os
+import time
+import logging
+import threading
+from calendar import monthrange
+from collections import Counter
+from datetime import date as date_type
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('booked', 'completed', 'cancelled')
+FIELDS = {status: field for field, status in enumerate(STATUSES)}
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+GROUPS = ('doctor', 'specialization', 'all')
+ALL = ('all', None)
+
+
+@lru_cache(maxsize=None)
+def _day(ordinal):
+    """(month key, weekday) of a date ordinal"""
+    day = date_type.fromordinal(ordinal)
+    return (day.year, day.month), day.weekday()
+
+
+def weekday_counts(first, last):
+    """How many of each weekday, Monday first, fall in the ordinals first..last"""
+    days = last - first + 1
+    counts = [days // 7] * 7
+    start = _day(first)[1]
+    for i in range(days % 7):
+        counts[(start + i) % 7] += 1
+    return counts
+
+
+class _Series:
+    """Per-day values of `width` fields, with month totals per weekday and field"""
+
+    __slots__ = ('width', 'days', 'months')
+
+    def __init__(self, width):
+        self.width = width
+        self.days = {}
+        self.months = {}
+
+    def add(self, ordinal, field, n=1):
+        month, weekday = _day(ordinal)
+        values = self.days.get(ordinal)
+        if values is None:
+            values = self.days[ordinal] = [0] * self.width
+        values[field] += n
+        totals = self.months.get(month)
+        if totals is None:
+            totals = self.months[month] = [0] * (7 * self.width)
+        totals[weekday * self.width + field] += n
+
+    def merge(self, other, sign=1):
+        for ordinal, values in other.days.items():
+            for field, n in enumerate(values):
+                if n:
+                    self.add(ordinal, field, sign * n)
+
+    def totals(self, first, last):
+        """Sums per weekday and field (weekday * width + field) over first..last"""
+        width = self.width
+        result = [0] * (7 * width)
+        if not self.days:
+            return result
+        ordinal = first
+        while ordinal <= last:
+            day = date_type.fromordinal(ordinal)
+            month_end = ordinal + monthrange(day.year, day.month)[1] - day.day
+            if day.day == 1 and month_end <= last:
+                totals = self.months.get((day.year, day.month))
+                if totals:
+                    result = [a + b for a, b in zip(result, totals)]
+                ordinal = month_end + 1
+                continue
+            values = self.days.get(ordinal)
+            if values:
+                base = day.weekday() * width
+                for field, n in enumerate(values):
+                    result[base + field] += n
+            ordinal += 1
+        return result
+
+
+class _Aggregates:
+    """The aggregates proper; Analytics swaps whole instances on rebuild"""
+
+    def __init__(self):
+        self.specializations = {}   # doctor id -> specialization
+        self.statuses = {}          # appointment id -> (doctor id, ordinal, field)
+        self.schedules = {}         # doctor id -> (weekly slot counts, {ordinal: change})
+        self.appointments = {}      # key -> _Series of STATUSES
+        self.available = {}         # key -> [weekly slot counts, _Series of override changes]
+
+    def keys(self, doctor_id):
+        keys = [('doctor', doctor_id), ALL]
+        specialization = self.specializations.get(doctor_id)
+        if specialization:
+            keys.append(('specialization', specialization))
+        return keys
+
+    def series(self, key):
+        series = self.appointments.get(key)
+        if series is None:
+            series = self.appointments[key] = _Series(len(STATUSES))
+        return series
+
+    def add_schedule(self, key, schedule, sign=1):
+        weekly, overrides = schedule
+        entry = self.available.get(key)
+        if entry is None:
+            entry = self.available[key] = [[0] * 7, _Series(1)]
+        entry[0] = [total + sign * count for total, count in zip(entry[0], weekly)]
+        for ordinal, change in overrides.items():
+            entry[1].add(ordinal, 0, sign * change)
+
+    def set_doctor(self, doctor_id, specialization):
+        previous = self.specializations.get(doctor_id)
+        self.specializations[doctor_id] = specialization
+        if previous == specialization:
+            return
+        # Move what is already counted for the doctor to the new group
+        appointments = self.appointments.get(('doctor', doctor_id))
+        schedule = self.schedules.get(doctor_id)
+        for group, sign in ((previous, -1), (specialization, 1)):
+            if not group:
+                continue
+            if appointments:
+                self.series(('specialization', group)).merge(appointments, sign)
+            if schedule:
+                self.add_schedule(('specialization', group), schedule, sign)
+
+    def set_schedule(self, doctor_id, weekly, overrides):
+        previous = self.schedules.get(doctor_id)
+        self.schedules[doctor_id] = (weekly, overrides)
+        for key in self.keys(doctor_id):
+            if previous:
+                self.add_schedule(key, previous, -1)
+            self.add_schedule(key, (weekly, overrides))
+
+    def set_appointment(self, appointment):
+        previous = self.statuses.pop(appointment['id'], None)
+        if previous is not None:
+            doctor_id, ordinal, field = previous
+            for key in self.keys(doctor_id):
+                self.series(key).add(ordinal, field, -1)
+        current = _appointment_row(appointment)
+        if current is not None:
+            doctor_id, ordinal, field = current
+            self.statuses[appointment['id']] = current
+            for key in self.keys(doctor_id):
+                self.series(key).add(ordinal, field)
+
+    def report(self, key, first, last):
+        """Utilization of one key over the ordinals first..last"""
+        counts = self.series(key).totals(first, last) if key in self.appointments else None
+        weekly, overrides = self.available.get(key) or ([0] * 7, None)
+        changes = overrides.totals(first, last) if overrides else [0] * 7
+        weekdays = weekday_counts(first, last)
+        width = len(STATUSES)
+        by_weekday = []
+        for weekday in range(7):
+            row = {'day': DAY_NAMES[weekday],
+                   'available_slots': weekdays[weekday] * weekly[weekday] + changes[weekday]}
+            for field, status in enumerate(STATUSES):
+                row[status] = counts[weekday * width + field] if counts else 0
+            by_weekday.append(_rates(row))
+        total = {'available_slots': sum(row['available_slots'] for row in by_weekday)}
+        for status in STATUSES:
+            total[status] = sum(row[status] for row in by_weekday)
+        busiest = max(by_weekday, key=lambda row: row['booked'] + row['completed'])
+        total['busiest_day'] = busiest['day'] if busiest['booked'] + busiest['completed'] else None
+        total['by_weekday'] = by_weekday
+        return _rates(total)
+
+
+def _rates(row):
+    """Add utilization (occupied / available slots) and cancellation rate to a row"""
+    occupied = row['booked'] + row['completed']
+    appointments = occupied + row['cancelled']
+    row['utilization'] = round(occupied / row['available_slots'], 4) if row['available_slots'] > 0 else None
+    row['cancellation_rate'] = round(row['cancelled'] / appointments, 4) if appointments else None
+    return row
+
+
+def _appointment_row(appointment):
+    """(doctor id, date ordinal, status field) of a countable appointment, else None"""
+    field = FIELDS.get(appointment.get('status'))
+    if field is None or not appointment.get('doctor_id'):
+        return None
+    try:
+        ordinal = date_type.fromisoformat(appointment['date']).toordinal()
+    except (KeyError, TypeError, ValueError):
+        return None
+    return appointment['doctor_id'], ordinal, field
+
+
+def _grouped_counts(rows, groups):
+    """{(key, ordinal, field): count} for every key a (doctor, ordinal, field) row counts under"""
+    by_doctor = Counter(rows)
+    counts = Counter()
+    for (doctor_id, ordinal, field), n in by_doctor.items():
+        counts[(('doctor', doctor_id), ordinal, field)] += n
+        counts[(ALL, ordinal, field)] += n
+        if groups.get(doctor_id):
+            counts[(('specialization', groups[doctor_id]), ordinal, field)] += n
+    return counts
+
+
+def build(doctors, schedules, appointments):
+    """Aggregates from scratch.
+
+    `doctors` are doctor records, `schedules` (doctor id, weekly slot
+    counts, overrides) as from SlotEngine.working_counts, `appointments`
+    appointment records.
+    """
+    aggregates = _Aggregates()
+    for doctor in doctors:
+        aggregates.specializations[doctor['id']] = doctor.get('specialization') or None
+    for doctor_id, weekly, overrides in schedules:
+        aggregates.set_schedule(doctor_id, weekly, overrides)
+    rows = []
+    for appointment in appointments:
+        row = _appointment_row(appointment)
+        if row is not None:
+            aggregates.statuses[appointment['id']] = row
+            rows.append(row)
+    for (key, ordinal, field), n in _grouped_counts(rows, aggregates.specializations).items():
+        aggregates.series(key).add(ordinal, field, n)
+    return aggregates
+
+
+class Analytics:
+    """Thread-safe utilization aggregates, updated as appointments and schedules change.
+
+    `refresh` rebuilds them from storage when missing or older than a
+    given age; `start` does the same periodically in a background thread,
+    so queries never wait for a rebuild. In between they only change
+    through the `record_*` calls they are given; they live in one process.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.built_at = None
+        self._clock = clock
+        self._aggregates = _Aggregates()
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._replay = None
+        self._pid = None
+        self._due = threading.Event()
+
+    def refresh(self, load, max_age):
+        """Rebuild from `load()`, which returns the arguments of `build`, if stale"""
+        if self.built_at is not None and self._clock() - self.built_at <= max_age:
+            return
+        with self._build_lock:
+            if self.built_at is not None and self._clock() - self.built_at <= max_age:
+                return
+            self._rebuild(load)
+
+    def start(self, load, interval):
+        """Rebuild from `load()` in a daemon thread now and every `interval` seconds"""
+        # Checked per pid: a forked worker needs its own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(load, interval),
+                             name='medislot-analytics', daemon=True).start()
+
+    def _run(self, load, interval):
+        while True:
+            self._due.clear()
+            try:
+                with self._build_lock:
+                    self._rebuild(load)
+            except Exception:
+                logger.exception('Rebuilding the analytics aggregates failed')
+            self._due.wait(interval)
+
+    def _rebuild(self, load):
+        with self._lock:
+            # Writes during the build are replayed on top of it
+            self._replay = []
+        try:
+            aggregates = build(*load())
+        except BaseException:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            for method, args in self._replay:
+                getattr(aggregates, method)(*args)
+            self._replay = None
+            self._aggregates = aggregates
+            self.built_at = self._clock()
+
+    def expire(self):
+        """Rebuild the aggregates: at once in the background thread, else on the next `refresh`"""
+        if self._pid == os.getpid():
+            self._due.set()
+        else:
+            self.built_at = None
+
+    def _apply(self, method, *args):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((method, args))
+            getattr(self._aggregates, method)(*args)
+
+    def record_doctor(self, doctor):
+        """Count a new or edited doctor under its specialization"""
+        self._apply('set_doctor', doctor['id'], doctor.get('specialization') or None)
+
+    def record_schedule(self, doctor_id, weekly, overrides):
+        """Replace a doctor's working slot counts (see SlotEngine.working_counts)"""
+        self._apply('set_schedule', doctor_id, weekly, overrides)
+
+    def record_appointment(self, appointment):
+        """Count an appointment under its current status"""
+        self._apply('set_appointment', dict(appointment))
+
+    def utilization(self, group, start, end, key=None):
+        """Utilization rows for `group` over the ISO dates start..end, inclusive.
+
+        `group` is 'doctor', 'specialization' or 'all'; `key` narrows a
+        doctor or specialization report to one of them. Rows are ordered by
+        utilization, highest first.
+        """
+        first = date_type.fromisoformat(start).toordinal()
+        last = date_type.fromisoformat(end).toordinal()
+        with self._lock:
+            aggregates = self._aggregates
+            if group == 'all':
+                keys = [ALL]
+            elif key is not None:
+                keys = [(group, key)]
+            elif group == 'doctor':
+                keys = [('doctor', doctor_id) for doctor_id in aggregates.specializations]
+            else:
+                keys = [('specialization', specialization) for specialization
+                        in sorted(set(aggregates.specializations.values()) - {None})]
+            rows = []
+            for group_name, value in keys:
+                row = aggregates.report((group_name, value), first, last)
+                if group_name == 'doctor':
+                    row = dict(doctor_id=value,
+                               specialization=aggregates.specializations.get(value), **row)
+                elif group_name == 'specialization':
+                    row = dict(specialization=value, **row)
+                rows.append(row)
+        rows.sort(key=lambda row: -1 if row['utilization'] is None else row['utilization'],
+                  reverse=True)
+        return rows
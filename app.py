@@ -1,15 +1,213 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import time
 import uuid
+import click
+import flask
+import hmac
+import hashlib
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Response, request, redirect, url_for, session, flash, jsonify, g
 from functools import wraps
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.http import http_date, is_resource_modified
+from repository import create_repository
+from slots import SlotEngine, mask_to_times
+from cache import LRUCache
+from search import DoctorSearchIndex
+from analytics import Analytics, GROUPS
+from hashing import PasswordHasher, HashingBusyError
+from sessions import ServerSessionInterface, create_session_store
+from events import EventBus, create_broker, slot_topic, format_sse
+from metrics import MetricsRegistry, SamplingProfiler, begin_io, end_io
+from schedules import (new_schedule, load_schedule, diff_schedule, updated_schedule,
+                       weekly_rule, override_rule, rule_error, date_error, time_error)
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# Sessions have to verify on every worker and serverless instance, so the
+# key comes from the environment; the random fallback only suits local runs
+app.secret_key = os.environ.get('MEDISLOT_SECRET_KEY')
+if not app.secret_key:
+    app.logger.warning('MEDISLOT_SECRET_KEY is not set; sessions will not survive a restart')
+    app.secret_key = os.urandom(24)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
+# 'cookie' keeps the whole session in the signed cookie, which suits
+# serverless; 'memory' (one process) and 'sqlite' (several workers) keep
+# it server-side, where it can be revoked and outlives a key change
+app.config['SESSION_STORE'] = os.environ.get('MEDISLOT_SESSION_STORE', 'cookie')
+app.config['SESSION_MAX_ENTRIES'] = int(os.environ.get('MEDISLOT_SESSION_MAX_ENTRIES', 100000))
+app.config['SESSION_REFRESH_INTERVAL'] = 60
+app.config['SESSION_SWEEP_INTERVAL'] = 60
+app.config['SESSION_SWEEP_BATCH'] = 1000
+
+app.config['DATA_DIR'] = os.environ.get('MEDISLOT_DATA_DIR', 'data')
+app.config['STORAGE_BACKEND'] = os.environ.get('MEDISLOT_STORAGE', 'json')
+app.config['SQLITE_PATH'] = os.environ.get('MEDISLOT_SQLITE_PATH',
+                                           os.path.join(app.config['DATA_DIR'], 'medislot.sqlite3'))
+app.config['SESSION_SQLITE_PATH'] = os.environ.get('MEDISLOT_SESSION_SQLITE_PATH',
+                                                   os.path.join(app.config['DATA_DIR'], 'sessions.sqlite3'))
+# Built by `flask build-snapshot`; the JSON backend maps it when present
+app.config['SNAPSHOT_PATH'] = os.environ.get('MEDISLOT_SNAPSHOT_PATH',
+                                             os.path.join(app.config['DATA_DIR'], 'snapshot.bin'))
+app.config['SNAPSHOT_COLLECTIONS'] = os.environ.get('MEDISLOT_SNAPSHOT_COLLECTIONS',
+                                                    'doctors,schedules,availability').split(',')
+# Write-ahead log of the JSON backend, off unless a path is set (e.g.
+# data/wal.log; the directory must be writable). It is checkpointed into
+# the data files once it grows past the limit.
+app.config['WAL_PATH'] = os.environ.get('MEDISLOT_WAL_PATH', '')
+app.config['WAL_CHECKPOINT_BYTES'] = int(os.environ.get('MEDISLOT_WAL_CHECKPOINT_BYTES',
+                                                        16 * 1024 * 1024))
+# Months of appointments kept as live files by `flask compact-appointments`;
+# older ones are folded into compressed archive segments
+app.config['APPOINTMENT_LIVE_MONTHS'] = int(os.environ.get('MEDISLOT_APPOINTMENT_LIVE_MONTHS', 3))
+app.config['SLOT_MINUTES'] = int(os.environ.get('MEDISLOT_SLOT_MINUTES', 30))
+app.config['BATCH_SLOTS_MAX_DAYS'] = 31
+app.config['NEXT_AVAILABLE_MAX_RESULTS'] = 50
+app.config['DASHBOARD_PAGE_SIZE'] = 10
+app.config['DOCTOR_CACHE_SIZE'] = int(os.environ.get('MEDISLOT_DOCTOR_CACHE_SIZE', 4096))
+app.config['DOCTOR_CACHE_TTL'] = int(os.environ.get('MEDISLOT_DOCTOR_CACHE_TTL', 300))
+app.config['SEARCH_INDEX_TTL'] = int(os.environ.get('MEDISLOT_SEARCH_INDEX_TTL', 300))
+app.config['SEARCH_MAX_RESULTS'] = 50
+app.config['AUTOCOMPLETE_MAX_RESULTS'] = 20
+# Seconds between background rebuilds of the analytics aggregates
+app.config['ANALYTICS_TTL'] = int(os.environ.get('MEDISLOT_ANALYTICS_TTL', 900))
+# Count the months `flask compact-appointments` moved to the archive too
+app.config['ANALYTICS_ARCHIVED'] = os.environ.get('MEDISLOT_ANALYTICS_ARCHIVED') == '1'
+# Bearer token for the analytics API; the API is off until one is set
+app.config['ANALYTICS_TOKEN'] = os.environ.get('MEDISLOT_ANALYTICS_TOKEN')
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('MEDISLOT_FRAGMENT_CACHE_SIZE', 4096))
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('MEDISLOT_FRAGMENT_CACHE_TTL', 300))
+# Compiled template bytecode; unset uses a per-user directory under /tmp
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('MEDISLOT_TEMPLATE_CACHE_DIR')
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('MEDISLOT_PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('MEDISLOT_PASSWORD_HASH_WORKERS',
+                                                         min(4, os.cpu_count() or 1)))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('MEDISLOT_PASSWORD_HASH_MAX_PENDING', 16))
+app.config['PASSWORD_HASH_QUEUE_TIMEOUT'] = float(os.environ.get('MEDISLOT_PASSWORD_HASH_QUEUE_TIMEOUT', 5))
+app.config['ASGI_EXECUTOR_WORKERS'] = int(os.environ.get('MEDISLOT_ASGI_EXECUTOR_WORKERS', 32))
+app.config['ASGI_STREAM_CHUNK_ROWS'] = 64
+app.config['SLOT_EVENTS_BROKER'] = os.environ.get('MEDISLOT_EVENTS_BROKER', 'local')
+app.config['SLOT_EVENTS_SOCKET_DIR'] = os.environ.get('MEDISLOT_EVENTS_SOCKET_DIR',
+                                                      os.path.join(app.config['DATA_DIR'], 'events'))
+app.config['SLOT_STREAM_KEEPALIVE'] = 15
+# Each open booking page holds a live slot stream. asgi.py serves those
+# without tying up a thread and always streams; under WSGI set this only
+# with async workers (gevent, eventlet), otherwise pages poll instead.
+app.config['SLOT_STREAMING'] = os.environ.get('MEDISLOT_SLOT_STREAMING') == '1'
+# Setting MEDISLOT_PROFILE_DIR turns on the sampling profiler
+app.config['PROFILE_DIR'] = os.environ.get('MEDISLOT_PROFILE_DIR')
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('MEDISLOT_PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_KEEP'] = int(os.environ.get('MEDISLOT_PROFILE_KEEP', 20))
+
+# Instrumentation, exported on /metrics
+metrics = MetricsRegistry()
+request_latency = metrics.histogram('medislot_request_duration_seconds',
+                                    'Request latency by route',
+                                    ['method', 'route', 'status'])
+request_files = metrics.histogram('medislot_request_storage_files',
+                                  'Storage files opened per request', ['route'],
+                                  buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+request_bytes = metrics.histogram('medislot_request_storage_bytes',
+                                  'Stored JSON bytes parsed per request', ['route'],
+                                  buckets=(0, 1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18,
+                                           1 << 20, 1 << 22, 1 << 24))
+operation_latency = metrics.histogram('medislot_operation_duration_seconds',
+                                      'Time spent in storage helpers and password hashing',
+                                      ['operation'])
+template_latency = metrics.histogram('medislot_template_render_seconds',
+                                     'Template rendering time', ['template'])
+if app.config['TEMPLATE_CACHE_DIR']:
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+profiler = None
+if app.config['PROFILE_DIR']:
+    profiler = SamplingProfiler(app.config['PROFILE_DIR'], app.config['PROFILE_INTERVAL'],
+                                app.config['PROFILE_KEEP'])
+
+# Storage backend behind save_data/load_data/filter_data
+repository = create_repository(app.config['STORAGE_BACKEND'],
+                               app.config['DATA_DIR'],
+                               app.config['SQLITE_PATH'],
+                               app.config['SNAPSHOT_PATH'],
+                               app.config['WAL_PATH'],
+                               app.config['WAL_CHECKPOINT_BYTES'])
+
+# Weekly schedules are cached per process with the JSON backend, which
+# tells the engine about schedule writes made by other processes
+slot_engine = SlotEngine(repository, app.config['SLOT_MINUTES'],
+                         cache=app.config['STORAGE_BACKEND'] == 'json')
+
+# Doctor profiles by id, and derived listings (search facets, doctors per
+# specialization/location). Profiles are dropped one by one on writes; any
+# doctor write clears the listings and bumps their version. Lookups first
+# refresh the doctors collection, so with the JSON backend writes made by
+# other processes reach the caches through remote_write; with SQLite they
+# show up once DOCTOR_CACHE_TTL expires the entries.
+doctor_cache = LRUCache(app.config['DOCTOR_CACHE_SIZE'], app.config['DOCTOR_CACHE_TTL'])
+doctor_listing_cache = LRUCache(app.config['DOCTOR_CACHE_SIZE'], app.config['DOCTOR_CACHE_TTL'])
+
+# Full-text doctor search, one index per process. Built from storage on
+# first use and updated by doctor writes: those of this process directly,
+# those of other processes through remote_write (JSON backend). With SQLite
+# it is rebuilt after SEARCH_INDEX_TTL instead.
+doctor_index = DoctorSearchIndex()
+
+# Appointment and availability aggregates behind the analytics API, kept
+# per process and maintained the same way as the search index
+analytics = Analytics()
+ANALYTICS_SOURCES = ('doctors', 'schedules', 'availability', 'appointments')
+
+# Rendered HTML fragments, keyed on the version of the data they show, and
+# the time each response validator (ETag) was first served
+fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+validator_times = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], 24 * 60 * 60)
+
+# Password hashing runs in a bounded process pool off the request threads
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+                                 queue_timeout=app.config['PASSWORD_HASH_QUEUE_TIMEOUT'],
+                                 observe=lambda operation, seconds: operation_latency.observe(
+                                     seconds, operation=f'password_{operation}'))
+
+def cache_stats():
+    return {'doctor': doctor_cache.stats(), 'doctor_listing': doctor_listing_cache.stats(),
+            'fragment': fragment_cache.stats()}
+
+metrics.gauge_callback('medislot_cache_hit_ratio', 'Hit ratio of the in-process caches',
+                       lambda: [({'cache': name}, stats['hit_ratio'])
+                                for name, stats in cache_stats().items()])
+metrics.counter_callback('medislot_cache_requests_total', 'Cache lookups by result',
+                         lambda: [({'cache': name, 'result': result}, stats[key])
+                                  for name, stats in cache_stats().items()
+                                  for result, key in (('hit', 'hits'), ('miss', 'misses'))])
+metrics.gauge_callback('medislot_cache_entries', 'Entries held by the in-process caches',
+                       lambda: [({'cache': name}, stats['size'])
+                                for name, stats in cache_stats().items()])
+
+# Server-side sessions; the cookie only carries the session id
+session_store = None
+if app.config['SESSION_STORE'] != 'cookie':
+    session_store = create_session_store(app.config['SESSION_STORE'],
+                                         app.config['SESSION_SQLITE_PATH'],
+                                         app.config['SESSION_MAX_ENTRIES'])
+    app.session_interface = ServerSessionInterface(session_store,
+                                                   app.config['SESSION_REFRESH_INTERVAL'],
+                                                   app.config['SESSION_SWEEP_INTERVAL'],
+                                                   app.config['SESSION_SWEEP_BATCH'])
+    metrics.gauge_callback('medislot_sessions', 'Sessions held by the session store',
+                           lambda: [({'store': app.config['SESSION_STORE']}, len(session_store))])
+
+# Live slot deltas for booking pages; use the unix broker when running
+# several workers so a booking on one reaches streams held by the others
+slot_events = EventBus(create_broker(app.config['SLOT_EVENTS_BROKER'],
+                                     app.config['SLOT_EVENTS_SOCKET_DIR']))
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday',
+             'Friday', 'Saturday', 'Sunday']
 
 # Common diseases and their corresponding specializations
 COMMON_DISEASES = {
@@ -37,13 +235,15 @@ def format_date_filter(date_str, format='%A, %B %d, %Y'):
 # Data storage initialization
 def init_data_dirs():
     """Create necessary directories for data storage"""
-    os.makedirs('data/patients', exist_ok=True)
-    os.makedirs('data/doctors', exist_ok=True)
-    os.makedirs('data/appointments', exist_ok=True)
-    os.makedirs('data/availability', exist_ok=True)
+    data_dir = app.config['DATA_DIR']
+    os.makedirs(os.path.join(data_dir, 'patients'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'doctors'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'appointments'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'availability'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'schedules'), exist_ok=True)
     
     # Create sample doctors if none exist
-    if len(os.listdir('data/doctors')) == 0:
+    if not load_all('doctors'):
         specialties = ['Cardiology', 'Dermatology', 'Neurology', 'Pediatrics', 'Orthopedics']
         locations = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix']
         for i in range(1, 6):
@@ -52,7 +252,7 @@ def init_data_dirs():
                 'full_name': f'Dr. Smith {i}',
                 'email': f'dr.smith{i}@example.com',
                 'phone': f'123456789{i}',
-                'password': generate_password_hash(f'doctor{i}'),
+                'password': password_hasher.hash(f'doctor{i}'),
                 'specialization': specialties[i-1],
                 'location': locations[i-1],
                 'consultation_fee': 500,
@@ -62,65 +262,196 @@ def init_data_dirs():
             save_data('doctors', doctor_data['id'], doctor_data)
             
             # Set default availability (Mon-Fri, 9AM-5PM)
-            for day in range(5):
-                availability_data = {
-                    'id': str(uuid.uuid4()),
-                    'doctor_id': doctor_data['id'],
-                    'day_of_week': day,
-                    'start_time': '09:00',
-                    'end_time': '17:00',
-                    'is_available': True
-                }
-                save_data('availability', availability_data['id'], availability_data)
+            save_data('schedules', doctor_data['id'], new_schedule(doctor_data['id']))
+
+def invalidate_caches(data_type, data_id, data):
+    """Drop cached state derived from a record that is being written"""
+    slot_engine.invalidate(data_type, data)
+    if data_type == 'doctors':
+        doctor_cache.delete(data_id)
+        doctor_listing_cache.clear()
 
+@operation_latency.timed(operation='save_data')
 def save_data(data_type, data_id, data):
     """Save data to a JSON file"""
-    with open(f'data/{data_type}/{data_id}.json', 'w') as f:
-        json.dump(data, f, indent=4)
+    repository.save(data_type, data_id, data)
+    invalidate_caches(data_type, data_id, data)
+    if data_type == 'doctors':
+        doctor_index.add(data)
+    record_analytics(data_type, data_id, data)
+
+def record_analytics(data_type, data_id, data):
+    """Bring the analytics aggregates up to date with a write; `data` is None for a delete"""
+    if data_type == 'appointments':
+        analytics.record_appointment(data or {'id': data_id})
+    elif data_type == 'doctors' and data:
+        analytics.record_doctor(data)
+    elif data_type in ('schedules', 'availability') and data and data.get('doctor_id'):
+        analytics.record_schedule(data['doctor_id'], *slot_engine.working_counts(data['doctor_id']))
+
+@operation_latency.timed(operation='book_slot')
+def book_slot(appointment):
+    """Save a booked appointment unless its slot is taken; returns success"""
+    booked = repository.book_slot(appointment)
+    if booked:
+        analytics.record_appointment(appointment)
+    return booked
+
+def publish_slot_change(appointment):
+    """Tell live booking pages whether an appointment's slot is free now.
+
+    Called after the write, so a failure here is logged rather than
+    failing the request; appointments with no valid slot are not published.
+    """
+    doctor_id, date, time = appointment['doctor_id'], appointment.get('date'), appointment.get('time')
+    if date_error(date) or time_error(time):
+        return
+    try:
+        available = time in slot_engine.free_slots(doctor_id, date)
+        slot_events.publish(slot_topic(doctor_id, date), {'time': time, 'available': available})
+    except Exception:
+        app.logger.exception('Could not publish the slot change for appointment %s',
+                             appointment.get('id'))
 
+def delete_data(data_type, data_id):
+    """Delete a JSON data file"""
+    data = load_data(data_type, data_id)
+    repository.delete(data_type, data_id)
+    invalidate_caches(data_type, data_id, data)
+    if data_type == 'doctors':
+        doctor_index.remove(data_id)
+    record_analytics(data_type, data_id, None if data_type == 'appointments' else data)
+
+def remote_write(data_type, data_id, data):
+    """Update derived state for a record another process wrote; see Repository.add_listener"""
+    if data_id is None:
+        # The whole collection was re-read
+        if data_type == 'doctors':
+            doctor_cache.clear()
+            doctor_listing_cache.clear()
+            doctor_index.expire()
+        if data_type in ANALYTICS_SOURCES:
+            analytics.expire()
+        return
+    if data_type == 'doctors':
+        invalidate_caches(data_type, data_id, data)
+        if data is None:
+            doctor_index.remove(data_id)
+        else:
+            doctor_index.add(data)
+    record_analytics(data_type, data_id, data)
+
+repository.add_listener(remote_write)
+
+@operation_latency.timed(operation='load_data')
 def load_data(data_type, data_id):
     """Load data from a JSON file"""
-    try:
-        with open(f'data/{data_type}/{data_id}.json', 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
+    return repository.load(data_type, data_id)
+
+@operation_latency.timed(operation='load_many')
+def load_many(data_type, data_ids):
+    """Load several records by id in one call; returns a dict keyed by id"""
+    return repository.load_many(data_type, data_ids)
 
+@operation_latency.timed(operation='load_all')
 def load_all(data_type):
     """Load all data files of a specific type"""
-    data = []
-    for filename in os.listdir(f'data/{data_type}'):
-        if filename.endswith('.json'):
-            item = load_data(data_type, filename[:-5])
-            if item:
-                data.append(item)
-    return data
+    return repository.load_all(data_type)
 
+@operation_latency.timed(operation='find_data')
 def find_data(data_type, field, value):
     """Find data by field value"""
-    for item in load_all(data_type):
-        if item.get(field) == value:
-            return item
-    return None
+    return repository.find(data_type, field, value)
 
+@operation_latency.timed(operation='filter_data')
 def filter_data(data_type, filters):
     """Filter data by multiple criteria"""
-    results = []
-    for item in load_all(data_type):
-        match = True
-        for field, value in filters.items():
-            if item.get(field) != value:
-                match = False
-                break
-        if match:
-            results.append(item)
-    return results
+    return repository.filter(data_type, filters)
+
+def get_doctor(doctor_id):
+    """Load a doctor profile through the read-through cache"""
+    repository.refresh('doctors')
+    return doctor_cache.get_or_set(doctor_id, lambda: load_data('doctors', doctor_id))
+
+def find_doctors(specialization=None, location=None):
+    """Doctors matching the given specialization and/or location (cached)"""
+    filters = {}
+    if specialization:
+        filters['specialization'] = specialization
+    if location:
+        filters['location'] = location
+    repository.refresh('doctors')
+    return doctor_listing_cache.get_or_set(('doctors', specialization or None, location or None),
+                                           lambda: filter_data('doctors', filters))
+
+def doctor_facets():
+    """Sorted (specialties, locations) for the search dropdowns (cached)"""
+    def build():
+        doctors = find_doctors()
+        return (sorted(set(d['specialization'] for d in doctors)),
+                sorted(set(d['location'] for d in doctors)))
+    repository.refresh('doctors')
+    return doctor_listing_cache.get_or_set(('facets',), build)
+
+def doctor_version():
+    """Digest of every doctor profile; changes whenever a doctor is added or edited"""
+    def build():
+        digest = hashlib.sha1()
+        for doctor in sorted(find_doctors(), key=lambda d: d['id']):
+            digest.update(json.dumps(doctor, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+    repository.refresh('doctors')
+    return doctor_listing_cache.get_or_set(('version',), build)
+
+def search_doctors(text, limit, specialization=None, location=None):
+    """Full-text doctor search as (label, score) pairs, best first.
+
+    A label is (id, full_name, specialization, location).
+    """
+    repository.refresh('doctors')
+    doctor_index.refresh(lambda: load_all('doctors'), app.config['SEARCH_INDEX_TTL'])
+    return doctor_index.search(text, limit, specialization, location)
+
+def authenticate(data_type, email, password):
+    """Return the user with this email if the password matches.
+
+    Hashes made with other cost parameters than PASSWORD_HASH_METHOD are
+    transparently replaced after a successful login.
+    """
+    user = find_data(data_type, 'email', email)
+    if not user or not password_hasher.verify(user['password'], password):
+        return None
+    if password_hasher.needs_rehash(user['password']):
+        user['password'] = password_hasher.hash(password)
+        save_data(data_type, user['id'], user)
+    return user
+
+def encode_cursor(appointment):
+    """Opaque pagination cursor pointing at an appointment's sort position"""
+    return f"{appointment['date']}|{appointment['time']}|{appointment['id']}"
+
+def decode_cursor(cursor):
+    """Parse a cursor from encode_cursor; None if missing or malformed"""
+    parts = cursor.split('|') if cursor else []
+    return tuple(parts) if len(parts) == 3 else None
+
+def reset_session():
+    """Empty the session; a server-side one also moves to a new id"""
+    session.clear()
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+
+def login_user(user_type, user):
+    reset_session()
+    session['user_id'] = user['id']
+    session['user_type'] = user_type
+    session['full_name'] = user['full_name']
 
 # Decorators
 def patient_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_type' not in session or session['user_type'] != 'patient':
+        if session.get('user_type') != 'patient':
             flash('Please login as patient to access this page', 'danger')
             return redirect(url_for('patient_login'))
         return f(*args, **kwargs)
@@ -129,12 +460,94 @@ def patient_required(f):
 def doctor_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_type' not in session or session['user_type'] != 'doctor':
+        if session.get('user_type') != 'doctor':
             flash('Please login as doctor to access this page', 'danger')
             return redirect(url_for('doctor_login'))
         return f(*args, **kwargs)
     return decorated_function
 
+def render_template(template_name, **context):
+    """flask.render_template, timed per template"""
+    with template_latency.time(template=template_name):
+        return flask.render_template(template_name, **context)
+
+def render_fragment(template_name, key, **context):
+    """Render a template fragment once per `key` and reuse the HTML.
+
+    `key` must cover everything the fragment shows, since the cached HTML
+    is returned for any request with the same key.
+    """
+    return fragment_cache.get_or_set((template_name,) + tuple(key),
+                                     lambda: Markup(render_template(template_name, **context)))
+
+def doctor_cards(doctors, key, show_phone=False):
+    """Doctor card list for a listing identified by `key` (cached per doctor data version)"""
+    return render_fragment('patient/doctor_cards.html', (doctor_version(), show_phone) + key,
+                           doctors=doctors, show_phone=show_phone)
+
+def validators(*parts):
+    """(ETag, Last-Modified) for a response determined by `parts`.
+
+    Last-Modified is when this process first served that ETag.
+    """
+    etag = hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+    return etag, http_date(validator_times.get_or_set(etag, time.time))
+
+def page_validators(*parts):
+    """validators() for an HTML page, which also shows who is logged in"""
+    return validators(session.get('user_id'), session.get('full_name'), *parts)
+
+def conditional_response(etag_and_modified, build):
+    """Return `build()` with ETag/Last-Modified, or an empty 304 when the client's copy is current.
+
+    A page with flashed messages still to show is always rendered.
+    """
+    etag, last_modified = etag_and_modified
+    if (request.method in ('GET', 'HEAD') and '_flashes' not in session
+            and not is_resource_modified(request.environ, etag, last_modified=last_modified)):
+        response = Response(status=304)
+    else:
+        response = flask.make_response(build())
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = last_modified
+    # Revalidate on every view; pages depend on the logged in user
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    begin_io()
+    if profiler is not None:
+        profiler.start()
+
+@app.before_request
+def start_analytics():
+    """Build the analytics aggregates from a worker's first request on, not a report's"""
+    if app.config['ANALYTICS_TOKEN']:
+        analytics.start(analytics_source, app.config['ANALYTICS_TTL'])
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else '<unmatched>'
+    request_latency.observe(elapsed, method=request.method, route=route,
+                            status=response.status_code)
+    files, nbytes = end_io()
+    request_files.observe(files, route=route)
+    request_bytes.observe(nbytes, route=route)
+    if profiler is not None:
+        profiler.stop(f'{request.method} {route}', elapsed)
+    return response
+
+@app.errorhandler(HashingBusyError)
+def hashing_busy(error):
+    flash('The server is busy right now, please try again in a moment', 'warning')
+    return redirect(request.url)
+
 # Routes
 @app.route('/')
 def index():
@@ -142,7 +555,7 @@ def index():
 
 @app.route('/logout')
 def logout():
-    session.clear()
+    reset_session()
     flash('You have been logged out', 'info')
     return redirect(url_for('index'))
 
@@ -150,18 +563,17 @@ def logout():
 @app.route('/patient/register', methods=['GET', 'POST'])
 def patient_register():
     if request.method == 'POST':
-        patient_data = {
-            'id': str(uuid.uuid4()),
-            'full_name': request.form['full_name'],
-            'email': request.form['email'],
-            'phone': request.form['phone'],
-            'password': generate_password_hash(request.form['password']),
-            'created_at': datetime.now().isoformat()
-        }
-        
-        if find_data('patients', 'email', patient_data['email']):
+        if find_data('patients', 'email', request.form['email']):
             flash('Email already exists!', 'danger')
         else:
+            patient_data = {
+                'id': str(uuid.uuid4()),
+                'full_name': request.form['full_name'],
+                'email': request.form['email'],
+                'phone': request.form['phone'],
+                'password': password_hasher.hash(request.form['password']),
+                'created_at': datetime.now().isoformat()
+            }
             save_data('patients', patient_data['id'], patient_data)
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('patient_login'))
@@ -171,11 +583,9 @@ def patient_register():
 @app.route('/patient/login', methods=['GET', 'POST'])
 def patient_login():
     if request.method == 'POST':
-        patient = find_data('patients', 'email', request.form['email'])
-        if patient and check_password_hash(patient['password'], request.form['password']):
-            session['user_id'] = patient['id']
-            session['user_type'] = 'patient'
-            session['full_name'] = patient['full_name']
+        patient = authenticate('patients', request.form['email'], request.form['password'])
+        if patient:
+            login_user('patient', patient)
             flash('Login successful!', 'success')
             return redirect(url_for('patient_dashboard'))
         else:
@@ -187,34 +597,35 @@ def patient_login():
 @patient_required
 def patient_dashboard():
     today = datetime.now().strftime('%Y-%m-%d')
+    user_id = session['user_id']
+    before = decode_cursor(request.args.get('before'))
     
-    # Get all patient appointments
-    appointments = []
-    for appt in load_all('appointments'):
-        if appt['patient_id'] == session['user_id']:
-            doctor = load_data('doctors', appt['doctor_id'])
-            if doctor:
-                appt_data = {
-                    **appt,
-                    'doctor_name': doctor['full_name'],
-                    'specialization': doctor['specialization'],
-                    'location': doctor['location']
-                }
-                appointments.append(appt_data)
-    
-    # Separate upcoming and past appointments
-    upcoming = [a for a in appointments 
-               if a['status'] == 'booked' and a['date'] >= today]
-    past = [a for a in appointments 
-           if a['status'] == 'completed' or a['date'] < today]
-    
-    # Sort appointments
-    upcoming.sort(key=lambda x: (x['date'], x['time']))
-    past.sort(key=lambda x: (x['date'], x['time']), reverse=True)
+    # Walk the patient's date-ordered appointment index
+    upcoming = repository.ordered('appointments', 'patient_id', user_id, start=(today,),
+                                  predicate=lambda a: a['status'] == 'booked')
+    past = repository.ordered('appointments', 'patient_id', user_id, start=before, reverse=True,
+                              limit=app.config['DASHBOARD_PAGE_SIZE'] + 1,
+                              predicate=lambda a: a['status'] == 'completed' or a['date'] < today)
+    next_cursor = None
+    if len(past) > app.config['DASHBOARD_PAGE_SIZE']:
+        past = past[:app.config['DASHBOARD_PAGE_SIZE']]
+        next_cursor = encode_cursor(past[-1])
+    
+    # Join doctor details with one batched lookup
+    doctors = load_many('doctors', [a['doctor_id'] for a in upcoming + past])
+    def with_doctor(appointments):
+        return [{
+            **appt,
+            'doctor_name': doctors[appt['doctor_id']]['full_name'],
+            'specialization': doctors[appt['doctor_id']]['specialization'],
+            'location': doctors[appt['doctor_id']]['location']
+        } for appt in appointments if appt['doctor_id'] in doctors]
     
     return render_template('patient/dashboard.html', 
-                         upcoming=upcoming, 
-                         past=past,
+                         upcoming=with_doctor(upcoming), 
+                         past=with_doctor(past),
+                         next_cursor=next_cursor,
+                         paged=before is not None,
                          common_diseases=COMMON_DISEASES.keys())
 
 @app.route('/find-doctors/<disease>')
@@ -225,36 +636,48 @@ def find_doctors_by_disease(disease):
         return redirect(url_for('patient_dashboard'))
     
     specialization = COMMON_DISEASES[disease]
-    doctors = filter_data('doctors', {'specialization': specialization})
     
-    return render_template('patient/doctors_list.html',
-                         disease=disease,
-                         specialization=specialization,
-                         doctors=doctors)
+    def render():
+        doctors = find_doctors(specialization=specialization)
+        return render_template('patient/doctors_list.html',
+                             disease=disease,
+                             specialization=specialization,
+                             doctors=doctors,
+                             doctor_cards=doctor_cards(doctors, (specialization,), show_phone=True))
+    
+    return conditional_response(page_validators('doctors_list', disease, doctor_version()), render)
 
 @app.route('/patient/search', methods=['GET', 'POST'])
 @patient_required
 def doctor_search():
-    doctors = load_all('doctors')
-    specialties = sorted(set(d['specialization'] for d in doctors))
-    locations = sorted(set(d['location'] for d in doctors))
+    specialization = request.form.get('specialization') or None
+    location = request.form.get('location') or None
+    query = request.form.get('q', '').strip()
     
-    if request.method == 'POST':
-        specialization = request.form.get('specialization')
-        location = request.form.get('location')
-        doctors = [d for d in doctors 
-                  if (not specialization or d['specialization'] == specialization) and
-                     (not location or d['location'] == location)]
+    def render():
+        specialties, locations = doctor_facets()
+        if query:
+            # Ranked full-text matches, narrowed by the dropdowns
+            matches = search_doctors(query, app.config['SEARCH_MAX_RESULTS'],
+                                     specialization, location)
+            found = load_many('doctors', [label[0] for label, _ in matches])
+            doctors = [found[label[0]] for label, _ in matches if label[0] in found]
+        else:
+            doctors = find_doctors(specialization, location)
+        return render_template('patient/search.html',
+                             doctors=doctors,
+                             doctor_cards=doctor_cards(doctors, (specialization, location, query)),
+                             specialties=specialties,
+                             locations=locations)
     
-    return render_template('patient/search.html',
-                         doctors=doctors,
-                         specialties=specialties,
-                         locations=locations)
+    if request.method == 'POST':
+        return render()
+    return conditional_response(page_validators('search', doctor_version()), render)
 
 @app.route('/patient/book/<doctor_id>', methods=['GET', 'POST'])
 @patient_required
 def book_appointment(doctor_id):
-    doctor = load_data('doctors', doctor_id)
+    doctor = get_doctor(doctor_id)
     if not doctor:
         flash('Doctor not found', 'danger')
         return redirect(url_for('doctor_search'))
@@ -263,73 +686,54 @@ def book_appointment(doctor_id):
         date = request.form['date']
         time = request.form['time']
         
-        # Check if slot is available
-        existing = filter_data('appointments', {
+        error = date_error(date) or time_error(time)
+        if not error and time not in slot_engine.free_slots(doctor_id, date):
+            working = mask_to_times(slot_engine.working_mask(doctor_id, date), slot_engine.slot_minutes)
+            error = ('This time slot is already booked!' if time in working
+                     else f'The doctor has no slot at {time} on {date}')
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('book_appointment', doctor_id=doctor_id))
+        
+        appointment_data = {
+            'id': str(uuid.uuid4()),
+            'patient_id': session['user_id'],
             'doctor_id': doctor_id,
             'date': date,
             'time': time,
-            'status': 'booked'
-        })
+            'status': 'booked',
+            'notes': request.form.get('notes', ''),
+            'created_at': datetime.now().isoformat()
+        }
         
-        if existing:
+        # Check and claim the slot in one atomic step
+        if not book_slot(appointment_data):
             flash('This time slot is already booked!', 'danger')
         else:
-            appointment_data = {
-                'id': str(uuid.uuid4()),
-                'patient_id': session['user_id'],
-                'doctor_id': doctor_id,
-                'date': date,
-                'time': time,
-                'status': 'booked',
-                'notes': request.form.get('notes', ''),
-                'created_at': datetime.now().isoformat()
-            }
-            save_data('appointments', appointment_data['id'], appointment_data)
+            publish_slot_change(appointment_data)
             flash('Appointment booked successfully!', 'success')
             return redirect(url_for('patient_dashboard'))
     
-    # Get available slots for the next 7 days
-    available_slots = []
+    # Free slots for the next 7 days; each day's mask is its booking version
+    days = []
     for i in range(7):
-        day = (datetime.now() + timedelta(days=i)).strftime('%Y-%m-%d')
-        day_of_week = (datetime.now() + timedelta(days=i)).weekday()
-        
-        # Get doctor's availability for this day
-        availability = filter_data('availability', {
-            'doctor_id': doctor_id,
-            'day_of_week': day_of_week,
-            'is_available': True
-        })
-        
-        if availability:
-            for avail in availability:
-                # Get booked slots for this day
-                booked = filter_data('appointments', {
-                    'doctor_id': doctor_id,
-                    'date': day,
-                    'status': 'booked'
-                })
-                booked_times = [appt['time'] for appt in booked]
-                
-                # Generate available slots
-                start = datetime.strptime(avail['start_time'], '%H:%M')
-                end = datetime.strptime(avail['end_time'], '%H:%M')
-                
-                current = start
-                while current + timedelta(minutes=30) <= end:
-                    slot_time = current.strftime('%H:%M')
-                    if slot_time not in booked_times:
-                        available_slots.append({
-                            'date': day,
-                            'day_name': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 
-                                        'Friday', 'Saturday', 'Sunday'][day_of_week],
-                            'slot_time': slot_time
-                        })
-                    current += timedelta(minutes=30)
-    
-    return render_template('patient/book.html', 
-                         doctor=doctor, 
-                         available_slots=available_slots)
+        day_date = (datetime.now() + timedelta(days=i)).date()
+        days.append((day_date.isoformat(), day_date.weekday(),
+                     slot_engine.free_mask(doctor_id, day_date.isoformat(), day_date.weekday())))
+    
+    def render():
+        # One cached slot-grid fragment per doctor-day
+        slot_grid = Markup('').join(
+            render_fragment('patient/slot_grid.html', ('slot_grid', doctor_id, day, free),
+                            date=day, day_name=DAY_NAMES[day_of_week],
+                            slots=mask_to_times(free, slot_engine.slot_minutes))
+            for day, day_of_week, free in days if free)
+        return render_template('patient/book.html', 
+                             doctor=doctor, 
+                             slot_grid=slot_grid,
+                             slot_streaming=slot_streaming())
+    
+    return conditional_response(page_validators('book', doctor, days), render)
 
 @app.route('/patient/cancel/<appointment_id>')
 @patient_required
@@ -338,6 +742,7 @@ def cancel_appointment(appointment_id):
     if appointment and appointment['patient_id'] == session['user_id']:
         appointment['status'] = 'cancelled'
         save_data('appointments', appointment_id, appointment)
+        publish_slot_change(appointment)
         flash('Appointment cancelled successfully', 'success')
     else:
         flash('Appointment not found or you are not authorized to cancel it', 'danger')
@@ -347,35 +752,25 @@ def cancel_appointment(appointment_id):
 @app.route('/doctor/register', methods=['GET', 'POST'])
 def doctor_register():
     if request.method == 'POST':
-        doctor_data = {
-            'id': str(uuid.uuid4()),
-            'full_name': request.form['full_name'],
-            'email': request.form['email'],
-            'phone': request.form['phone'],
-            'password': generate_password_hash(request.form['password']),
-            'specialization': request.form['specialization'],
-            'location': request.form['location'],
-            'consultation_fee': 500,
-            'bio': request.form.get('bio', ''),
-            'created_at': datetime.now().isoformat()
-        }
-        
-        if find_data('doctors', 'email', doctor_data['email']):
+        if find_data('doctors', 'email', request.form['email']):
             flash('Email already exists!', 'danger')
         else:
+            doctor_data = {
+                'id': str(uuid.uuid4()),
+                'full_name': request.form['full_name'],
+                'email': request.form['email'],
+                'phone': request.form['phone'],
+                'password': password_hasher.hash(request.form['password']),
+                'specialization': request.form['specialization'],
+                'location': request.form['location'],
+                'consultation_fee': 500,
+                'bio': request.form.get('bio', ''),
+                'created_at': datetime.now().isoformat()
+            }
             save_data('doctors', doctor_data['id'], doctor_data)
             
             # Set default availability (Mon-Fri, 9AM-5PM)
-            for day in range(5):
-                availability_data = {
-                    'id': str(uuid.uuid4()),
-                    'doctor_id': doctor_data['id'],
-                    'day_of_week': day,
-                    'start_time': '09:00',
-                    'end_time': '17:00',
-                    'is_available': True
-                }
-                save_data('availability', availability_data['id'], availability_data)
+            save_data('schedules', doctor_data['id'], new_schedule(doctor_data['id']))
             
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('doctor_login'))
@@ -385,11 +780,9 @@ def doctor_register():
 @app.route('/doctor/login', methods=['GET', 'POST'])
 def doctor_login():
     if request.method == 'POST':
-        doctor = find_data('doctors', 'email', request.form['email'])
-        if doctor and check_password_hash(doctor['password'], request.form['password']):
-            session['user_id'] = doctor['id']
-            session['user_type'] = 'doctor'
-            session['full_name'] = doctor['full_name']
+        doctor = authenticate('doctors', request.form['email'], request.form['password'])
+        if doctor:
+            login_user('doctor', doctor)
             flash('Login successful!', 'success')
             return redirect(url_for('doctor_dashboard'))
         else:
@@ -402,71 +795,85 @@ def doctor_login():
 def doctor_dashboard():
     today = datetime.now().strftime('%Y-%m-%d')
     today_formatted = datetime.now().strftime('%A, %B %d, %Y')
+    user_id = session['user_id']
+    before = decode_cursor(request.args.get('before'))
+    
+    # Walk the doctor's date-ordered appointment index
+    booked = repository.ordered('appointments', 'doctor_id', user_id, start=(today,),
+                                predicate=lambda a: a['status'] == 'booked')
+    past = repository.ordered('appointments', 'doctor_id', user_id, start=before, reverse=True,
+                              limit=app.config['DASHBOARD_PAGE_SIZE'] + 1,
+                              predicate=lambda a: a['status'] == 'completed' or a['date'] < today)
+    next_cursor = None
+    if len(past) > app.config['DASHBOARD_PAGE_SIZE']:
+        past = past[:app.config['DASHBOARD_PAGE_SIZE']]
+        next_cursor = encode_cursor(past[-1])
+    
+    # Join patient details with one batched lookup
+    patients = load_many('patients', [a['patient_id'] for a in booked + past])
+    def with_patient(appointments):
+        return [{
+            **appt,
+            'patient_name': patients[appt['patient_id']]['full_name'],
+            'patient_phone': patients[appt['patient_id']]['phone']
+        } for appt in appointments if appt['patient_id'] in patients]
+    booked = with_patient(booked)
     
-    # Get appointments
-    appointments = []
-    for appt in load_all('appointments'):
-        if appt['doctor_id'] == session['user_id']:
-            patient = load_data('patients', appt['patient_id'])
-            if patient:
-                appt_data = {
-                    **appt,
-                    'patient_name': patient['full_name'],
-                    'patient_phone': patient['phone']
-                }
-                appointments.append(appt_data)
-    
-    # Categorize appointments
-    todays_appointments = [a for a in appointments 
-                         if a['date'] == today and a['status'] == 'booked']
-    upcoming = [a for a in appointments 
-               if a['date'] > today and a['status'] == 'booked']
-    past = [a for a in appointments 
-           if a['status'] == 'completed' or a['date'] < today]
-    
-    # Sort appointments
-    todays_appointments.sort(key=lambda x: x['time'])
-    upcoming.sort(key=lambda x: (x['date'], x['time']))
-    past.sort(key=lambda x: (x['date'], x['time']), reverse=True)
+    # Categorize appointments; the index already returns them in order
+    todays_appointments = [a for a in booked if a['date'] == today]
+    upcoming = [a for a in booked if a['date'] > today]
     
     return render_template('doctor/dashboard.html',
                          todays_appointments=todays_appointments,
                          upcoming=upcoming,
-                         past=past,
+                         past=with_patient(past),
+                         next_cursor=next_cursor,
+                         paged=before is not None,
                          today_formatted=today_formatted)
 
 @app.route('/doctor/availability', methods=['GET', 'POST'])
 @doctor_required
 def manage_availability():
+    doctor_id = session['user_id']
     if request.method == 'POST':
-        # Remove existing availability
-        for avail in load_all('availability'):
-            if avail['doctor_id'] == session['user_id']:
-                os.remove(f"data/availability/{avail['id']}.json")
+        # Collect the submitted weekly hours and date overrides
+        try:
+            weekly = [weekly_rule(day, start_time, end_time)
+                      for day, start_time, end_time in zip(request.form.getlist('day'),
+                                                           request.form.getlist('start_time'),
+                                                           request.form.getlist('end_time'))
+                      if day and start_time and end_time]
+        except ValueError:
+            flash('Unknown day of the week', 'danger')
+            return redirect(url_for('manage_availability'))
+        overrides = [override_rule(date, start_time, end_time, is_available == '1')
+                     for date, start_time, end_time, is_available in zip(
+                         request.form.getlist('override_date'),
+                         request.form.getlist('override_start_time'),
+                         request.form.getlist('override_end_time'),
+                         request.form.getlist('override_available'))
+                     if date and (is_available != '1' or (start_time and end_time))]
+        for rule in weekly + overrides:
+            error = rule_error(rule)
+            if error:
+                flash(error, 'danger')
+                return redirect(url_for('manage_availability'))
         
-        # Add new availability
-        days = request.form.getlist('day')
-        start_times = request.form.getlist('start_time')
-        end_times = request.form.getlist('end_time')
-        
-        for day, start_time, end_time in zip(days, start_times, end_times):
-            if day and start_time and end_time:
-                availability_data = {
-                    'id': str(uuid.uuid4()),
-                    'doctor_id': session['user_id'],
-                    'day_of_week': int(day),
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'is_available': True
-                }
-                save_data('availability', availability_data['id'], availability_data)
+        # Write only when the schedule actually changed, as one document
+        old = load_schedule(repository, doctor_id)
+        diff = diff_schedule(old, weekly, overrides)
+        if diff['changed'] or not old['version']:
+            save_data('schedules', doctor_id, updated_schedule(old, diff))
+            if not old['version']:
+                # First save replaces the legacy per-row availability files
+                for avail in filter_data('availability', {'doctor_id': doctor_id}):
+                    delete_data('availability', avail['id'])
         
         flash('Availability updated successfully!', 'success')
         return redirect(url_for('doctor_dashboard'))
     
     # Get current availability
-    availability = filter_data('availability', {'doctor_id': session['user_id']})
-    availability.sort(key=lambda x: (x['day_of_week'], x['start_time']))
+    schedule = load_schedule(repository, doctor_id)
     
     days = [
         {'id': 0, 'name': 'Monday'},
@@ -479,7 +886,8 @@ def manage_availability():
     ]
     
     return render_template('doctor/availability.html', 
-                         availability=availability, 
+                         availability=schedule['weekly'], 
+                         overrides=schedule['overrides'],
                          days=days)
 
 @app.route('/doctor/appointment/<appointment_id>/<action>')
@@ -500,51 +908,430 @@ def manage_appointment(appointment_id, action):
             flash('Appointment cancelled', 'success')
         
         save_data('appointments', appointment_id, appointment)
+        publish_slot_change(appointment)
     else:
         flash('Appointment not found or you are not authorized to modify it', 'danger')
     
     return redirect(url_for('doctor_dashboard'))
 
 # API endpoints
-@app.route('/api/doctor/<doctor_id>/slots')
-def get_available_slots(doctor_id):
-    date_str = request.args.get('date')
+#
+# Each API is a plain function of the query arguments returning
+# (payload, status), so the Flask routes below and the async routes in
+# asgi.py serve identical responses.
+def doctor_slots_query(doctor_id, args):
+    date_str = args.get('date')
     if not date_str:
-        return jsonify({'error': 'Date parameter is required'}), 400
+        return {'error': 'Date parameter is required'}, 400
     
     try:
         date_obj = datetime.strptime(date_str, '%Y-%m-%d')
         day_of_week = date_obj.weekday()
     except ValueError:
-        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
-    
-    # Get doctor's availability
-    availability = filter_data('availability', {
-        'doctor_id': doctor_id,
-        'day_of_week': day_of_week,
-        'is_available': True
-    })
-    
-    # Get booked slots
-    booked_slots = [a['time'] for a in load_all('appointments')
-                  if a['doctor_id'] == doctor_id and
-                  a['date'] == date_str and
-                  a['status'] == 'booked']
-    
-    # Generate available slots
-    available_slots = []
-    for avail in availability:
-        start = datetime.strptime(avail['start_time'], '%H:%M')
-        end = datetime.strptime(avail['end_time'], '%H:%M')
-        current = start
-        
-        while current + timedelta(minutes=30) <= end:
-            slot_time = current.strftime('%H:%M')
-            if slot_time not in booked_slots:
-                available_slots.append(slot_time)
-            current += timedelta(minutes=30)
+        return {'error': 'Invalid date format. Use YYYY-MM-DD'}, 400
+    
+    # Free slots are the doctor's working slots minus the booked ones
+    available_slots = slot_engine.free_slots(doctor_id, date_str, day_of_week)
     
-    return jsonify({'slots': available_slots})
+    return {'slots': available_slots}, 200
+
+def batch_slots_query(args):
+    """Parse a batch slots request into the doctors and date range to scan.
+
+    Doctors are picked with repeated `doctor_id` (or comma-separated
+    `doctor_ids`) arguments, or with `specialization`/`location` filters
+    like the search page.
+    """
+    doctor_ids = args.getlist('doctor_id')
+    for ids in args.getlist('doctor_ids'):
+        doctor_ids.extend(i for i in ids.split(',') if i)
+    
+    try:
+        start = datetime.strptime(args.get('start') or datetime.now().strftime('%Y-%m-%d'),
+                                  '%Y-%m-%d').date()
+        days = int(args.get('days', 7))
+    except ValueError:
+        return {'error': 'Use start=YYYY-MM-DD and an integer days'}, 400
+    if not 1 <= days <= app.config['BATCH_SLOTS_MAX_DAYS']:
+        return {'error': f"days must be between 1 and {app.config['BATCH_SLOTS_MAX_DAYS']}"}, 400
+    
+    if not doctor_ids:
+        doctor_ids = [d['id'] for d in find_doctors(args.get('specialization'),
+                                                    args.get('location'))]
+    
+    return {'doctor_ids': doctor_ids, 'start': start, 'days': days,
+            'ndjson': args.get('format') == 'ndjson'}, 200
+
+def iter_batch_slots(query):
+    """Yield one {'doctor_id', 'date', 'slots'} row per doctor-day with free slots"""
+    for doctor_id in query['doctor_ids']:
+        for day, slots in slot_engine.free_slots_range(doctor_id, query['start'], query['days']):
+            yield {'doctor_id': doctor_id, 'date': day, 'slots': slots}
+
+def batch_slots_document(query):
+    result = {doctor_id: {} for doctor_id in query['doctor_ids']}
+    for row in iter_batch_slots(query):
+        result[row['doctor_id']][row['date']] = row['slots']
+    return {'start': query['start'].isoformat(), 'days': query['days'], 'doctors': result}
+
+def next_available_query(args):
+    """Earliest free appointments across every matching doctor.
+
+    Doctors are matched by `disease` (via COMMON_DISEASES) or
+    `specialization`, optionally narrowed by `location`; `limit` results
+    are returned in time order from the next `days` days.
+    """
+    disease = args.get('disease')
+    if disease:
+        if disease not in COMMON_DISEASES:
+            return {'error': 'Unknown disease'}, 400
+        specialization = COMMON_DISEASES[disease]
+    else:
+        specialization = args.get('specialization')
+    
+    try:
+        limit = int(args.get('limit', 10))
+        days = int(args.get('days', 30))
+    except ValueError:
+        return {'error': 'limit and days must be integers'}, 400
+    limit = max(1, min(limit, app.config['NEXT_AVAILABLE_MAX_RESULTS']))
+    days = max(1, min(days, app.config['BATCH_SLOTS_MAX_DAYS']))
+    
+    doctors = {d['id']: d for d in find_doctors(specialization, args.get('location'))}
+    now = datetime.now()
+    earliest = slot_engine.earliest_slots(list(doctors), now.date(), days=days, limit=limit,
+                                          first_minute=now.hour * 60 + now.minute)
+    
+    results = []
+    for doctor_id, date, time in earliest:
+        doctor = doctors[doctor_id]
+        results.append({
+            'doctor_id': doctor_id,
+            'doctor_name': doctor['full_name'],
+            'specialization': doctor['specialization'],
+            'location': doctor['location'],
+            'date': date,
+            'time': time
+        })
+    return {'results': results}, 200
+
+def analytics_source():
+    """Everything Analytics.refresh rebuilds from"""
+    doctors = load_all('doctors')
+    schedules = [(doctor['id'],) + slot_engine.working_counts(doctor['id']) for doctor in doctors]
+    # Streamed past the repository cache, so a worker does not hold the
+    # whole history; writes from here on reach the aggregates through
+    # remote_write. Archived months only count when asked for.
+    repository.refresh('appointments')
+    return doctors, schedules, repository.scan('appointments', app.config['ANALYTICS_ARCHIVED'])
+
+def utilization_query(args):
+    """Booked, completed and cancelled appointments against available slots.
+
+    Rows are per `group` ('doctor', 'specialization' or 'all') over the
+    dates `start`..`end` (default: the last 30 days), optionally narrowed
+    to one `doctor_id` or `specialization`, with a per-weekday breakdown.
+    """
+    group = args.get('group', 'doctor')
+    if group not in GROUPS:
+        return {'error': f"group must be one of {', '.join(GROUPS)}"}, 400
+    today = datetime.now().date()
+    try:
+        end = datetime.strptime(args.get('end') or today.isoformat(), '%Y-%m-%d').date()
+        start = datetime.strptime(args.get('start') or (end - timedelta(days=29)).isoformat(),
+                                  '%Y-%m-%d').date()
+    except ValueError:
+        return {'error': 'Use start=YYYY-MM-DD and end=YYYY-MM-DD'}, 400
+    if start > end:
+        return {'error': 'start must not be after end'}, 400
+    key = args.get('doctor_id') if group == 'doctor' else None
+    if group == 'specialization':
+        key = args.get('specialization')
+    
+    # Served from the last build; rebuilds run in the background
+    analytics.start(analytics_source, app.config['ANALYTICS_TTL'])
+    if analytics.built_at is None:
+        return {'error': 'Analytics are still being prepared; try again shortly'}, 503
+    for data_type in ANALYTICS_SOURCES:
+        repository.refresh(data_type)
+    rows = analytics.utilization(group, start.isoformat(), end.isoformat(), key)
+    if group == 'doctor' and args.get('specialization'):
+        rows = [row for row in rows if row['specialization'] == args['specialization']]
+    return {'group': group, 'start': start.isoformat(), 'end': end.isoformat(), 'results': rows}, 200
+
+def slots_validators(doctor_id, args, body):
+    """ETag/Last-Modified of a doctor slots response"""
+    return validators('slots', doctor_id, args.get('date'), body['slots'])
+
+def autocomplete_query(args):
+    """Doctors and words matching a partly typed search box.
+
+    Matches names, specializations, locations and bio words by prefix and
+    with typos; `limit` caps the doctors returned.
+    """
+    text = args.get('q', '')
+    try:
+        limit = int(args.get('limit', 8))
+    except ValueError:
+        return {'error': 'limit must be an integer'}, 400
+    limit = max(1, min(limit, app.config['AUTOCOMPLETE_MAX_RESULTS']))
+    
+    matches = search_doctors(text, limit, args.get('specialization'), args.get('location'))
+    return {
+        'query': text,
+        'doctors': [{
+            'id': doctor_id,
+            'full_name': full_name,
+            'specialization': specialization,
+            'location': location,
+            'score': round(score, 3)
+        } for (doctor_id, full_name, specialization, location), score in matches],
+        'completions': doctor_index.complete(text)
+    }, 200
+
+@app.route('/api/doctor/<doctor_id>/slots')
+def get_available_slots(doctor_id):
+    body, status = doctor_slots_query(doctor_id, request.args)
+    if status != 200:
+        return jsonify(body), status
+    return conditional_response(slots_validators(doctor_id, request.args, body),
+                                lambda: jsonify(body))
+
+@app.route('/api/slots')
+def get_available_slots_batch():
+    """Free slots for many doctors over a date range in one response.
+
+    `format=ndjson` streams one line per doctor-day instead.
+    """
+    query, status = batch_slots_query(request.args)
+    if status != 200:
+        return jsonify(query), status
+    if query['ndjson']:
+        return Response((json.dumps(row) + '\n' for row in iter_batch_slots(query)),
+                        mimetype='application/x-ndjson')
+    return jsonify(batch_slots_document(query))
+
+def slot_streaming():
+    """Whether pages should follow slots over server-sent events rather than poll"""
+    return app.config['SLOT_STREAMING'] or request.environ.get('medislot.asgi', False)
+
+@app.route('/api/doctor/<doctor_id>/slots/stream')
+def stream_available_slots(doctor_id):
+    """Server-sent events for one doctor-day.
+
+    Sends a `snapshot` of the free slots, then a `delta` with `time` and
+    `available` whenever an appointment on that day changes. Off under
+    WSGI unless SLOT_STREAMING is set, since each stream pins a worker.
+    """
+    if not app.config['SLOT_STREAMING']:
+        return jsonify({'error': 'Live slot updates are off; poll /api/doctor/<doctor_id>/slots'}), 404
+    # Subscribe before taking the snapshot so no change falls in between
+    subscription = slot_events.subscribe(slot_topic(doctor_id, request.args.get('date')))
+    snapshot, status = doctor_slots_query(doctor_id, request.args)
+    if status != 200:
+        subscription.close()
+        return jsonify(snapshot), status
+    date = request.args['date']
+    keepalive = app.config['SLOT_STREAM_KEEPALIVE']
+    
+    def stream():
+        with subscription:
+            yield format_sse('snapshot', snapshot)
+            while True:
+                event = subscription.get(timeout=keepalive)
+                if subscription.overflowed:
+                    # Deltas were dropped; start over from a fresh snapshot
+                    subscription.overflowed = False
+                    yield format_sse('snapshot', {'slots': slot_engine.free_slots(doctor_id, date)})
+                elif event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield format_sse('delta', event)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/next-available')
+def next_available():
+    body, status = next_available_query(request.args)
+    return jsonify(body), status
+
+@app.route('/api/doctors/autocomplete')
+def autocomplete_doctors():
+    body, status = autocomplete_query(request.args)
+    return jsonify(body), status
+
+@app.route('/api/analytics/utilization')
+def utilization_analytics():
+    token = app.config['ANALYTICS_TOKEN']
+    if not token:
+        return jsonify({'error': 'Analytics is disabled; set MEDISLOT_ANALYTICS_TOKEN'}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Missing or invalid analytics token'}), 401
+    body, status = utilization_query(request.args)
+    response = jsonify(body)
+    if status == 503:
+        response.headers['Retry-After'] = '5'
+    return response, status
+
+# Monitoring
+@app.route('/metrics')
+def export_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# CLI commands
+@app.cli.command('migrate-json')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Records written per transaction.')
+def migrate_json_command(batch_size):
+    """Import the data/ JSON tree into the SQLite backend"""
+    from sqlite_store import SQLiteRepository, migrate_json
+    store = SQLiteRepository(app.config['SQLITE_PATH'])
+    counts = migrate_json(app.config['DATA_DIR'], store, batch_size=batch_size)
+    for data_type, count in counts.items():
+        click.echo(f'{data_type}: {count} records')
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(['doctors', 'patients', 'availability', 'appointments']))
+@click.argument('source', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format [default: from the file extension].')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Records written per transaction.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              help='Password hashing processes.')
+@click.option('--dry-run', is_flag=True, help='Validate and deduplicate without writing.')
+def import_data_command(kind, source, fmt, batch_size, workers, dry_run):
+    """Import doctors, patients, availability or appointments from CSV or JSONL.
+
+    Users need a `password` (hashed on import) or a `password_hash` from
+    `export-data --include-passwords`; availability and appointment rows
+    name their doctor and patient by `*_id` or `*_email`. Booked
+    appointments claim their slots one at a time. Rejected rows are
+    listed and skipped.
+    """
+    from bulk import BulkImporter, detect_format, read_rows
+    try:
+        fmt = fmt or detect_format(source)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], workers=workers)
+    importer = BulkImporter(repository, hasher, batch_size=batch_size, dry_run=dry_run,
+                            report=lambda line, message: click.echo(
+                                f'line {line}: {message}' if line else message, err=True))
+    started = time.perf_counter()
+    stream = click.get_text_stream('stdin') if source == '-' else open(source, newline='',
+                                                                     encoding='utf-8')
+    try:
+        counts = importer.run(kind, read_rows(stream, fmt))
+    finally:
+        if source != '-':
+            stream.close()
+        hasher.shutdown()
+    seconds = time.perf_counter() - started
+    click.echo(f"{kind}: {counts['imported']} imported, {counts['rejected']} rejected, "
+               f"{counts['written']} records written in {seconds:.1f}s"
+               + (' (dry run)' if dry_run else ''))
+
+@app.cli.command('export-data')
+@click.argument('kind', type=click.Choice(['doctors', 'patients', 'availability', 'appointments']))
+@click.argument('target', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Output format [default: from the file extension].')
+@click.option('--include-passwords', is_flag=True,
+              help='Add the stored password hashes; without them the users cannot be re-imported.')
+def export_data_command(kind, target, fmt, include_passwords):
+    """Export doctors, patients, availability or appointments as CSV or JSONL"""
+    from bulk import detect_format, export_columns, export_rows, write_rows
+    try:
+        fmt = fmt or detect_format(target)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    stream = click.get_text_stream('stdout') if target == '-' else open(target, 'w', newline='',
+                                                                      encoding='utf-8')
+    try:
+        count = write_rows(stream, fmt, export_columns(kind, include_passwords),
+                           export_rows(repository, kind, include_passwords))
+    finally:
+        if target != '-':
+            stream.close()
+    click.echo(f'{kind}: {count} rows exported', err=True)
+
+@app.cli.command('revoke-sessions')
+@click.argument('user')
+def revoke_sessions_command(user):
+    """Log a doctor or patient (by id or email) out of every session"""
+    if session_store is None:
+        raise click.ClickException('sessions live in cookies; set MEDISLOT_SESSION_STORE to revoke them')
+    user_id = user
+    for data_type in ('doctors', 'patients'):
+        found = find_data(data_type, 'email', user)
+        if found:
+            user_id = found['id']
+            break
+    click.echo(f'{session_store.revoke_user(user_id)} sessions revoked')
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions_command():
+    """Delete every expired server-side session"""
+    if session_store is None:
+        raise click.ClickException('sessions live in cookies; nothing to sweep')
+    total = 0
+    while True:
+        removed = session_store.sweep(app.config['SESSION_SWEEP_BATCH'])
+        total += removed
+        if removed < app.config['SESSION_SWEEP_BATCH']:
+            break
+    click.echo(f'{total} expired sessions deleted')
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """Snapshot the JSON doctor and schedule indexes for fast cold starts"""
+    from snapshot import write_snapshot
+    if app.config['STORAGE_BACKEND'] != 'json':
+        raise click.ClickException('Snapshots are only used by the JSON backend')
+    counts = write_snapshot(repository, app.config['SNAPSHOT_PATH'],
+                            app.config['SNAPSHOT_COLLECTIONS'])
+    for data_type, count in counts.items():
+        click.echo(f'{data_type}: {count} records')
+    click.echo(f"Wrote {app.config['SNAPSHOT_PATH']}")
+
+@app.cli.command('compact-appointments')
+@click.option('--live-months', type=int, default=None,
+              help='Months before the current one kept as live files '
+                   '[default: APPOINTMENT_LIVE_MONTHS].')
+def compact_appointments_command(live_months):
+    """Partition flat appointment files and archive months past --live-months"""
+    if app.config['STORAGE_BACKEND'] != 'json':
+        raise click.ClickException('Appointment partitions are only used by the JSON backend')
+    if live_months is None:
+        live_months = app.config['APPOINTMENT_LIVE_MONTHS']
+    today = datetime.now().date()
+    cutoff = today.year * 12 + today.month - 1 - live_months
+    before = f'{cutoff // 12:04d}-{cutoff % 12 + 1:02d}'
+    moved, archived = repository.compact('appointments', before)
+    click.echo(f'{moved} flat files moved into partitions')
+    for month, count in sorted(archived.items()):
+        click.echo(f'{month}: {count} records archived')
+
+@app.cli.command('checkpoint-wal')
+def checkpoint_wal_command():
+    """Sync the JSON data files and empty the write-ahead log"""
+    if getattr(repository, 'wal', None) is None:
+        raise click.ClickException('The write-ahead log is only used by the JSON backend '
+                                   'with MEDISLOT_WAL_PATH set')
+    size = repository.wal.size()
+    repository.checkpoint()
+    click.echo(f'Checkpointed {size} bytes of {repository.wal.path}')
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the bytecode cache ahead of the first request"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    click.echo(f'Compiled {len(names)} templates into {app.jinja_env.bytecode_cache.directory}')
 
 if __name__ == '__main__':
     init_data_dirs()
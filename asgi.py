@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""ASGI entry point.
+
+The JSON API routes are served natively: their storage work runs on a
+bounded thread pool while the event loop keeps accepting requests, so slow
+polling clients don't each hold a worker thread. Every other path is handed
+to the regular Flask app through a small WSGI bridge that runs on the same
+pool. Run it with any ASGI server, e.g.
+
+    uvicorn asgi:application --workers 4
+"""
+import io
+import re
+import sys
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
+
+from app import (app as flask_app, doctor_slots_query, batch_slots_query, iter_batch_slots,
+                 batch_slots_document, next_available_query, autocomplete_query, slot_engine,
+                 slot_events, request_latency, slots_validators)
+from events import slot_topic, format_sse
+
+executor = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_EXECUTOR_WORKERS'],
+                              thread_name_prefix='medislot-asgi')
+
+_DONE = object()
+
+
+async def run_blocking(fn, *args):
+    """Run a blocking call on the bounded executor"""
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def _query_args(scope):
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    return MultiDict(parse_qsl(query_string, keep_blank_values=True))
+
+
+async def send_json(send, body, status=200, headers=()):
+    payload = json.dumps(body).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode('ascii')), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+def _next_rows(rows, count):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row) + '\n')
+        if len(chunk) >= count:
+            break
+    return ''.join(chunk).encode('utf-8')
+
+
+async def doctor_slots(scope, receive, send, doctor_id):
+    args = _query_args(scope)
+    body, status = await run_blocking(doctor_slots_query, doctor_id, args)
+    if status != 200:
+        await send_json(send, body, status)
+        return
+    # Same validators as the Flask route, so either can answer a revalidation
+    etag, last_modified = slots_validators(doctor_id, args, body)
+    headers = [(b'etag', f'"{etag}"'.encode('ascii')),
+               (b'last-modified', last_modified.encode('ascii')),
+               (b'cache-control', b'private, no-cache')]
+    if is_resource_modified(build_environ(scope, b''), etag, last_modified=last_modified):
+        await send_json(send, body, status, headers)
+    else:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def batch_slots(scope, receive, send):
+    query, status = await run_blocking(batch_slots_query, _query_args(scope))
+    if status != 200:
+        await send_json(send, query, status)
+        return
+    if not query['ndjson']:
+        await send_json(send, await run_blocking(batch_slots_document, query))
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/x-ndjson')],
+    })
+    # Pull the generator a chunk at a time so memory stays bounded
+    rows = iter_batch_slots(query)
+    chunk_rows = flask_app.config['ASGI_STREAM_CHUNK_ROWS']
+    while True:
+        chunk = await run_blocking(_next_rows, rows, chunk_rows)
+        if not chunk:
+            break
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def slot_stream(scope, receive, send, doctor_id):
+    """Live slot deltas; an open stream costs no thread while it waits"""
+    args = _query_args(scope)
+    subscription = slot_events.subscribe_async(slot_topic(doctor_id, args.get('date')))
+    try:
+        snapshot, status = await run_blocking(doctor_slots_query, doctor_id, args)
+        if status != 200:
+            await send_json(send, snapshot, status)
+            return
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        message = format_sse('snapshot', snapshot)
+        keepalive = flask_app.config['SLOT_STREAM_KEEPALIVE']
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            while not disconnected.done():
+                await send({'type': 'http.response.body', 'body': message.encode('utf-8'),
+                            'more_body': True})
+                event = await subscription.get(timeout=keepalive)
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    slots = await run_blocking(slot_engine.free_slots, doctor_id, args['date'])
+                    message = format_sse('snapshot', {'slots': slots})
+                elif event is None:
+                    message = ': keepalive\n\n'
+                else:
+                    message = format_sse('delta', event)
+        finally:
+            disconnected.cancel()
+    finally:
+        subscription.close()
+
+
+async def next_available(scope, receive, send):
+    body, status = await run_blocking(next_available_query, _query_args(scope))
+    await send_json(send, body, status)
+
+
+async def autocomplete(scope, receive, send):
+    body, status = await run_blocking(autocomplete_query, _query_args(scope))
+    await send_json(send, body, status)
+
+
+# (pattern, handler, Flask rule used as the metrics route label)
+ROUTES = [
+    (re.compile(r'^/api/doctor/(?P<doctor_id>[^/]+)/slots$'), doctor_slots,
+     '/api/doctor/<doctor_id>/slots'),
+    (re.compile(r'^/api/doctor/(?P<doctor_id>[^/]+)/slots/stream$'), slot_stream,
+     '/api/doctor/<doctor_id>/slots/stream'),
+    (re.compile(r'^/api/slots$'), batch_slots, '/api/slots'),
+    (re.compile(r'^/api/next-available$'), next_available, '/api/next-available'),
+    (re.compile(r'^/api/doctors/autocomplete$'), autocomplete, '/api/doctors/autocomplete'),
+]
+
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope into a WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # Slot streams are served natively here, so pages may use them
+        'medislot.asgi': True,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def call_wsgi(scope, receive, send):
+    """Serve a request with the Flask app on the executor"""
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                               for k, v in headers]
+        return lambda data: None
+
+    iterable = await run_blocking(flask_app, build_environ(scope, body), start_response)
+    try:
+        chunks = iter(iterable)
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': response['headers']})
+        while True:
+            chunk = await run_blocking(next, chunks, _DONE)
+            if chunk is _DONE:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            await run_blocking(iterable.close)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def timed_handler(handler, rule, scope, receive, send, **params):
+    """Run a native handler, recording its latency like the Flask hooks do"""
+    started = time.perf_counter()
+    status = []
+
+    async def send_and_record(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_record, **params)
+    finally:
+        request_latency.observe(time.perf_counter() - started, method=scope['method'],
+                                route=rule, status=status[0] if status else 500)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if scope['method'] in ('GET', 'HEAD'):
+        for pattern, handler, rule in ROUTES:
+            match = pattern.match(scope['path'])
+            if match:
+                await timed_handler(handler, rule, scope, receive, send, **match.groupdict())
+                return
+    await call_wsgi(scope, receive, send)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Time the utilization aggregates on synthetic appointments and report JSON.
+
+Builds the aggregates in memory for `--doctors` doctors working the
+default weekly hours and `--appointments` appointments spread over
+`--days` days, then times incremental writes and range queries. Run from
+the repository root:
+
+    python -m benchmarks.analytics_bench --doctors 1000 --appointments 1000000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics import Analytics
+from benchmarks.route_bench import percentile, peak_rss_mb
+from benchmarks.search_bench import SPECIALIZATIONS
+
+START = date(2025, 1, 1)
+STATUS_WEIGHTS = (('booked', 0.5), ('completed', 0.35), ('cancelled', 0.15))
+
+
+def dataset(doctors, appointments, days, seed):
+    rng = random.Random(seed)
+    doctor_records = [{'id': f'doctor-{i}', 'specialization': SPECIALIZATIONS[i % len(SPECIALIZATIONS)]}
+                      for i in range(doctors)]
+    schedules = [(doctor['id'], [16] * 5 + [0, 0],
+                  {(START + timedelta(days=rng.randrange(days))).toordinal(): -16})
+                 for doctor in doctor_records]
+    statuses, weights = zip(*STATUS_WEIGHTS)
+    appointment_records = [{
+        'id': f'appointment-{i}',
+        'doctor_id': f'doctor-{rng.randrange(doctors)}',
+        'date': (START + timedelta(days=rng.randrange(days))).isoformat(),
+        'status': rng.choices(statuses, weights)[0],
+    } for i in range(appointments)]
+    return doctor_records, schedules, appointment_records
+
+
+def time_build(data):
+    index = Analytics()
+    started = time.perf_counter()
+    index.refresh(lambda: data, max_age=0)
+    return index, round(time.perf_counter() - started, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=1000)
+    parser.add_argument('--appointments', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = dataset(args.doctors, args.appointments, args.days, args.seed)
+    report = {'doctors': args.doctors, 'appointments': args.appointments}
+    index, report['build_seconds'] = time_build(data)
+
+    rng = random.Random(args.seed + 1)
+    started = time.perf_counter()
+    for appointment in rng.sample(data[2], 1000):
+        index.record_appointment(dict(appointment, status='cancelled'))
+    report['incremental_write_ms'] = round((time.perf_counter() - started) * 1000 / 1000, 4)
+
+    end = START + timedelta(days=args.days - 1)
+    queries = {
+        'all_full_range': ('all', START, end, None),
+        'specializations_quarter': ('specialization', START + timedelta(days=40),
+                                    START + timedelta(days=130), None),
+        'one_doctor_full_range': ('doctor', START, end, 'doctor-0'),
+        'all_doctors_month': ('doctor', START + timedelta(days=31), START + timedelta(days=58), None),
+    }
+    report['queries'] = {}
+    for name, (group, first, last, key) in queries.items():
+        latencies = []
+        for _ in range(args.iterations):
+            t0 = time.perf_counter()
+            rows = index.utilization(group, first.isoformat(), last.isoformat(), key)
+            latencies.append(time.perf_counter() - t0)
+        latencies.sort()
+        report['queries'][name] = {
+            'rows': len(rows),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    report['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
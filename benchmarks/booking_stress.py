@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Fire N parallel bookings at one doctor slot and check exactly one wins.
+
+Run from the repository root:
+
+    python -m benchmarks.booking_stress --workers 32 --mode process --backend json
+
+`--wal` runs the JSON backend with its write-ahead log.
+"""
+import os
+import sys
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import create_repository
+
+DOCTOR_ID = 'stress-doctor'
+DATE = '2030-01-07'
+TIME = '09:00'
+
+
+def _attempt(args):
+    backend, data_dir, wal_path, start_at, store = args
+    if store is None:
+        # A process attempt gets its own repository, like a separate gunicorn worker
+        store = create_repository(backend, data_dir, wal_path=wal_path)
+    appointment = {
+        'id': str(uuid.uuid4()),
+        'patient_id': str(uuid.uuid4()),
+        'doctor_id': DOCTOR_ID,
+        'date': DATE,
+        'time': TIME,
+        'status': 'booked',
+        'notes': '',
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    while time.time() < start_at:
+        time.sleep(0.0005)
+    started = time.perf_counter()
+    booked = store.book_slot(appointment)
+    return booked, time.perf_counter() - started
+
+
+def run(workers, mode, backend, wal=False):
+    data_dir = tempfile.mkdtemp(prefix='medislot-stress-')
+    wal_path = os.path.join(data_dir, 'wal.log') if wal else None
+    try:
+        store = create_repository(backend, data_dir, wal_path=wal_path)
+        start_at = time.time() + 0.5
+        if mode == 'process':
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           mp_context=multiprocessing.get_context('spawn'))
+            start_at += 2
+            store = None
+        else:
+            # Threads share one repository, like the threads of one worker
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            results = list(executor.map(_attempt, [(backend, data_dir, wal_path, start_at, store)] * workers))
+        store = create_repository(backend, data_dir, wal_path=wal_path)
+        stored = store.filter('appointments', {
+            'doctor_id': DOCTOR_ID,
+            'date': DATE,
+            'time': TIME,
+            'status': 'booked'
+        })
+        latencies = sorted(latency for _, latency in results)
+        return {
+            'workers': workers,
+            'mode': mode,
+            'backend': backend,
+            'wal': wal,
+            'succeeded': sum(1 for booked, _ in results if booked),
+            'stored': len(stored),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--mode', choices=['thread', 'process'], default='process')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--wal', action='store_true')
+    args = parser.parse_args()
+
+    for _ in range(args.rounds):
+        result = run(args.workers, args.mode, args.backend, args.wal)
+        print(result)
+        assert result['succeeded'] == 1, 'expected exactly one successful booking'
+        assert result['stored'] == 1, 'expected exactly one stored booking'
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Measure cold starts of the serverless handler, with and without a snapshot.
+
+Each run is a fresh interpreter that imports functions/main/main.py and
+sends two requests through `handler`, the way a new function instance
+would. Reports the median import time and first/second request latency
+as JSON. Run from the repository root:
+
+    python -m benchmarks.cold_start --doctors 2000 --runs 7
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import datagen
+
+# Runs inside the child interpreter; timings go to stdout as JSON
+CHILD = '''
+import sys, json, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+from functions.main import main
+imported = time.perf_counter()
+timings = {{'import_ms': (imported - started) * 1000}}
+for name in ('first_request_ms', 'second_request_ms'):
+    t0 = time.perf_counter()
+    response = main.handler({{'httpMethod': 'GET', 'path': '/api/next-available',
+                              'queryStringParameters': {{'disease': {disease!r}}}}}, None)
+    timings[name] = (time.perf_counter() - t0) * 1000
+    assert response['statusCode'] == 200, response
+print(json.dumps(timings))
+'''
+
+
+def run_once(env, disease):
+    code = CHILD.format(root=ROOT, disease=disease)
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                            text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(env, runs, disease):
+    samples = [run_once(env, disease) for _ in range(runs)]
+    return {name: round(statistics.median(sample[name] for sample in samples), 2)
+            for name in samples[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', help='reuse (or generate into) this directory')
+    parser.add_argument('--doctors', type=int, default=1000)
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--appointments', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    # Appointments are partitioned and read per doctor-month, never snapshotted
+    parser.add_argument('--collections', default='doctors,schedules,availability')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='medislot-cold-')
+    snapshot_path = os.path.join(data_dir, 'snapshot.bin')
+    env = dict(os.environ, MEDISLOT_DATA_DIR=data_dir, MEDISLOT_STORAGE='json',
+               MEDISLOT_SECRET_KEY='cold-start-benchmark', MEDISLOT_SNAPSHOT_PATH=snapshot_path,
+               MEDISLOT_SNAPSHOT_COLLECTIONS=args.collections)
+    os.environ.update(MEDISLOT_DATA_DIR=data_dir)
+    try:
+        summary_path = os.path.join(data_dir, datagen.SUMMARY_FILE)
+        if os.path.exists(summary_path):
+            with open(summary_path) as f:
+                dataset = dict(json.load(f), reused=data_dir)
+        else:
+            dataset = datagen.generate(data_dir, args.doctors, args.patients, args.appointments,
+                                       seed=args.seed,
+                                       log=lambda message: print(message, file=sys.stderr))
+        from app import COMMON_DISEASES
+        disease = sorted(COMMON_DISEASES)[0]
+
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        print('measuring without snapshot', file=sys.stderr)
+        report = {'dataset': dataset, 'runs': args.runs, 'collections': args.collections,
+                  'without_snapshot': measure(env, args.runs, disease)}
+        subprocess.run([sys.executable, '-m', 'flask', 'build-snapshot'], cwd=ROOT,
+                       env=dict(env, FLASK_APP='app.py'), check=True, capture_output=True)
+        print('measuring with snapshot', file=sys.stderr)
+        report['with_snapshot'] = measure(env, args.runs, disease)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
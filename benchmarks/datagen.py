@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Generate a synthetic MediSlot dataset in the app's storage format.
+
+Everything is derived from `--seed`, so the same arguments always give the
+same records (ids included). Every user shares the password `benchmark`,
+hashed once, and doctors keep the default Mon-Fri 09:00-17:00 schedule.
+Run from the repository root:
+
+    python -m benchmarks.datagen --data-dir /tmp/medislot-10k \\
+        --doctors 10000 --patients 1000000 --appointments 10000000
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import random
+import argparse
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+
+from partitions import partition_of
+from repository import PARTITIONED
+from schedules import new_schedule
+
+PASSWORD = 'benchmark'
+LOCATIONS = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix', 'Philadelphia',
+             'San Antonio', 'San Diego', 'Dallas', 'San Jose', 'Austin', 'Seattle',
+             'Denver', 'Boston', 'Atlanta', 'Miami']
+FIRST_NAMES = ['Alex', 'Priya', 'Sam', 'Maria', 'Chen', 'Fatima', 'John', 'Aisha',
+               'Luca', 'Yuki', 'Omar', 'Elena', 'Ravi', 'Grace', 'Noah', 'Zara']
+LAST_NAMES = ['Smith', 'Patel', 'Garcia', 'Kim', 'Nguyen', 'Khan', 'Brown', 'Rossi',
+              'Silva', 'Cohen', 'Okafor', 'Ivanova', 'Sato', 'Jones', 'Müller', 'Singh']
+# Working slots per weekday under the default schedule, at 30 minutes
+SLOTS_PER_DAY = 16
+TARGET_OCCUPANCY = 0.5
+BATCH_SIZE = 5000
+SUMMARY_FILE = 'dataset.json'
+
+
+def specializations():
+    from app import COMMON_DISEASES
+    return sorted(set(COMMON_DISEASES.values()))
+
+
+def doctor_email(i):
+    return f'doctor{i}@example.com'
+
+
+def patient_email(i):
+    return f'patient{i}@example.com'
+
+
+class Writer:
+    """Batched writes to either backend, bypassing the app's per-write fsync"""
+
+    def __init__(self, backend, data_dir, sqlite_path=None):
+        self.backend = backend
+        self.data_dir = data_dir
+        self.store = None
+        self._pending = {}
+        self._directories = set()
+        if backend == 'sqlite':
+            from sqlite_store import SQLiteRepository
+            self.store = SQLiteRepository(sqlite_path or os.path.join(data_dir, 'medislot.sqlite3'))
+        elif backend != 'json':
+            raise ValueError(f'Unknown storage backend: {backend}')
+
+    def add(self, data_type, data_id, data):
+        if self.store is None:
+            directory = os.path.join(self.data_dir, data_type)
+            if data_type in PARTITIONED:
+                directory = os.path.join(directory, *partition_of(data))
+                if directory not in self._directories:
+                    os.makedirs(directory, exist_ok=True)
+                    self._directories.add(directory)
+            with open(os.path.join(directory, f'{data_id}.json'), 'w') as f:
+                json.dump(data, f, indent=4)
+            return
+        batch = self._pending.setdefault(data_type, [])
+        batch.append((data_id, data))
+        if len(batch) >= BATCH_SIZE:
+            self.flush(data_type)
+
+    def flush(self, data_type=None):
+        for name in [data_type] if data_type else list(self._pending):
+            batch = self._pending.pop(name, [])
+            if batch:
+                self.store.save_many(name, batch)
+
+
+def _weekdays(start, count):
+    """The first `count` weekdays on or after `start`"""
+    days = []
+    day = start
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+def generate(data_dir, doctors=1000, patients=10000, appointments=100000, backend='json',
+             sqlite_path=None, seed=0, today=None, log=None):
+    """Write the dataset and return (and store) a summary dict.
+
+    Each doctor gets about appointments/doctors appointments on distinct
+    slots of a weekday window centred on `today`, sized for ~50% occupancy:
+    past ones are completed or cancelled, future ones mostly booked.
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    started = time.perf_counter()
+
+    def new_id():
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    def progress(message):
+        if log:
+            log(f'{message} ({time.perf_counter() - started:.1f}s)')
+
+    for data_type in ('patients', 'doctors', 'appointments', 'availability', 'schedules'):
+        os.makedirs(os.path.join(data_dir, data_type), exist_ok=True)
+    writer = Writer(backend, data_dir, sqlite_path)
+    password = generate_password_hash(PASSWORD)
+    created_at = datetime.combine(today, datetime.min.time()).isoformat()
+    specialties = specializations()
+
+    doctor_ids = []
+    for i in range(doctors):
+        doctor_id = new_id()
+        name = f'Dr. {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        specialization = specialties[i % len(specialties)]
+        writer.add('doctors', doctor_id, {
+            'id': doctor_id,
+            'full_name': name,
+            'email': doctor_email(i),
+            'phone': f'555{i:07d}',
+            'password': password,
+            'specialization': specialization,
+            'location': rng.choice(LOCATIONS),
+            'consultation_fee': rng.choice([300, 500, 750, 1000]),
+            'bio': f'{specialization} specialist',
+            'created_at': created_at
+        })
+        schedule = new_schedule(doctor_id)
+        schedule['updated_at'] = created_at
+        for rule in schedule['weekly']:
+            rule['id'] = new_id()
+        writer.add('schedules', doctor_id, schedule)
+        doctor_ids.append(doctor_id)
+    writer.flush()
+    progress(f'{doctors} doctors')
+
+    patient_ids = []
+    for i in range(patients):
+        patient_id = new_id()
+        writer.add('patients', patient_id, {
+            'id': patient_id,
+            'full_name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'email': patient_email(i),
+            'phone': f'777{i:07d}',
+            'password': password,
+            'created_at': created_at
+        })
+        patient_ids.append(patient_id)
+        if (i + 1) % 100000 == 0:
+            progress(f'{i + 1} patients')
+    writer.flush()
+    progress(f'{patients} patients')
+
+    per_doctor = -(-appointments // doctors) if doctors else 0
+    window = max(1, -(-per_doctor // int(SLOTS_PER_DAY * TARGET_OCCUPANCY)))
+    days = _weekdays(today - timedelta(days=window * 7 // 10), window)
+    times = [f'{9 + s // 2:02d}:{30 * (s % 2):02d}' for s in range(SLOTS_PER_DAY)]
+    today_iso = today.isoformat()
+    written = 0
+    for doctor_id in doctor_ids:
+        count = min(per_doctor, appointments - written)
+        if count <= 0:
+            break
+        for slot in sorted(rng.sample(range(len(days) * SLOTS_PER_DAY), count)):
+            day = days[slot // SLOTS_PER_DAY]
+            if day < today_iso:
+                status = 'completed' if rng.random() < 0.85 else 'cancelled'
+            else:
+                status = 'booked' if rng.random() < 0.9 else 'cancelled'
+            appointment_id = new_id()
+            writer.add('appointments', appointment_id, {
+                'id': appointment_id,
+                'patient_id': patient_ids[rng.randrange(patients)] if patients else None,
+                'doctor_id': doctor_id,
+                'date': day,
+                'time': times[slot % SLOTS_PER_DAY],
+                'status': status,
+                'notes': '',
+                'created_at': created_at
+            })
+        written += count
+        if written % 1000000 < count:
+            progress(f'{written} appointments')
+    writer.flush()
+    progress(f'{written} appointments')
+
+    summary = {
+        'backend': backend,
+        'seed': seed,
+        'doctors': doctors,
+        'patients': patients,
+        'appointments': written,
+        'appointment_days': [days[0], days[-1]] if days else [],
+        'seconds': round(time.perf_counter() - started, 1),
+    }
+    # Lets a benchmark reusing the directory know what it holds
+    with open(os.path.join(data_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--sqlite-path')
+    parser.add_argument('--doctors', type=int, default=1000)
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--appointments', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # specializations() imports the app; keep it off the default data dir
+    os.environ.setdefault('MEDISLOT_DATA_DIR', args.data_dir)
+    summary = generate(args.data_dir, args.doctors, args.patients, args.appointments,
+                       backend=args.backend, sqlite_path=args.sqlite_path, seed=args.seed,
+                       log=lambda message: print(message, file=sys.stderr))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
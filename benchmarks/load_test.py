@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Load the slot API under WSGI and ASGI serving and compare rps and p99.
+
+Seeds a throwaway data directory, starts each server in a subprocess on
+it and hammers the API routes from keep-alive client threads. The ASGI
+target needs uvicorn; it is skipped when that isn't installed. Run from
+the repository root:
+
+    python -m benchmarks.load_test --doctors 500 --concurrency 64 --duration 10
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import logging
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import importlib.util
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from repository import create_repository
+from schedules import new_schedule
+
+SPECIALIZATIONS = ['Cardiology', 'Dermatology', 'Neurology', 'Orthopedics', 'Pediatrics']
+LOCATIONS = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix']
+
+
+def seed(data_dir, doctors):
+    store = create_repository('json', data_dir)
+    doctor_ids = []
+    for i in range(doctors):
+        doctor = {
+            'id': str(uuid.uuid4()),
+            'full_name': f'Dr. Load {i}',
+            'email': f'dr.load{i}@example.com',
+            'phone': f'555{i:07d}',
+            'password': '',
+            'specialization': SPECIALIZATIONS[i % len(SPECIALIZATIONS)],
+            'location': LOCATIONS[i % len(LOCATIONS)],
+            'consultation_fee': 500,
+            'bio': '',
+            'created_at': datetime.now().isoformat()
+        }
+        store.save('doctors', doctor['id'], doctor)
+        store.save('schedules', doctor['id'], new_schedule(doctor['id']))
+        doctor_ids.append(doctor['id'])
+    return doctor_ids
+
+
+def request_paths(doctor_ids):
+    """The mix of API requests each client cycles through"""
+    start = date.today() + timedelta(days=1)
+    paths = []
+    for i, doctor_id in enumerate(doctor_ids[:50]):
+        day = (start + timedelta(days=i % 7)).isoformat()
+        paths.append(f'/api/doctor/{doctor_id}/slots?date={day}')
+        paths.append(f'/api/next-available?specialization={SPECIALIZATIONS[i % len(SPECIALIZATIONS)]}')
+        batch = ','.join(doctor_ids[i:i + 5])
+        paths.append(f'/api/slots?doctor_ids={batch}&start={start.isoformat()}&days=7')
+    return paths
+
+
+def serve_wsgi(port):
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def start_server(target, port, env):
+    if target == 'wsgi':
+        command = [sys.executable, '-m', 'benchmarks.load_test', '--serve-wsgi', str(port)]
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:application',
+                   '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        wait_for_port(port)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def _client(port, paths, offset, deadline, latencies, errors):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    i = offset
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException):
+            errors.append(None)
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+
+
+def run_load(port, paths, concurrency, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    clients = [threading.Thread(target=_client,
+                                args=(port, paths, i * 7, deadline, latencies, errors))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--targets', default='wsgi,asgi')
+    parser.add_argument('--serve-wsgi', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_wsgi:
+        serve_wsgi(args.serve_wsgi)
+        return
+
+    data_dir = tempfile.mkdtemp(prefix='medislot-load-')
+    report = {'doctors': args.doctors, 'concurrency': args.concurrency,
+              'duration_s': args.duration, 'targets': {}}
+    try:
+        paths = request_paths(seed(data_dir, args.doctors))
+        env = dict(os.environ, MEDISLOT_DATA_DIR=data_dir, MEDISLOT_STORAGE='json',
+                   MEDISLOT_PASSWORD_HASH_WORKERS='0')
+        for target in args.targets.split(','):
+            if target == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+                report['targets'][target] = {'skipped': 'uvicorn is not installed'}
+                continue
+            port = free_port()
+            process = start_server(target, port, env)
+            try:
+                run_load(port, paths, args.concurrency, args.warmup)
+                report['targets'][target] = run_load(port, paths, args.concurrency, args.duration)
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Drive the hot routes through Flask's test client and report JSON.
+
+Generates a dataset with benchmarks.datagen (or reuses `--data-dir` when it
+already holds one made by it), then times each scenario in-process and prints
+throughput, latency percentiles and peak RSS. Save the output per commit
+and compare. Run from the repository root:
+
+    python -m benchmarks.route_bench --doctors 2000 --patients 20000 \\
+        --appointments 200000 --iterations 200 > bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import datagen
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def login(client, kind, email):
+    response = client.post(f'/{kind}/login', data={'email': email, 'password': datagen.PASSWORD})
+    if response.status_code != 302 or f'/{kind}/dashboard' not in response.headers['Location']:
+        raise RuntimeError(f'{kind} login failed for {email}')
+
+
+def scenarios(app_module, args):
+    """(name, client kind, request function) for every measured route"""
+    rng = random.Random(args.seed)
+    doctors = app_module.load_all('doctors')
+    doctor_ids = [d['id'] for d in doctors]
+    diseases = list(app_module.COMMON_DISEASES)
+    specialties, locations = app_module.doctor_facets()
+    day = date.today() + timedelta(days=1)
+    while day.weekday() > 4:
+        day += timedelta(days=1)
+    weekly_forms = [
+        {'day': ['0', '1', '2', '3', '4'], 'start_time': ['09:00'] * 5, 'end_time': ['17:00'] * 5},
+        {'day': ['0', '1', '2', '3'], 'start_time': ['08:00'] * 4, 'end_time': ['16:00'] * 4},
+    ]
+
+    def patient_login(client, i):
+        return client.post('/patient/login', data={
+            'email': datagen.patient_email(rng.randrange(args.patients)),
+            'password': datagen.PASSWORD})
+
+    return [
+        ('patient_login', 'anonymous', patient_login),
+        ('search', 'patient', lambda client, i: client.post('/patient/search', data={
+            'specialization': rng.choice(specialties), 'location': rng.choice(locations)})),
+        ('find_doctors_by_disease', 'patient',
+         lambda client, i: client.get(f'/find-doctors/{rng.choice(diseases)}')),
+        ('booking_page', 'patient',
+         lambda client, i: client.get(f'/patient/book/{rng.choice(doctor_ids)}')),
+        ('slots_api', 'anonymous',
+         lambda client, i: client.get(f'/api/doctor/{rng.choice(doctor_ids)}/slots'
+                                      f'?date={day.isoformat()}')),
+        ('slots_batch_api', 'anonymous',
+         lambda client, i: client.get(f'/api/slots?specialization={rng.choice(specialties)}'
+                                      f'&start={day.isoformat()}&days=7')),
+        ('next_available_api', 'anonymous',
+         lambda client, i: client.get(f'/api/next-available?disease={rng.choice(diseases)}')),
+        ('patient_dashboard', 'patient', lambda client, i: client.get('/patient/dashboard')),
+        ('doctor_dashboard', 'doctor', lambda client, i: client.get('/doctor/dashboard')),
+        ('availability_save', 'doctor',
+         lambda client, i: client.post('/doctor/availability', data=weekly_forms[i % 2])),
+    ]
+
+
+def run_scenario(request, client, iterations, warmup):
+    for i in range(warmup):
+        request(client, i)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        response = request(client, i)
+        latencies.append(time.perf_counter() - t0)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'errors': errors,
+        'rps': round(iterations / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', help='reuse (or generate into) this directory')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--doctors', type=int, default=500)
+    parser.add_argument('--patients', type=int, default=5000)
+    parser.add_argument('--appointments', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--only', help='comma-separated scenario names')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='medislot-bench-')
+    sqlite_path = os.path.join(data_dir, 'medislot.sqlite3')
+    report = {'commit': git_commit(), 'python': platform.python_version(),
+              'backend': args.backend}
+    # The app reads its storage settings at import time, and the generator
+    # imports it for COMMON_DISEASES, so point it at the dataset first
+    os.environ.update(MEDISLOT_DATA_DIR=data_dir, MEDISLOT_STORAGE=args.backend,
+                      MEDISLOT_SQLITE_PATH=sqlite_path, MEDISLOT_PASSWORD_HASH_WORKERS='0')
+    try:
+        summary_path = os.path.join(data_dir, datagen.SUMMARY_FILE)
+        if os.path.exists(summary_path):
+            with open(summary_path) as f:
+                report['dataset'] = dict(json.load(f), reused=data_dir)
+            args.patients = report['dataset']['patients']
+        else:
+            report['dataset'] = datagen.generate(
+                data_dir, args.doctors, args.patients, args.appointments, backend=args.backend,
+                sqlite_path=sqlite_path, seed=args.seed,
+                log=lambda message: print(message, file=sys.stderr))
+        import app as app_module
+
+        clients = {'anonymous': app_module.app.test_client(),
+                   'patient': app_module.app.test_client(),
+                   'doctor': app_module.app.test_client()}
+        login(clients['patient'], 'patient', datagen.patient_email(0))
+        login(clients['doctor'], 'doctor', datagen.doctor_email(0))
+
+        started = time.perf_counter()
+        selected = set(args.only.split(',')) if args.only else None
+        report['scenarios'] = {}
+        for name, kind, request in scenarios(app_module, args):
+            if selected and name not in selected:
+                continue
+            print(f'running {name}', file=sys.stderr)
+            report['scenarios'][name] = run_scenario(request, clients[kind],
+                                                     args.iterations, args.warmup)
+        report['seconds'] = round(time.perf_counter() - started, 1)
+        report['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Time the doctor search index on synthetic profiles and report JSON.
+
+Builds the index in memory from `--doctors` generated profiles (the same
+names and cities as benchmarks.datagen), then times autocomplete-style
+queries: prefixes, typos, multi-word and accented input. Run from the
+repository root:
+
+    python -m benchmarks.search_bench --doctors 100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import datagen
+from benchmarks.route_bench import percentile, peak_rss_mb
+from search import DoctorSearchIndex
+
+SPECIALIZATIONS = ['Allergy and Immunology', 'Cardiology', 'Dermatology', 'Endocrinology',
+                   'Neurology', 'Orthopedics', 'Pediatrics', 'Psychiatry', 'Pulmonology',
+                   'Rheumatology']
+QUERIES = ['ca', 'card', 'cardiolgy', 'neuro san', 'priya pat', 'seatle', 'muller',
+           'mül', 'dermatology boston', 'dr sam k', 'specialist', 'zz']
+
+
+def doctors(count, seed):
+    rng = random.Random(seed)
+    for i in range(count):
+        specialization = SPECIALIZATIONS[i % len(SPECIALIZATIONS)]
+        yield {
+            'id': f'doctor-{i}',
+            'full_name': f'Dr. {rng.choice(datagen.FIRST_NAMES)} {rng.choice(datagen.LAST_NAMES)}',
+            'specialization': specialization,
+            'location': rng.choice(datagen.LOCATIONS),
+            'bio': f'{specialization} specialist',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    index = DoctorSearchIndex()
+    started = time.perf_counter()
+    index.refresh(lambda: doctors(args.doctors, args.seed), max_age=0)
+    report = {'doctors': len(index), 'build_seconds': round(time.perf_counter() - started, 2)}
+
+    started = time.perf_counter()
+    for doctor in doctors(100, args.seed + 1):
+        index.add(dict(doctor, id=f'new-{doctor["id"]}'))
+    report['incremental_add_ms'] = round((time.perf_counter() - started) * 1000 / 100, 3)
+
+    report['queries'] = {}
+    for query in QUERIES:
+        latencies = []
+        for _ in range(args.iterations):
+            t0 = time.perf_counter()
+            results = index.search(query, args.limit)
+            index.complete(query)
+            latencies.append(time.perf_counter() - t0)
+        latencies.sort()
+        report['queries'][query] = {
+            'results': len(results),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    report['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
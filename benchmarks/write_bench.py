@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Time concurrent saves to the JSON backend with and without its write-ahead log.
+
+Each of `--threads` threads saves `--writes` appointments to a fresh data
+directory, once with the files fsynced one by one and once through the
+WAL, and the writes per second and log syncs are reported as JSON. Run
+from the repository root:
+
+    python -m benchmarks.write_bench --threads 8 --writes 200
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wal
+from repository import Repository
+from benchmarks.route_bench import percentile
+
+
+def appointment(thread, i):
+    return {
+        'id': f'bench-{thread}-{i}',
+        'doctor_id': f'doctor-{thread % 4}',
+        'patient_id': f'patient-{i}',
+        'date': f'2030-01-{1 + i % 28:02d}',
+        'time': f'{8 + i % 10:02d}:00',
+        'status': 'booked',
+        'notes': '',
+        'created_at': '2030-01-01T00:00:00'
+    }
+
+
+def run(threads, writes, use_wal):
+    data_dir = tempfile.mkdtemp(prefix='medislot-writes-')
+    syncs = [0]
+    fdatasync = wal._fdatasync
+
+    def counting_sync(fd):
+        syncs[0] += 1
+        return fdatasync(fd)
+
+    wal._fdatasync = counting_sync
+    try:
+        repository = Repository(data_dir, wal_path=os.path.join(data_dir, 'wal.log') if use_wal else None)
+        latencies = []
+
+        def work(thread):
+            for i in range(writes):
+                started = time.perf_counter()
+                repository.save('appointments', f'bench-{thread}-{i}', appointment(thread, i))
+                latencies.append(time.perf_counter() - started)
+
+        workers = [threading.Thread(target=work, args=(thread,)) for thread in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'writes_per_second': round(threads * writes / elapsed),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'log_syncs': syncs[0] if use_wal else None,
+        }
+    finally:
+        wal._fdatasync = fdatasync
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=200)
+    args = parser.parse_args()
+
+    report = {'threads': args.threads, 'writes': args.threads * args.writes,
+              'fsync_per_file': run(args.threads, args.writes, False),
+              'wal': run(args.threads, args.writes, True)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
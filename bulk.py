@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""Bulk import and export of doctors, patients, availability and appointments.
+
+Rows stream in from CSV or JSONL and are handled a batch at a time: each
+batch is validated, checked for duplicate emails (within the input and
+against the storage email index) or double-booked slots, has its
+passwords hashed across the hashing pool's processes in one go, and is
+written with `save_many` -- one transaction on SQLite, one batched sync on
+the JSON backend. Booked appointments are the exception: each claims its
+slot through `book_slot`, as an online booking does, so an import cannot
+double-book a slot taken while it runs. Rejected rows are reported with
+their line number and skipped; the rest of the file still goes in.
+
+Users need a password to be imported. Exports leave the stored hashes out
+unless asked for them, so a users file meant for re-import must be
+exported with them (`include_passwords`) or given a `password` column.
+"""
+import os
+import re
+import csv
+import json
+import uuid
+import sqlite3
+from datetime import datetime
+
+from schedules import (new_schedule, load_schedule, diff_schedule, updated_schedule,
+                       weekly_rule, override_rule, rule_error, date_error, time_error)
+
+KINDS = ('doctors', 'patients', 'availability', 'appointments')
+FORMATS = ('csv', 'jsonl')
+STATUSES = ('booked', 'completed', 'cancelled')
+DAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+DEFAULT_CONSULTATION_FEE = 500
+# Fields that identify an appointment when re-importing a file without ids
+IDENTITY = ('patient_id', 'time', 'status')
+
+# Fields a row must carry, besides a `password` or `password_hash` for users
+REQUIRED = {
+    'doctors': ['full_name', 'email', 'phone', 'specialization', 'location'],
+    'patients': ['full_name', 'email', 'phone'],
+}
+
+# Columns written by export, in order; JSONL rows carry the same keys
+COLUMNS = {
+    'doctors': ['id', 'full_name', 'email', 'phone', 'specialization', 'location',
+                'consultation_fee', 'bio', 'created_at'],
+    'patients': ['id', 'full_name', 'email', 'phone', 'created_at'],
+    'availability': ['doctor_id', 'doctor_email', 'day_of_week', 'date', 'start_time',
+                     'end_time', 'is_available'],
+    'appointments': ['id', 'doctor_id', 'doctor_email', 'patient_id', 'patient_email', 'date',
+                     'time', 'status', 'notes', 'created_at'],
+}
+
+EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+$')
+RECORD_ID = re.compile(r'[\w-]+$')
+TRUE = ('1', 'true', 'yes', 'y')
+FALSE = ('0', 'false', 'no', 'n')
+
+
+class RowError(ValueError):
+    """A row that cannot be imported"""
+
+
+def detect_format(path):
+    """'csv' or 'jsonl' from a file name; stdin ('-') defaults to JSONL"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson', '.json') or path == '-':
+        return 'jsonl'
+    raise ValueError(f'Cannot tell the format of {path}; pass --format')
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row) from a CSV or JSONL stream; unparsable rows are None"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key.strip(): value for key, value in row.items() if key}
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def write_rows(stream, fmt, columns, rows):
+    """Write dict rows as CSV (with a header) or JSONL; returns the row count"""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+    for row in rows:
+        stream.write(json.dumps({column: row.get(column) for column in columns}) + '\n')
+        count += 1
+    return count
+
+
+def _text(row, field, required=True):
+    value = row.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f'missing {field}')
+    return value
+
+
+def _flag(row, field, default):
+    value = _text(row, field, required=False).lower()
+    if not value:
+        return default
+    if value in TRUE:
+        return True
+    if value in FALSE:
+        return False
+    raise RowError(f'{field} must be true or false, not {value!r}')
+
+
+def _date(value, field='date'):
+    # Stricter than date.fromisoformat, which also takes 20240101 and 2024-W01-1
+    if date_error(value):
+        raise RowError(f'{field} must be YYYY-MM-DD, not {value!r}')
+    return value
+
+
+def _time(value, field):
+    if time_error(value):
+        raise RowError(f'{field} must be HH:MM, not {value!r}')
+    return value
+
+
+def _day_of_week(value):
+    if value.isdigit() and int(value) < 7:
+        return int(value)
+    if value.lower() in DAY_NAMES:
+        return DAY_NAMES.index(value.lower())
+    raise RowError(f'day_of_week must be 0-6 or a day name, not {value!r}')
+
+
+class BulkImporter:
+    """Import rows of one kind into a repository, a batch at a time.
+
+    `report(line, message)` is called for every rejected row. With
+    `dry_run` rows are validated and deduplicated but nothing is hashed or
+    written. `counts` holds the rows imported and rejected and the
+    records written.
+    """
+
+    def __init__(self, repository, hasher, batch_size=1000, dry_run=False, report=None):
+        self.repository = repository
+        self.hasher = hasher
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.report = report or (lambda line, message: None)
+        self.counts = {'imported': 0, 'rejected': 0, 'written': 0}
+        self._emails = {'doctors': set(), 'patients': set()}
+        self._stored_emails = {}
+        self._ids = {}
+        self._seen = set()
+        self._slots = set()
+        self._schedules = {}
+
+    def run(self, kind, rows):
+        """Import an iterable of (line, row); returns `counts`"""
+        prepare = {'doctors': self._user, 'patients': self._user,
+                   'availability': self._rule, 'appointments': self._appointment}[kind]
+        batch = []
+        for line, row in rows:
+            try:
+                if row is None:
+                    raise RowError('not a JSON object')
+                batch.append(prepare(row, kind))
+            except RowError as e:
+                self.counts['rejected'] += 1
+                self.report(line, str(e))
+                continue
+            self.counts['imported'] += 1
+            if len(batch) >= self.batch_size:
+                self._write(kind, batch)
+                batch = []
+        self._write(kind, batch)
+        if kind == 'availability':
+            self._write_schedules()
+        return self.counts
+
+    def _save(self, data_type, items):
+        if self.dry_run or not items:
+            return
+        try:
+            self.repository.save_many(data_type, items)
+            self.counts['written'] += len(items)
+        except sqlite3.IntegrityError:
+            # Only SQLite enforces constraints; find the offending rows
+            for data_id, data in items:
+                try:
+                    self.repository.save(data_type, data_id, data)
+                    self.counts['written'] += 1
+                except sqlite3.IntegrityError:
+                    self.counts['imported'] -= 1
+                    self.counts['rejected'] += 1
+                    self.report(None, f'{data_type} {data_id} conflicts with a stored record')
+
+    def _new_id(self, row, data_type, exists):
+        """The row's own id if it is free, else a fresh one; `exists(id)` checks storage"""
+        data_id = _text(row, 'id', required=False)
+        if not data_id:
+            return str(uuid.uuid4())
+        if not RECORD_ID.match(data_id):
+            raise RowError(f'invalid id {data_id!r}')
+        if (data_type, data_id) in self._seen or exists(data_id):
+            raise RowError(f'{data_type} id {data_id} already exists')
+        self._seen.add((data_type, data_id))
+        return data_id
+
+    def _user(self, row, kind):
+        """A doctor or patient record, with its plain password to hash if it has one"""
+        values = {field: _text(row, field) for field in REQUIRED[kind]}
+        email = values['email']
+        if not EMAIL.match(email):
+            raise RowError(f'invalid email {email!r}')
+        password = _text(row, 'password', required=False)
+        password_hash = _text(row, 'password_hash', required=False)
+        if not password and '$' not in password_hash:
+            raise RowError('missing password or password_hash (export with --include-passwords)')
+        record = {'id': None, **values}
+        if kind == 'doctors':
+            fee = _text(row, 'consultation_fee', required=False)
+            try:
+                record['consultation_fee'] = int(fee) if fee else DEFAULT_CONSULTATION_FEE
+            except ValueError:
+                raise RowError(f'consultation_fee must be a whole number, not {fee!r}')
+            record['bio'] = _text(row, 'bio', required=False)
+        record['password'] = password_hash or None
+        record['created_at'] = _text(row, 'created_at', required=False) or datetime.now().isoformat()
+        # Duplicates are checked last so a rejected row doesn't claim its email
+        if email.lower() in self._emails[kind]:
+            raise RowError(f'duplicate email {email} in the input')
+        if email.lower() in self._registered(kind):
+            raise RowError(f'email {email} is already registered')
+        record['id'] = self._new_id(
+            row, kind, lambda data_id: self.repository.load(kind, data_id) is not None)
+        self._emails[kind].add(email.lower())
+        return record, None if password_hash else password
+
+    def _registered(self, kind):
+        """Lowercased emails already stored, read once per import"""
+        if kind not in self._stored_emails:
+            self._stored_emails[kind] = {user['email'].lower()
+                                         for user in self.repository.load_all(kind)
+                                         if user.get('email')}
+        return self._stored_emails[kind]
+
+    def _write_users(self, kind, batch):
+        plain = [(record, password) for record, password in batch if password]
+        if plain:
+            hashes = self.hasher.hash_many([password for _, password in plain])
+            for (record, _), password_hash in zip(plain, hashes):
+                record['password'] = password_hash
+        self._save(kind, [(record['id'], record) for record, _ in batch])
+        if kind == 'doctors':
+            # New doctors get the default hours, as on registration
+            self._save('schedules', [(record['id'], new_schedule(record['id']))
+                                     for record, _ in batch])
+
+    def _write(self, kind, batch):
+        if not batch or self.dry_run:
+            return
+        if kind in ('doctors', 'patients'):
+            self._write_users(kind, batch)
+        elif kind == 'appointments':
+            self._save(kind, [(record['id'], record) for record in batch
+                              if record['status'] != 'booked'])
+            for record in batch:
+                if record['status'] == 'booked':
+                    self._book(record)
+
+    def _book(self, appointment):
+        """Store a booked appointment through the slot claim; a taken slot rejects it"""
+        if self.repository.book_slot(appointment):
+            self.counts['written'] += 1
+            return
+        self.counts['imported'] -= 1
+        self.counts['rejected'] += 1
+        self.report(None, f"appointment {appointment['id']}: {appointment['date']} "
+                          f"{appointment['time']} is already booked for this doctor")
+
+    def _resolve(self, row, data_type):
+        """Id of the doctor/patient a row names by `<prefix>_id` or `<prefix>_email`"""
+        prefix = data_type[:-1]
+        data_id = _text(row, f'{prefix}_id', required=False)
+        email = _text(row, f'{prefix}_email', required=False)
+        key = (data_type, data_id or email.lower())
+        if key in self._ids:
+            return self._ids[key]
+        if data_id:
+            found = self.repository.load(data_type, data_id)
+        elif email:
+            found = self.repository.find(data_type, 'email', email)
+        else:
+            raise RowError(f'missing {prefix}_id or {prefix}_email')
+        if found is None:
+            raise RowError(f'unknown {prefix} {data_id or email}')
+        self._ids[key] = found['id']
+        return found['id']
+
+    def _appointment(self, row, kind):
+        appointment = {
+            'id': None,
+            'patient_id': self._resolve(row, 'patients'),
+            'doctor_id': self._resolve(row, 'doctors'),
+            'date': _date(_text(row, 'date')),
+            'time': _time(_text(row, 'time'), 'time'),
+            'status': _text(row, 'status', required=False).lower() or 'booked',
+            'notes': _text(row, 'notes', required=False),
+            'created_at': _text(row, 'created_at', required=False) or datetime.now().isoformat()
+        }
+        if appointment['status'] not in STATUSES:
+            raise RowError(f"status must be one of {', '.join(STATUSES)}")
+        if appointment['status'] == 'booked':
+            slot = (appointment['doctor_id'], appointment['date'], appointment['time'])
+            if slot in self._slots or self.repository.filter('appointments', {
+                'doctor_id': slot[0],
+                'date': slot[1],
+                'time': slot[2],
+                'status': 'booked'
+            }):
+                raise RowError(f'{slot[1]} {slot[2]} is already booked for this doctor')
+        # A re-imported appointment lands on its own doctor-day, so only
+        # that partition is checked for its id, or for a stored copy when
+        # the input has no ids
+        same_day = self.repository.filter('appointments', {'doctor_id': appointment['doctor_id'],
+                                                           'date': appointment['date']})
+        if any(all(stored.get(field) == appointment[field] for field in IDENTITY)
+               for stored in same_day):
+            raise RowError('this appointment is already stored')
+        appointment['id'] = self._new_id(row, 'appointments', lambda data_id: any(
+            stored['id'] == data_id for stored in same_day))
+        if appointment['status'] == 'booked':
+            self._slots.add(slot)
+        return appointment
+
+    def _rule(self, row, kind):
+        """Collect a weekly (day_of_week) or date override row into its doctor's schedule"""
+        doctor_id = self._resolve(row, 'doctors')
+        start_time = _text(row, 'start_time', required=False)
+        end_time = _text(row, 'end_time', required=False)
+        if _text(row, 'date', required=False):
+            is_available = _flag(row, 'is_available', False)
+            if is_available and not (start_time and end_time):
+                raise RowError('an open date override needs start_time and end_time')
+            kind, rule = 'overrides', override_rule(_text(row, 'date'), start_time, end_time,
+                                                    is_available)
+        else:
+            kind, rule = 'weekly', weekly_rule(_day_of_week(_text(row, 'day_of_week')), start_time,
+                                               end_time, _flag(row, 'is_available', True))
+        # The same checks as the availability page
+        error = rule_error(rule)
+        if error:
+            raise RowError(error)
+        self._schedules.setdefault(doctor_id, {}).setdefault(kind, []).append(rule)
+        return doctor_id
+
+    def _write_schedules(self):
+        """Replace the imported doctors' weekly hours and/or overrides, a batch at a time"""
+        if self.dry_run:
+            return
+        batch = []
+        legacy = []
+        for doctor_id, rules in self._schedules.items():
+            old = load_schedule(self.repository, doctor_id)
+            diff = diff_schedule(old, rules.get('weekly', old['weekly']),
+                                 rules.get('overrides', old.get('overrides', [])))
+            if diff['changed'] or not old['version']:
+                batch.append((doctor_id, updated_schedule(old, diff)))
+                if not old['version']:
+                    legacy.append(doctor_id)
+            if len(batch) >= self.batch_size:
+                self._save('schedules', batch)
+                batch = []
+        self._save('schedules', batch)
+        # The first schedule document replaces the legacy availability rows
+        for doctor_id in legacy:
+            for avail in self.repository.filter('availability', {'doctor_id': doctor_id}):
+                self.repository.delete('availability', avail['id'])
+
+
+def export_rows(repository, kind, include_passwords=False):
+    """Yield the export rows of one kind, in a stable order"""
+    if kind in ('doctors', 'patients'):
+        for user in sorted(repository.load_all(kind), key=lambda user: user['id']):
+            row = dict(user)
+            password = row.pop('password', None)
+            if include_passwords:
+                row['password_hash'] = password
+            yield row
+        return
+    doctor_emails = {doctor['id']: doctor.get('email') for doctor in repository.load_all('doctors')}
+    if kind == 'availability':
+        for doctor_id in sorted(doctor_emails):
+            schedule = load_schedule(repository, doctor_id)
+            for rule in schedule['weekly']:
+                yield dict(rule, doctor_id=doctor_id, doctor_email=doctor_emails[doctor_id])
+            for rule in schedule.get('overrides', []):
+                yield dict(rule, doctor_id=doctor_id, doctor_email=doctor_emails[doctor_id])
+        return
+    patient_emails = {patient['id']: patient.get('email')
+                      for patient in repository.load_all('patients')}
+    appointments = repository.load_all('appointments')
+    appointments.sort(key=lambda a: (a.get('date') or '', a.get('time') or '', a['id']))
+    for appointment in appointments:
+        yield dict(appointment, doctor_email=doctor_emails.get(appointment.get('doctor_id')),
+                   patient_email=patient_emails.get(appointment.get('patient_id')))
+
+
+def export_columns(kind, include_passwords=False):
+    columns = list(COLUMNS[kind])
+    if include_passwords and kind in ('doctors', 'patients'):
+        columns.append('password_hash')
+    return columns
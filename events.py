@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Slot change notifications.
+
+Booking pages subscribe to one doctor-day topic and get a small delta
+whenever an appointment on that day is booked or released. `EventBus`
+fans events out to the subscribers of this process; its broker decides
+which processes see a publish: `LocalBroker` only this one,
+`UnixSocketBroker` every worker on the host sharing the socket directory.
+"""
+import os
+import json
+import queue
+import atexit
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def slot_topic(doctor_id, date):
+    return f'{doctor_id}|{date}'
+
+
+def format_sse(event, data):
+    """Encode one server-sent event"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    """Events for one topic, read with `get` from a worker thread.
+
+    Events past `maxsize` unread ones are dropped and `overflowed` is set,
+    so the reader knows to resend a full snapshot instead of deltas.
+    """
+
+    def __init__(self, bus, topic, maxsize):
+        self.bus = bus
+        self.topic = topic
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize)
+
+    def deliver(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """Next event, or None if none arrives within `timeout` seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read from an event loop; `deliver` may be called from any thread.
+
+    asyncio is imported by the methods, not the module: only the ASGI
+    entry point needs it and the WSGI/serverless paths skip its import cost.
+    """
+
+    def __init__(self, bus, topic, maxsize, loop):
+        import asyncio
+        super().__init__(bus, topic, maxsize)
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+
+    def deliver(self, event):
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # Loop already closed; the subscriber is gone
+            pass
+
+    def _put(self, event):
+        import asyncio
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout=None):
+        import asyncio
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """Deliver events to subscribers in this process only"""
+
+    def __init__(self):
+        self._dispatch = None
+
+    def attach(self, dispatch):
+        self._dispatch = dispatch
+
+    def start(self):
+        pass
+
+    def publish(self, topic, event):
+        self._dispatch(topic, event)
+
+
+class UnixSocketBroker:
+    """Fan events out to every worker on the host through datagram sockets.
+
+    Each process binds `<socket_dir>/<pid>-<id>.sock` on first use and
+    publishes by sending to every socket in the directory, its own included.
+    Sockets left behind by dead workers are removed when a send to them is
+    refused.
+    """
+
+    def __init__(self, socket_dir):
+        self.socket_dir = socket_dir
+        self._dispatch = None
+        self._pid = None
+        self._path = None
+        self._sender = None
+        self._lock = threading.Lock()
+
+    def attach(self, dispatch):
+        self._dispatch = dispatch
+
+    def start(self):
+        # Checked per pid: a forked worker needs its own socket and thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.socket_dir, exist_ok=True)
+            path = os.path.join(self.socket_dir, f'{os.getpid()}-{id(self):x}.sock')
+            if os.path.exists(path):
+                os.unlink(path)
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(path)
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+            self._path = path
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, args=(receiver,),
+                             name='medislot-events', daemon=True).start()
+            atexit.register(self._cleanup, path)
+
+    def _listen(self, receiver):
+        while True:
+            try:
+                message = json.loads(receiver.recv(65536))
+                self._dispatch(message['topic'], message['event'])
+            except (ValueError, KeyError):
+                logger.warning('Dropped a malformed slot event')
+            except OSError:
+                return
+
+    @staticmethod
+    def _cleanup(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def publish(self, topic, event):
+        self.start()
+        payload = json.dumps({'topic': topic, 'event': event}).encode('utf-8')
+        for name in os.listdir(self.socket_dir):
+            if not name.endswith('.sock'):
+                continue
+            path = os.path.join(self.socket_dir, name)
+            try:
+                self._sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._cleanup(path)
+            except BlockingIOError:
+                logger.warning('Slot event dropped: %s is not reading', name)
+
+
+def create_broker(kind='local', socket_dir=None):
+    if kind == 'local':
+        return LocalBroker()
+    if kind == 'unix':
+        return UnixSocketBroker(socket_dir)
+    raise ValueError(f'Unknown event broker: {kind}')
+
+
+class EventBus:
+    """In-process publish/subscribe keyed by topic"""
+
+    def __init__(self, broker=None, queue_size=256):
+        self.queue_size = queue_size
+        self.broker = broker or LocalBroker()
+        self.broker.attach(self.dispatch)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def _add(self, subscription):
+        self.broker.start()
+        with self._lock:
+            self._subscribers.setdefault(subscription.topic, set()).add(subscription)
+        return subscription
+
+    def subscribe(self, topic):
+        return self._add(Subscription(self, topic, self.queue_size))
+
+    def subscribe_async(self, topic):
+        """Subscribe from a coroutine running on the current event loop"""
+        import asyncio
+        return self._add(AsyncSubscription(self, topic, self.queue_size,
+                                           asyncio.get_running_loop()))
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.topic]
+
+    def publish(self, topic, event):
+        self.broker.publish(topic, event)
+
+    def dispatch(self, topic, event):
+        """Hand an event from the broker to this process's subscribers"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
@@ -1,19 +1,77 @@
-from flask import Flask
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
-from werkzeug.wrappers import Response
-import sys
+"""Serverless entry point.
+
+`handler` takes an API-gateway style event (as Netlify and AWS Lambda
+send), runs it through the Flask app and returns the matching response
+dict. Cold starts stay cheap because the app defers its expensive setup
+(hashing pool, storage connections, collection scans) to first use; set
+MEDISLOT_SECRET_KEY so every instance accepts the same sessions, and run
+`flask build-snapshot` at build time so the JSON backend can map its
+doctor indexes instead of scanning data/.
+
+An instance is frozen between invocations, so nothing may run outside a
+request: passwords are hashed inline rather than in a process pool, the
+write-ahead log stays off, and live slot streams, whose body never ends,
+are refused so pages poll instead.
+"""
 import os
+import sys
+import base64
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# Read by app at import time
+os.environ['MEDISLOT_PASSWORD_HASH_WORKERS'] = '0'
+os.environ['MEDISLOT_WAL_PATH'] = ''
+os.environ['MEDISLOT_SLOT_STREAMING'] = '0'
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+
+from app import app
+
+TEXT_TYPES = ('text/', 'application/json', 'application/javascript',
+              'application/x-ndjson', 'image/svg+xml')
+
+
+def _multi(event, name):
+    values = event.get(f'multiValue{name}')
+    if values:
+        return values
+    return {key: [value] for key, value in (event.get(name[0].lower() + name[1:]) or {}).items()}
+
 
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+def build_environ(event):
+    """Translate a gateway event into a WSGI environ"""
+    headers = _multi(event, 'Headers')
+    query = _multi(event, 'QueryStringParameters')
+    body = event.get('body') or ''
+    body = base64.b64decode(body) if event.get('isBase64Encoded') else body.encode('utf-8')
+    return EnvironBuilder(
+        path=event.get('path') or '/',
+        method=event.get('httpMethod') or 'GET',
+        headers=[(name, value) for name, values in headers.items() for value in values],
+        query_string=urlencode([(name, value) for name, values in query.items() for value in values]),
+        data=body,
+    ).get_environ()
 
-from app import app as flask_app
 
 def handler(event, context):
-    with flask_app.app_context():
-        return Response(
-            flask_app.full_dispatch_request(),
-            status=flask_app.response.status_code,
-            headers=dict(flask_app.response.headers)
-        )
-
-app = DispatcherMiddleware(flask_app)
\ No newline at end of file
+    if (event.get('path') or '/').rstrip('/').endswith('/slots/stream'):
+        # Buffering a stream that never ends would hang the invocation
+        return {
+            'statusCode': 501,
+            'multiValueHeaders': {'Content-Type': ['application/json']},
+            'body': '{"error": "Live slot updates are not available here"}',
+            'isBase64Encoded': False,
+        }
+    response = Response.from_app(app, build_environ(event))
+    body = response.get_data()
+    binary = not (response.mimetype or '').startswith(TEXT_TYPES)
+    return {
+        'statusCode': response.status_code,
+        'multiValueHeaders': {name: response.headers.getlist(name)
+                              for name in set(response.headers.keys())},
+        'body': base64.b64encode(body).decode('ascii') if binary else body.decode('utf-8'),
+        'isBase64Encoded': binary,
+    }
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusyError(Exception):
+    """Raised when a hashing job could not be queued within the timeout"""
+
+
+class PasswordHasher:
+    """Run password hashing in a bounded process pool.
+
+    At most `max_pending` jobs are queued or running at once; callers past
+    that wait up to `queue_timeout` seconds and then get HashingBusyError,
+    so a login burst cannot pile up behind the workers. With `workers=0`
+    hashing runs inline in the calling thread. `observe`, if given, is
+    called with (operation, seconds) after every hash or verify, queueing
+    time included.
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=None, queue_timeout=5.0,
+                 observe=None):
+        self.method = method
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.observe = observe
+        self._slots = threading.BoundedSemaphore(max_pending or max(workers, 1) * 4)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # Imported here: the pool is only built on first use, and
+                    # multiprocessing is a noticeable part of a cold import
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    # spawn: forking a threaded server process is not safe
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusyError('password hashing queue is full')
+        try:
+            return self._pool().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _timed(self, operation, fn, *args):
+        started = time.perf_counter()
+        try:
+            return self._run(fn, *args)
+        finally:
+            if self.observe is not None:
+                self.observe(operation, time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._timed('hash', generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        """Hash a batch of passwords spread over every worker, for bulk imports.
+
+        Bypasses the `max_pending` queue: meant for offline jobs, not
+        request threads.
+        """
+        passwords = list(passwords)
+        if not self.workers or len(passwords) < 2:
+            return [self.hash(password) for password in passwords]
+        started = time.perf_counter()
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        hashes = list(self._pool().map(generate_password_hash, passwords,
+                                       [self.method] * len(passwords), chunksize=chunksize))
+        if self.observe is not None:
+            self.observe('hash_many', time.perf_counter() - started)
+        return hashes
+
+    def verify(self, pwhash, password):
+        return self._timed('verify', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when `pwhash` was made with different cost parameters"""
+        if self._prefix is None:
+            # Let werkzeug spell out the defaults, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
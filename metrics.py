@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""Request instrumentation exported in the Prometheus text format.
+
+Metrics live in the process that records them; with several workers each
+one exposes its own numbers and the scraper aggregates them. Storage
+backends report the files they open and the bytes they parse through
+`record_io`, which is charged to the request running on the current thread.
+"""
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+import collections
+from contextlib import contextmanager
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+
+def begin_io():
+    """Start counting storage I/O for the request on this thread"""
+    _local.io = [0, 0]
+
+
+def end_io():
+    """Stop counting and return (files opened, bytes parsed)"""
+    counters = getattr(_local, 'io', None)
+    _local.io = None
+    return tuple(counters) if counters else (0, 0)
+
+
+def record_io(files=0, nbytes=0):
+    """Charge storage reads to the current request; a no-op outside one"""
+    counters = getattr(_local, 'io', None)
+    if counters is not None:
+        counters[0] += files
+        counters[1] += nbytes
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, one series per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per label combination"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels):
+        """Decorator form of `time`"""
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(counts), total, count)
+                      for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            yield f'{self.name}_bucket{labels} {count}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {count}'
+
+
+class CallbackMetric:
+    """Metric read at scrape time from `collect()`, which returns (labels, value) pairs"""
+
+    def __init__(self, name, documentation, kind, collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            names = tuple(labels)
+            values = tuple(labels[name] for name in names)
+            yield f'{self.name}{_format_labels(names, values)} {_format_value(value)}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, collect):
+        return self._register(CallbackMetric(name, documentation, 'gauge', collect))
+
+    def counter_callback(self, name, documentation, collect):
+        return self._register(CallbackMetric(name, documentation, 'counter', collect))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+def _collapse(frame):
+    """A stack as 'outer;...;inner' frame labels, the flamegraph input format"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """Sample the stacks of in-flight requests and keep the slowest ones.
+
+    A daemon thread wakes every `interval` seconds and records the current
+    stack of each thread between `start` and `stop`. When a request is
+    among the `keep` slowest seen so far, its collapsed stacks are written
+    to `out_dir` (one "stack count" line each); the file of the request it
+    pushes out of that set is deleted.
+    """
+
+    def __init__(self, out_dir, interval=0.005, keep=20):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.keep = keep
+        self._active = {}
+        self._slowest = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sequence = itertools.count(1)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='medislot-profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[_collapse(frame)] += 1
+
+    def start(self):
+        with self._lock:
+            self._ensure_thread()
+            self._active[threading.get_ident()] = collections.Counter()
+
+    def stop(self, label, duration):
+        """Finish sampling this thread's request; returns the dump path if kept"""
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+            if not stacks:
+                return None
+            if len(self._slowest) >= self.keep and duration <= self._slowest[0][0]:
+                return None
+            safe_label = ''.join(c if c.isalnum() else '_' for c in label).strip('_')[:60]
+            path = os.path.join(self.out_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-'
+                                              f'{int(duration * 1000)}ms-{safe_label}-'
+                                              f'{next(self._sequence)}.txt')
+            heapq.heappush(self._slowest, (duration, path))
+            evicted = heapq.heappop(self._slowest)[1] if len(self._slowest) > self.keep else None
+        os.makedirs(self.out_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f'# {label} {duration * 1000:.1f}ms, {sum(stacks.values())} samples\n')
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        if evicted:
+            try:
+                os.remove(evicted)
+            except OSError:
+                pass
+        return path
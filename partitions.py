@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""Month/doctor partitions for the appointment collection.
+
+Live appointments are one JSON file each, filed under the month of their
+date and their doctor, so a query bounded by doctor and date opens one
+small directory instead of the whole collection:
+
+    appointments/2025-06/<doctor_id>/<appointment_id>.json
+
+`PartitionStore.compact` folds months older than a cutoff into an
+append-only archive segment per month:
+
+    appointments/archive/2025-06.jsonl.gz     gzip members of JSON lines
+    appointments/archive/2025-06.index.json   {'doctors': {doctor_id: [[offset, length]]}}
+    appointments/archive/2025-06.lookup.json  {'ids': {id: doctor_id},
+                                               'patients': {patient_id: [doctor_id]}}
+
+Each member holds one doctor's records sorted by date and time, so
+reading a doctor's archived month decompresses only their members, and a
+patient's history only the doctors the lookup lists for them. Members
+are only ever appended: for the same id a later member wins over an
+earlier one, a live file wins over the archive (it can only have been
+written after the month was compacted) and deletions are appended as
+tombstones.
+
+Files left flat in `appointments/` by older versions are still read;
+`migrate_flat` moves them into their partitions.
+"""
+import os
+import re
+import gzip
+import json
+from contextlib import contextmanager
+
+from metrics import record_io
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+ARCHIVE_DIR = 'archive'
+UNDATED = 'undated'
+UNASSIGNED = 'unassigned'
+TOMBSTONE = '_deleted'
+_MONTH = re.compile(r'\d{4}-\d{2}$')
+_NAME = re.compile(r'[\w-][\w.-]*$')
+
+
+def month_of(date):
+    """'YYYY-MM' partition of an ISO date; anything else is UNDATED"""
+    if isinstance(date, str) and _MONTH.match(date[:7]):
+        return date[:7]
+    return UNDATED
+
+
+def month_order(month):
+    """Sort key putting UNDATED first, as empty dates sort in the indexes"""
+    return '' if month == UNDATED else month
+
+
+def doctor_key(doctor_id):
+    """Directory name of a doctor's partitions"""
+    if isinstance(doctor_id, str) and _NAME.match(doctor_id):
+        return doctor_id
+    return UNASSIGNED
+
+
+def partition_of(item):
+    """(month, doctor directory) a record is filed under"""
+    return month_of(item.get('date')), doctor_key(item.get('doctor_id'))
+
+
+def scope(filters):
+    """(month, doctor, patient) narrowing implied by equality filters; None is unbounded"""
+    month = month_of(filters['date']) if 'date' in filters else None
+    doctor = doctor_key(filters['doctor_id']) if 'doctor_id' in filters else None
+    patient = filters.get('patient_id')
+    return month, doctor, patient if isinstance(patient, str) else None
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _record_key(item):
+    return (item.get('date') or '', item.get('time') or '', item['id'])
+
+
+class PartitionStore:
+    """Partitioned files and archive segments of one collection directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Off when a write-ahead log makes the live file writes durable
+        self.sync = True
+        self._flat = set()
+        self._cache = {}
+
+    def path(self, month, doctor, data_id):
+        return os.path.join(self.directory, month, doctor, f'{data_id}.json')
+
+    def path_of(self, data_id, item):
+        return self.path(*partition_of(item), data_id)
+
+    def _archive_path(self, month, suffix):
+        return os.path.join(self.directory, ARCHIVE_DIR, f'{month}{suffix}')
+
+    def live_months(self):
+        return [name for name in _listdir(self.directory)
+                if _MONTH.match(name) or name == UNDATED]
+
+    def archived_months(self):
+        suffix = '.index.json'
+        return sorted(name[:-len(suffix)] for name in _listdir(os.path.join(self.directory, ARCHIVE_DIR))
+                      if name.endswith(suffix) and not name.startswith('.tmp-'))
+
+    def months(self):
+        return sorted(set(self.live_months()) | set(self.archived_months()), key=month_order)
+
+    def _archive_json(self, month, suffix):
+        """A month's index or lookup document, cached until the file changes"""
+        path = self._archive_path(month, suffix)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        from repository import Repository
+        document = Repository._read_json(path)
+        self._cache[path] = (mtime, document)
+        return document
+
+    def spans(self, month, doctor):
+        index = self._archive_json(month, '.index.json')
+        return index['doctors'].get(doctor, []) if index else []
+
+    def lookup(self, month):
+        return self._archive_json(month, '.lookup.json') or {'ids': {}, 'patients': {}}
+
+    def doctors(self, month, patient=None):
+        """Doctor directories with records in a month, narrowed to a patient's in the archive"""
+        live = set(_listdir(os.path.join(self.directory, month)))
+        if patient is not None:
+            return live | set(self.lookup(month)['patients'].get(patient, ()))
+        index = self._archive_json(month, '.index.json')
+        return live | set(index['doctors'] if index else ())
+
+    def _read_live(self, month, doctor):
+        from repository import Repository
+        records = {}
+        directory = os.path.join(self.directory, month, doctor)
+        for name in _listdir(directory):
+            if name.endswith('.json') and not name.startswith('.tmp-'):
+                item = Repository._read_json(os.path.join(directory, name))
+                if item:
+                    records[name[:-5]] = item
+        return records
+
+    def _read_archive(self, month, doctor):
+        records = {}
+        spans = self.spans(month, doctor)
+        if not spans:
+            return records
+        with open(self._archive_path(month, '.jsonl.gz'), 'rb') as f:
+            for offset, length in spans:
+                f.seek(offset)
+                member = f.read(length)
+                record_io(nbytes=length)
+                for line in gzip.decompress(member).splitlines():
+                    item = json.loads(line)
+                    records[item['id']] = None if item.get(TOMBSTONE) else item
+        record_io(files=1)
+        return records
+
+    def read(self, month, doctor):
+        """{id: record} of one partition, the archive overlaid with live files"""
+        records = self._read_archive(month, doctor)
+        records.update(self._read_live(month, doctor))
+        return {data_id: item for data_id, item in records.items() if item is not None}
+
+    def _read_flat_files(self):
+        from repository import Repository
+        records = {}
+        for name in _listdir(self.directory):
+            if name.endswith('.json') and not name.startswith('.tmp-'):
+                item = Repository._read_json(os.path.join(self.directory, name))
+                if item:
+                    records[name[:-5]] = item
+        return records
+
+    def read_flat(self):
+        """Records still filed flat by an older version"""
+        records = self._read_flat_files()
+        self._flat = set(records)
+        return records
+
+    def read_one(self, data_id, item):
+        """Re-read a record from disk; `item` only needs its date and doctor_id"""
+        from repository import Repository
+        month, doctor = partition_of(item)
+        for path in (self.path(month, doctor, data_id), os.path.join(self.directory, f'{data_id}.json')):
+            found = Repository._read_json(path)
+            if found:
+                return found
+        return self._read_archive(month, doctor).get(data_id)
+
+    def read_at(self, month, doctor, data_id):
+        """Read one record of a partition, live file first; None if it is not there"""
+        from repository import Repository
+        return (Repository._read_json(self.path(month, doctor, data_id))
+                or self._read_archive(month, doctor).get(data_id))
+
+    def records(self):
+        """Yield (id, record) for the whole collection"""
+        yield from self._records(self.read_flat(), ())
+
+    def scan(self, archived=True):
+        """Yield (id, record) like `records`, leaving compacted months out unless `archived`.
+
+        Only one partition is held at a time and nothing is kept, so a
+        scan of the whole history stays small.
+        """
+        skip = () if archived else set(self.archived_months())
+        yield from self._records(self._read_flat_files(), skip)
+
+    def _records(self, flat, skip):
+        seen = set()
+        for month in self.months():
+            if month in skip:
+                continue
+            for doctor in sorted(self.doctors(month)):
+                for data_id, item in self.read(month, doctor).items():
+                    seen.add(data_id)
+                    yield data_id, item
+        for data_id, item in flat.items():
+            if data_id not in seen and month_of(item.get('date')) not in skip:
+                yield data_id, item
+
+    def locate(self, data_id):
+        """(month, doctor) of the partition holding `data_id`, or None.
+
+        Live months are probed newest first, since the records looked up
+        by id are mostly upcoming ones, then the archive lookups.
+        """
+        for month in sorted(self.live_months(), key=month_order, reverse=True):
+            for doctor in _listdir(os.path.join(self.directory, month)):
+                if os.path.exists(self.path(month, doctor, data_id)):
+                    return month, doctor
+        for month in reversed(self.archived_months()):
+            doctor = self.lookup(month)['ids'].get(data_id)
+            if doctor is not None:
+                return month, doctor
+        return None
+
+    def write(self, data_id, item, previous=None):
+        """Write a record to its partition, moving its old file if it changed place"""
+        from repository import write_json_atomic
+        path = self.path_of(data_id, item)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if data_id in self._flat:
+            old = os.path.join(self.directory, f'{data_id}.json')
+            self._flat.discard(data_id)
+        else:
+            old = self.path_of(data_id, previous) if previous else path
+        if old != path:
+            try:
+                os.replace(old, path)
+            except FileNotFoundError:
+                pass
+        write_json_atomic(path, item, sync=self.sync)
+
+    def write_many(self, items):
+        """Write (data_id, record, previous) triples synced as one batch; see `write`"""
+        from repository import write_json_many
+        writes, stale = [], []
+        for data_id, item, previous in items:
+            path = self.path_of(data_id, item)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if data_id in self._flat:
+                stale.append(os.path.join(self.directory, f'{data_id}.json'))
+                self._flat.discard(data_id)
+            elif previous and self.path_of(data_id, previous) != path:
+                stale.append(self.path_of(data_id, previous))
+            writes.append((path, item))
+        write_json_many(writes, sync=self.sync)
+        for path in stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, data_id, item):
+        """Remove a record's live file and tombstone any archived copy"""
+        paths = [self.path_of(data_id, item)]
+        if data_id in self._flat:
+            paths.append(os.path.join(self.directory, f'{data_id}.json'))
+            self._flat.discard(data_id)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        month, doctor = partition_of(item)
+        if self.spans(month, doctor):
+            self.append(month, {doctor: [{'id': data_id, TOMBSTONE: True}]})
+
+    @contextmanager
+    def _archive_lock(self):
+        """Serialise appends to the archive across processes"""
+        directory = os.path.join(self.directory, ARCHIVE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(directory, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def append(self, month, blocks):
+        """Append {doctor: [records]} to a month's segment, one gzip member per doctor.
+
+        The segment is synced before its index and lookup are replaced, so
+        a crash leaves at most unreferenced bytes at the end of the segment.
+        """
+        from repository import write_json_atomic
+        with self._archive_lock():
+            index = self._archive_json(month, '.index.json') or {'doctors': {}}
+            lookup = self.lookup(month)
+            index = {'doctors': {doctor: list(spans) for doctor, spans in index['doctors'].items()}}
+            lookup = {'ids': dict(lookup['ids']),
+                      'patients': {patient: list(doctors) for patient, doctors in lookup['patients'].items()}}
+            with open(self._archive_path(month, '.jsonl.gz'), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                for doctor, records in sorted(blocks.items()):
+                    records = sorted(records, key=_record_key)
+                    member = gzip.compress(b''.join(
+                        json.dumps(item, separators=(',', ':')).encode('utf-8') + b'\n'
+                        for item in records))
+                    f.write(member)
+                    index['doctors'].setdefault(doctor, []).append([offset, len(member)])
+                    offset += len(member)
+                    for item in records:
+                        lookup['ids'][item['id']] = doctor
+                        patient = item.get('patient_id')
+                        if isinstance(patient, str):
+                            doctors = lookup['patients'].setdefault(patient, [])
+                            if doctor not in doctors:
+                                doctors.append(doctor)
+                f.flush()
+                os.fsync(f.fileno())
+                record_io(files=1)
+            write_json_atomic(self._archive_path(month, '.lookup.json'), lookup)
+            write_json_atomic(self._archive_path(month, '.index.json'), index)
+
+    def compact(self, before):
+        """Archive the live files of every month earlier than `before` ('YYYY-MM').
+
+        Returns the number of records archived per month. A file rewritten
+        while its month is being compacted is left in place; it still
+        overrides the archived copy and is picked up by the next run.
+        """
+        counts = {}
+        for month in sorted(self.live_months()):
+            if month == UNDATED or month >= before:
+                continue
+            blocks = {}
+            written = []
+            month_dir = os.path.join(self.directory, month)
+            for doctor in _listdir(month_dir):
+                directory = os.path.join(month_dir, doctor)
+                for name in _listdir(directory):
+                    if not name.endswith('.json') or name.startswith('.tmp-'):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        with open(path, 'r') as f:
+                            stamp = os.fstat(f.fileno())
+                            item = json.loads(f.read())
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        continue
+                    if item:
+                        blocks.setdefault(doctor, []).append(dict(item, id=name[:-5]))
+                        written.append((path, (stamp.st_ino, stamp.st_mtime_ns)))
+            if blocks:
+                self.append(month, blocks)
+            for path, stamp in written:
+                try:
+                    current = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if (current.st_ino, current.st_mtime_ns) == stamp:
+                    os.remove(path)
+            for doctor in _listdir(month_dir):
+                try:
+                    os.rmdir(os.path.join(month_dir, doctor))
+                except OSError:
+                    pass
+            try:
+                os.rmdir(month_dir)
+            except OSError:
+                pass
+            counts[month] = len(written)
+        return counts
+
+    def migrate_flat(self):
+        """Move files left flat by older versions into their partitions; returns the count"""
+        moved = 0
+        for data_id, item in self.read_flat().items():
+            path = self.path_of(data_id, item)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(os.path.join(self.directory, f'{data_id}.json'), path)
+            moved += 1
+        self._flat = set()
+        return moved
@@ -0,0 +1,968 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import bisect
+import shutil
+import logging
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from metrics import record_io
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Secondary indexes kept for every collection. Each entry is a tuple of field
+# names; the index maps the tuple of those field values to the set of record
+# ids that carry them.
+INDEXES = {
+    'patients': [('email',)],
+    'doctors': [('email',), ('specialization',)],
+    'appointments': [('doctor_id',), ('patient_id',), ('doctor_id', 'date', 'status')],
+    'availability': [('doctor_id',), ('doctor_id', 'day_of_week')],
+}
+
+# Ordered indexes: records sharing a field value, kept sorted by the given
+# fields (then id) so per-user history can be paged without a full sort.
+SORTED_INDEXES = {
+    'appointments': {'doctor_id': ('date', 'time'), 'patient_id': ('date', 'time')},
+}
+
+# Collections filed by month and doctor and read a partition at a time
+# (see partitions.py) instead of as one flat directory
+PARTITIONED = ('appointments',)
+
+# Every write appends the ids it changed to `changes/<collection>.log`, so
+# processes sharing the data directory can bring their cached copies up to
+# date; a log is started afresh once it grows past CHANGES_MAX_BYTES.
+CHANGES_DIR = 'changes'
+CHANGES_MAX_BYTES = 4 * 1024 * 1024
+
+# Booking locks, one file per doctor-day, and slot claims filed by month:
+# `slots/<YYYY-MM>/<slot hash>.json` names the appointment holding a slot
+# and goes when it is cancelled, deleted or archived.
+LOCKS_DIR = 'locks'
+SLOTS_DIR = 'slots'
+
+
+def _index_key(item, fields):
+    return tuple(item.get(field) for field in fields)
+
+
+def slot_key(appointment):
+    """Identify the doctor/date/time slot an appointment occupies"""
+    return (appointment['doctor_id'], appointment['date'], appointment['time'])
+
+
+def write_json_atomic(path, data, sync=True):
+    """Write JSON to a temp file and rename it over `path`.
+
+    Readers see either the old or the new document, never a truncated one.
+    `sync=False` skips the fsync, for writes a write-ahead log already covers.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    record_io(files=1)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def fsync_path(path):
+    """fsync a file or directory; False if it no longer exists"""
+    if os.path.isdir(path) and os.name != 'posix':
+        return True  # directories cannot be opened for syncing here
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return True
+
+
+def write_json_many(items, sync=True):
+    """Write `(path, data)` pairs atomically, syncing them as one batch.
+
+    Every document goes to a temp file; once all of them are written they
+    are synced, renamed over their targets and the directories synced, so
+    every file is either old or new. `sync=False` skips the syncs, as in
+    `write_json_atomic`.
+    """
+    pending = []
+    try:
+        for path, data in items:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-',
+                                            suffix='.json')
+            pending.append((tmp_path, path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=4)
+        if sync:
+            # Written first and synced after, so the disk sees one batch
+            for tmp_path, _ in pending:
+                fsync_path(tmp_path)
+        record_io(files=len(pending))
+        directories = {os.path.dirname(path) or '.' for _, path in pending}
+        while pending:
+            tmp_path, path = pending[0]
+            os.replace(tmp_path, path)
+            pending.pop(0)
+        if sync:
+            for directory in directories:
+                fsync_path(directory)
+    except BaseException:
+        for tmp_path, _ in pending:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+@contextmanager
+def _flocked(fd, operation):
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(fd, operation)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class Repository:
+    """In-memory, indexed view of the JSON data directory.
+
+    Each collection is read from disk once, on first use. Writes go to disk
+    and update the cached records and their indexes, so lookups on indexed
+    fields cost O(result) instead of a full directory scan. With a
+    `snapshot_path`, collections still fresh in that snapshot are mapped
+    from it instead of scanned (see snapshot.py). Partitioned collections
+    only read the month/doctor partitions a query can touch.
+
+    Writes are also appended to a per-collection change log that every
+    cached collection checks on access (one stat when nothing changed), so
+    records written by other processes are re-read before they are served.
+    Callbacks registered with `add_listener` hear about those records.
+
+    With a `wal_path`, writes are logged to a write-ahead log (see wal.py)
+    and the data files are written without syncing; the log is replayed
+    when the repository is created and checkpointed once it outgrows
+    `checkpoint_bytes`.
+    """
+
+    def __init__(self, data_dir='data', indexes=None, sorted_indexes=None, snapshot_path=None,
+                 partitioned=None, wal_path=None, checkpoint_bytes=16 * 1024 * 1024):
+        self.data_dir = data_dir
+        self.snapshot_path = snapshot_path
+        self._snapshot = None
+        self.indexes = INDEXES if indexes is None else indexes
+        self.sorted_indexes = SORTED_INDEXES if sorted_indexes is None else sorted_indexes
+        self.partitioned = PARTITIONED if partitioned is None else partitioned
+        self._records = {}
+        self._index_data = {}
+        self._sorted_data = {}
+        self._stores = {}
+        self._loaded = {}
+        self._seen = {}
+        self._journals = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._applied = 0   # last WAL ticket whose write was applied
+        self._applied_cond = threading.Condition(self._lock)
+        self._slot_locks = {}
+        self.checkpoint_bytes = checkpoint_bytes
+        self.wal = None
+        if wal_path:
+            from wal import WriteAheadLog
+            try:
+                self.wal = WriteAheadLog(wal_path)
+            except OSError as exc:
+                # A read-only deploy, say; every write then syncs its own files
+                logger.warning('Cannot open the write-ahead log %s (%s); writing without it',
+                               wal_path, exc)
+            else:
+                self.recover()
+
+    def _path(self, data_type, data_id):
+        return os.path.join(self.data_dir, data_type, f'{data_id}.json')
+
+    def _read_file(self, data_type, data_id):
+        return self._read_json(self._path(data_type, data_id))
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        record_io(files=1, nbytes=len(text))
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning('Skipping %s: not valid JSON', path)
+            return None
+
+    def _collection(self, data_type):
+        """Return the cached records of a collection, loading it if needed.
+
+        A cached collection is first brought up to date with the changes
+        other processes logged since it was read.
+        """
+        records = self._records.get(data_type)
+        if records is not None and self._seen.get(data_type) == self._journal_state(data_type):
+            return records
+        changes = []
+        with self._lock:
+            if data_type in self._records:
+                changes = self._catch_up(data_type)
+                if changes is not None:
+                    records = self._records[data_type]
+                else:
+                    self.invalidate(data_type)
+                    changes = [(None, None)]
+            if data_type not in self._records:
+                records = self._load(data_type)
+        for data_id, item in changes:
+            for listener in self._listeners:
+                listener(data_type, data_id, item)
+        return records
+
+    def _load(self, data_type):
+        # Changes logged from here on are caught up on next use
+        self._seen[data_type] = self._journal_state(data_type)
+        loaded = None if data_type in self.partitioned else self._load_snapshot(data_type)
+        if loaded is not None:
+            records, self._index_data[data_type], self._sorted_data[data_type] = loaded
+            self._records[data_type] = records
+            return records
+        records = {}
+        index_data = {fields: {} for fields in self.indexes.get(data_type, [])}
+        directory = os.path.join(self.data_dir, data_type)
+        if data_type in self.partitioned:
+            # Partitions are read as queries need them; only files
+            # left flat by older versions are loaded up front
+            records = self._store(data_type).read_flat()
+            self._loaded[data_type] = set()
+        elif os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.endswith('.json') and not filename.startswith('.tmp-'):
+                    item = self._read_file(data_type, filename[:-5])
+                    if item:
+                        records[filename[:-5]] = item
+        self._index_data[data_type] = index_data
+        self._sorted_data[data_type] = {field: {} for field in self.sorted_indexes.get(data_type, {})}
+        for data_id, item in records.items():
+            self._add_to_indexes(data_type, data_id, item)
+        self._records[data_type] = records
+        return records
+
+    def _journal_path(self, data_type):
+        return os.path.join(self.data_dir, CHANGES_DIR, f'{data_type}.log')
+
+    def _journal_state(self, data_type):
+        """(inode, size) of a collection's change log; (None, 0) before its first write"""
+        try:
+            stat = os.stat(self._journal_path(data_type))
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def _catch_up(self, data_type):
+        """Re-read the records changed since the collection was read.
+
+        Returns the (id, record or None) pairs that changed, or None when
+        the log was started afresh and the collection must be reloaded.
+        """
+        inode, offset = self._seen[data_type]
+        try:
+            f = open(self._journal_path(data_type), 'rb')
+        except FileNotFoundError:
+            return None if inode is not None else []
+        with f:
+            current = os.fstat(f.fileno()).st_ino
+            if inode is not None and current != inode:
+                return None
+            f.seek(offset)
+            data = f.read()
+        # A line still being written is left for the next check
+        end = data.rfind(b'\n') + 1
+        self._seen[data_type] = (current, offset + end)
+        record_io(files=1, nbytes=end)
+        changes = {tuple(json.loads(line)): None for line in data[:end].splitlines()}
+        return [(change[0], self._reread(data_type, change)) for change in changes]
+
+    def _reread(self, data_type, change):
+        """Refresh one cached record from disk; returns it, or None if it is gone"""
+        records = self._records[data_type]
+        data_id = change[0]
+        cached = True
+        if data_type not in self.partitioned:
+            item = self._read_file(data_type, data_id)
+        elif len(change) < 3:
+            item = None
+        else:
+            month, doctor = change[1], change[2]
+            item = self._store(data_type).read_at(month, doctor, data_id)
+            loaded = self._loaded[data_type]
+            cached = None in loaded or (month, None) in loaded or (month, doctor) in loaded
+        previous = records.pop(data_id, None)
+        if previous is not None:
+            self._remove_from_indexes(data_type, data_id, previous)
+        if item and cached:
+            records[data_id] = item
+            self._add_to_indexes(data_type, data_id, item)
+        return item or None
+
+    def _log_changes(self, data_type, changes):
+        """Append changed ids to the collection's change log, one write per call"""
+        data = b''.join(json.dumps(change).encode('utf-8') + b'\n' for change in changes)
+        path = self._journal_path(data_type)
+        with self._lock:
+            while True:
+                pid, fd = self._journals.get(data_type, (None, None))
+                if pid != os.getpid():
+                    # Descriptors inherited over fork share an offset; use our own
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    self._journals[data_type] = (os.getpid(), fd)
+                with _flocked(fd, fcntl.LOCK_SH if fcntl else None):
+                    stat = os.fstat(fd)
+                    if stat.st_nlink:
+                        os.write(fd, data)
+                        end = os.lseek(fd, 0, os.SEEK_CUR)
+                        break
+                # Started afresh by another process; reopen the new log
+                os.close(fd)
+                del self._journals[data_type]
+            record_io(nbytes=len(data))
+            # Nothing else was logged since our last check: our cache already has it
+            seen = self._seen.get(data_type)
+            if seen is not None and seen[0] in (None, stat.st_ino) and seen[1] == end - len(data):
+                self._seen[data_type] = (stat.st_ino, end)
+            if end > CHANGES_MAX_BYTES and fcntl is not None:
+                self._rotate_changes(data_type, fd, path)
+
+    def _rotate_changes(self, data_type, fd, path):
+        """Start a collection's change log afresh once every writer is caught up"""
+        with _flocked(fd, fcntl.LOCK_EX):
+            if not os.fstat(fd).st_nlink:
+                return
+            if data_type in self._records:
+                self.refresh(data_type)
+            tmp_path = f'{path}.tmp-{os.getpid()}'
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, path)
+            if data_type in self._seen:
+                self._seen[data_type] = self._journal_state(data_type)
+
+    def add_listener(self, callback):
+        """Call `callback(data_type, data_id, record)` for records other processes changed.
+
+        `record` is None for a deletion; `data_id` is None when a whole
+        collection was re-read and anything in it may have changed.
+        """
+        self._listeners.append(callback)
+
+    def refresh(self, data_type):
+        """Catch a cached collection up with writes made by other processes"""
+        self._collection(data_type)
+
+    def _store(self, data_type):
+        store = self._stores.get(data_type)
+        if store is None:
+            from partitions import PartitionStore
+            store = self._stores[data_type] = PartitionStore(os.path.join(self.data_dir, data_type))
+            store.sync = self.wal is None
+        return store
+
+    def _load_partitions(self, data_type, month=None, doctor=None, patient=None):
+        """Read the partitions a query bounded this way can touch into the cache"""
+        if data_type not in self.partitioned:
+            return
+        records = self._collection(data_type)
+        store = self._store(data_type)
+        with self._lock:
+            loaded = self._loaded[data_type]
+            if None in loaded:
+                return
+            for current in store.months() if month is None else [month]:
+                if (current, None) in loaded:
+                    continue
+                doctors = [doctor] if doctor is not None else store.doctors(current, patient)
+                for name in doctors:
+                    if (current, name) in loaded:
+                        continue
+                    for data_id, item in store.read(current, name).items():
+                        # The cached copy is never older than the one on disk
+                        if data_id not in records:
+                            records[data_id] = item
+                            self._add_to_indexes(data_type, data_id, item)
+                    loaded.add((current, name))
+                if doctor is None and patient is None:
+                    loaded.add((current, None))
+            if month is None and doctor is None and patient is None:
+                loaded.add(None)
+
+    def _load_scope(self, data_type, filters):
+        if data_type in self.partitioned:
+            from partitions import scope
+            self._load_partitions(data_type, *scope(filters))
+
+    def _locate(self, data_type, data_id):
+        """Load the partition holding a record that is not cached yet"""
+        records = self._collection(data_type)
+        if data_id in records or data_type not in self.partitioned:
+            return
+        with self._lock:
+            if None in self._loaded[data_type]:
+                return
+            partition = self._store(data_type).locate(data_id)
+            if partition is not None:
+                self._load_partitions(data_type, *partition)
+
+    def _load_snapshot(self, data_type):
+        if not self.snapshot_path:
+            return None
+        if self._snapshot is None:
+            from snapshot import Snapshot
+            self._snapshot = Snapshot.open(self.snapshot_path) or False
+        if not self._snapshot:
+            return None
+        return self._snapshot.load(data_type, self.data_dir, self.indexes.get(data_type, []),
+                                   self.sorted_indexes.get(data_type, {}))
+
+    def _sort_key(self, data_type, field, data_id, item):
+        order_by = self.sorted_indexes[data_type][field]
+        return tuple(item.get(f) or '' for f in order_by) + (data_id,)
+
+    def _add_to_indexes(self, data_type, data_id, item):
+        for fields, index in self._index_data[data_type].items():
+            index.setdefault(_index_key(item, fields), set()).add(data_id)
+        for field, index in self._sorted_data[data_type].items():
+            entries = index.setdefault(item.get(field), [])
+            bisect.insort(entries, self._sort_key(data_type, field, data_id, item))
+
+    def _remove_from_indexes(self, data_type, data_id, item):
+        for fields, index in self._index_data[data_type].items():
+            key = _index_key(item, fields)
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(data_id)
+                if not ids:
+                    del index[key]
+        for field, index in self._sorted_data[data_type].items():
+            entries = index.get(item.get(field))
+            if entries:
+                sort_key = self._sort_key(data_type, field, data_id, item)
+                position = bisect.bisect_left(entries, sort_key)
+                if position < len(entries) and entries[position] == sort_key:
+                    del entries[position]
+                if not entries:
+                    del index[item.get(field)]
+
+    def _candidates(self, data_type, filters):
+        """Return the ids to check for `filters`, using the narrowest index"""
+        records = self._collection(data_type)
+        self._load_scope(data_type, filters)
+        with self._lock:
+            best = None
+            for fields, index in self._index_data[data_type].items():
+                if all(field in filters for field in fields):
+                    try:
+                        ids = index.get(tuple(filters[field] for field in fields), ())
+                    except TypeError:
+                        continue
+                    if best is None or len(ids) < len(best):
+                        best = ids
+            if best is None:
+                return list(records)
+            return list(best)
+
+    @contextmanager
+    def _writing(self, entries):
+        """Hold the lock for a write and, with a WAL, log `entries` ahead of it.
+
+        The entries are appended and synced before the data files change.
+        The sync runs outside the lock, so writers on other threads can
+        share it, and the writes are then applied in the order they were
+        logged. The log stays held shared throughout, so no checkpoint
+        empties it in between.
+        """
+        if self.wal is None:
+            with self._lock:
+                yield
+            return
+        with self.wal.shared():
+            with self._lock:
+                ticket = self.wal.append([self._with_origin(entry) for entry in entries])
+            try:
+                self.wal.sync(ticket)
+            except BaseException:
+                # Still take our turn, or later writes would wait for it forever
+                with self._in_log_order(ticket):
+                    pass
+                raise
+            with self._in_log_order(ticket):
+                yield
+        if self.wal.size() > self.checkpoint_bytes:
+            self.checkpoint()
+
+    def _with_origin(self, entry):
+        """Log entry noting where a partitioned record was, for the checkpoint to sync"""
+        data_type, data_id = entry['type'], entry['id']
+        if data_type not in self.partitioned:
+            return entry
+        from partitions import partition_of
+        self._locate(data_type, data_id)
+        previous = self._collection(data_type).get(data_id)
+        if previous is None:
+            return entry
+        origin = list(partition_of(previous))
+        if entry['op'] == 'save' and origin == list(partition_of(entry['data'])):
+            return entry
+        return dict(entry, **{'from': origin})
+
+    @contextmanager
+    def _in_log_order(self, ticket):
+        """Hold the lock once the writes logged before `ticket` have been applied"""
+        with self._lock:
+            while self._applied < ticket - 1:
+                self._applied_cond.wait()
+            try:
+                yield
+            finally:
+                self._applied = ticket
+                self._applied_cond.notify_all()
+
+    def save(self, data_type, data_id, data):
+        """Write a record to disk and refresh its cache and index entries"""
+        with self._writing([{'op': 'save', 'type': data_type, 'id': data_id, 'data': data}]):
+            previous = self._apply_save(data_type, data_id, data)
+        if data_type == 'appointments':
+            self._release_claims([(data_id, previous, data)])
+
+    def _apply_save(self, data_type, data_id, data):
+        with self._lock:
+            records = self._collection(data_type)
+            if data_type in self.partitioned:
+                from partitions import partition_of
+                self._load_partitions(data_type, *partition_of(data))
+                self._store(data_type).write(data_id, data, records.get(data_id))
+            else:
+                os.makedirs(os.path.join(self.data_dir, data_type), exist_ok=True)
+                write_json_atomic(self._path(data_type, data_id), data, sync=self.wal is None)
+            previous = records.get(data_id)
+            if previous is not None:
+                self._remove_from_indexes(data_type, data_id, previous)
+            records[data_id] = dict(data)
+            self._add_to_indexes(data_type, data_id, records[data_id])
+            self._log_changes(data_type, [self._change(data_type, data_id, data)])
+            return previous
+
+    def _change(self, data_type, data_id, item):
+        """Change log entry for a record: its id, and its partition if it has one"""
+        if data_type in self.partitioned and item is not None:
+            from partitions import partition_of
+            return [data_id, *partition_of(item)]
+        return [data_id]
+
+    def save_many(self, data_type, items):
+        """Save `(data_id, data)` pairs, written first and then synced as one batch"""
+        items = [(data_id, dict(data)) for data_id, data in items]
+        with self._writing([{'op': 'save', 'type': data_type, 'id': data_id, 'data': data}
+                            for data_id, data in items]):
+            records = self._collection(data_type)
+            if data_type in self.partitioned:
+                from partitions import partition_of
+                for _, data in items:
+                    self._load_partitions(data_type, *partition_of(data))
+                self._store(data_type).write_many(
+                    [(data_id, data, records.get(data_id)) for data_id, data in items])
+            else:
+                os.makedirs(os.path.join(self.data_dir, data_type), exist_ok=True)
+                write_json_many([(self._path(data_type, data_id), data) for data_id, data in items],
+                                sync=self.wal is None)
+            replaced = []
+            for data_id, data in items:
+                previous = records.get(data_id)
+                if previous is not None:
+                    self._remove_from_indexes(data_type, data_id, previous)
+                    replaced.append((data_id, previous, data))
+                records[data_id] = data
+                self._add_to_indexes(data_type, data_id, data)
+            self._log_changes(data_type, [self._change(data_type, data_id, data) for data_id, data in items])
+        if data_type == 'appointments':
+            self._release_claims(replaced)
+
+    def delete(self, data_type, data_id):
+        """Remove a record from disk, the cache and the indexes"""
+        with self._writing([{'op': 'delete', 'type': data_type, 'id': data_id}]):
+            previous = self._apply_delete(data_type, data_id)
+        if data_type == 'appointments':
+            self._release_claims([(data_id, previous, None)])
+
+    def _apply_delete(self, data_type, data_id):
+        with self._lock:
+            records = self._collection(data_type)
+            if data_type in self.partitioned:
+                self._locate(data_type, data_id)
+                if data_id in records:
+                    self._store(data_type).delete(data_id, records[data_id])
+            else:
+                try:
+                    os.remove(self._path(data_type, data_id))
+                except FileNotFoundError:
+                    pass
+            previous = records.pop(data_id, None)
+            if previous is not None:
+                self._remove_from_indexes(data_type, data_id, previous)
+            self._log_changes(data_type, [self._change(data_type, data_id, previous)])
+            return previous
+
+    def load(self, data_type, data_id):
+        self._locate(data_type, data_id)
+        item = self._collection(data_type).get(data_id)
+        return dict(item) if item is not None else None
+
+    def load_all(self, data_type):
+        records = self._collection(data_type)
+        self._load_partitions(data_type)
+        with self._lock:
+            return [dict(item) for item in records.values()]
+
+    def scan(self, data_type, archived=False):
+        """Yield a collection's records read from disk, without caching them.
+
+        Partitioned collections are read one partition at a time, and
+        their archived months only with `archived`; others are small and
+        come from the cache.
+        """
+        if data_type not in self.partitioned:
+            yield from self.load_all(data_type)
+            return
+        for data_id, item in self._store(data_type).scan(archived):
+            yield item
+
+    def find(self, data_type, field, value):
+        records = self._collection(data_type)
+        for data_id in self._candidates(data_type, {field: value}):
+            item = records.get(data_id)
+            if item is not None and item.get(field) == value:
+                return dict(item)
+        return None
+
+    def filter(self, data_type, filters):
+        records = self._collection(data_type)
+        results = []
+        for data_id in self._candidates(data_type, filters):
+            item = records.get(data_id)
+            if item is None:
+                continue
+            if all(item.get(field) == value for field, value in filters.items()):
+                results.append(dict(item))
+        return results
+
+    def load_many(self, data_type, data_ids):
+        """Load several records at once; returns a dict keyed by id"""
+        records = self._collection(data_type)
+        data_ids = set(data_ids)
+        for data_id in data_ids:
+            self._locate(data_type, data_id)
+        return {data_id: dict(records[data_id]) for data_id in data_ids
+                if data_id in records}
+
+    def ordered(self, data_type, field, value, start=None, reverse=False,
+                limit=None, predicate=None):
+        """Records with `field == value` in sort-index order.
+
+        `start` is a prefix of the sort key (e.g. `(date,)` or
+        `(date, time, id)`): forward scans yield keys >= start, reverse
+        scans keys < start. `predicate` filters records and the scan stops
+        once `limit` records have matched. On a partitioned collection
+        ordered by date, months are read in scan order until `limit` is met.
+        """
+        records = self._collection(data_type)
+        if data_type in self.partitioned:
+            from partitions import scope, month_of, month_order
+            bounds = scope({field: value})[1:]
+            if self.sorted_indexes[data_type][field][0] != 'date':
+                self._load_partitions(data_type, None, *bounds)
+            for month in self._scan_months(data_type, field, start, reverse):
+                self._load_partitions(data_type, month, *bounds)
+                if limit is None:
+                    continue
+                results = self._scan(records, data_type, field, value, start, reverse, limit, predicate)
+                # Done once the last result lies in a month already read:
+                # the months still unread all sort after it
+                if len(results) >= limit:
+                    last = month_order(month_of(results[-1].get('date')))
+                    if (last >= month_order(month)) if reverse else (last <= month_order(month)):
+                        return results
+        return self._scan(records, data_type, field, value, start, reverse, limit, predicate)
+
+    def _scan_months(self, data_type, field, start, reverse):
+        """Months a date-ordered scan from `start` can reach, in scan order"""
+        from partitions import month_order
+        if self.sorted_indexes[data_type][field][0] != 'date':
+            return []
+        months = self._store(data_type).months()
+        if reverse:
+            months.reverse()
+        if not start or not isinstance(start[0], str):
+            return months
+        # A month sorts before every date in it and after every earlier one
+        if reverse:
+            return [month for month in months if month_order(month) <= start[0]]
+        return [month for month in months if month_order(month) + '\uffff' >= start[0]]
+
+    def _scan(self, records, data_type, field, value, start, reverse, limit, predicate):
+        results = []
+        with self._lock:
+            entries = self._sorted_data[data_type][field].get(value, [])
+            if reverse:
+                end = len(entries) if start is None else bisect.bisect_left(entries, tuple(start))
+                positions = range(end - 1, -1, -1)
+            else:
+                begin = 0 if start is None else bisect.bisect_left(entries, tuple(start))
+                positions = range(begin, len(entries))
+            for position in positions:
+                item = records.get(entries[position][-1])
+                if item is None or (predicate is not None and not predicate(item)):
+                    continue
+                results.append(dict(item))
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    @contextmanager
+    def _slot_lock(self, doctor_id, date):
+        """Hold an exclusive lock on a doctor-day's bookings across threads and processes"""
+        name = hashlib.sha1(f'{doctor_id}|{date}'.encode('utf-8')).hexdigest()
+        if fcntl is None:
+            with self._lock:
+                lock = self._slot_locks.setdefault(name, threading.Lock())
+            with lock:
+                yield
+            return
+        lock_dir = os.path.join(self.data_dir, LOCKS_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        record_io(files=1)
+        with open(os.path.join(lock_dir, f'{name}.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _claim_path(self, key):
+        from partitions import month_of
+        name = hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.data_dir, SLOTS_DIR, month_of(key[1]), f'{name}.json')
+
+    def _release_claims(self, changes):
+        """Remove the claims of booked appointments that were cancelled, moved or deleted.
+
+        Runs after the write and outside the slot lock, which `book_slot`
+        already holds when it saves. Claims only speed up `_slot_taken`,
+        which checks the index as well, so a claim lost to a race is harmless.
+        """
+        for data_id, previous, item in changes:
+            if not previous or previous.get('status') != 'booked':
+                continue
+            key = (previous.get('doctor_id'), previous.get('date'), previous.get('time'))
+            if not all(isinstance(part, str) for part in key):
+                continue
+            if item and item.get('status') == 'booked' and slot_key(item) == key:
+                continue
+            path = self._claim_path(key)
+            claim = self._read_json(path)
+            if claim and claim.get('appointment_id') == data_id:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _is_booked_on_disk(self, appointment_id, key):
+        if 'appointments' in self.partitioned:
+            appointment = self._store('appointments').read_one(
+                appointment_id, {'doctor_id': key[0], 'date': key[1]})
+        else:
+            appointment = self._read_file('appointments', appointment_id)
+        return (appointment is not None and appointment.get('status') == 'booked'
+                and slot_key(appointment) == key)
+
+    def _slot_taken(self, key):
+        # The claim file names the appointment that last took the slot; it
+        # only counts while that appointment is still booked on disk.
+        claim = self._read_json(self._claim_path(key))
+        if claim and self._is_booked_on_disk(claim['appointment_id'], key):
+            return True
+        # Bookings made before claim files existed are only in the index
+        doctor_id, date, time = key
+        for appointment in self.filter('appointments', {
+            'doctor_id': doctor_id,
+            'date': date,
+            'time': time,
+            'status': 'booked'
+        }):
+            if self._is_booked_on_disk(appointment['id'], key):
+                return True
+        return False
+
+    def book_slot(self, appointment):
+        """Save a booked appointment unless its slot is already taken.
+
+        Returns True when the appointment was stored, False on a conflict.
+        """
+        key = slot_key(appointment)
+        with self._slot_lock(*key[:2]):
+            if self._slot_taken(key):
+                return False
+            path = self._claim_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Rebuilt from the appointments if lost, so it needs no WAL entry
+            write_json_atomic(path, {'appointment_id': appointment['id']}, sync=self.wal is None)
+            self.save('appointments', appointment['id'], appointment)
+        return True
+
+    def invalidate(self, data_type=None):
+        """Drop cached collections so they are re-read from disk on next use"""
+        with self._lock:
+            if data_type is None:
+                self._records.clear()
+                self._index_data.clear()
+                self._sorted_data.clear()
+                self._loaded.clear()
+                self._seen.clear()
+            else:
+                self._records.pop(data_type, None)
+                self._index_data.pop(data_type, None)
+                self._sorted_data.pop(data_type, None)
+                self._loaded.pop(data_type, None)
+                self._seen.pop(data_type, None)
+
+    def compact(self, data_type, before):
+        """Partition flat files and archive months before `before` ('YYYY-MM').
+
+        Returns (files moved into partitions, {month: records archived}).
+        """
+        if self.wal is not None:
+            # Replaying older entries later must not undo the move
+            self.checkpoint()
+        with self._lock:
+            store = self._store(data_type)
+            moved = store.migrate_flat()
+            archived = store.compact(before)
+            self.invalidate(data_type)
+        if data_type == 'appointments':
+            self._drop_claims(archived)
+        return moved, archived
+
+    def _drop_claims(self, months):
+        """Remove the slot claims of archived months, and any left unfiled by older versions"""
+        directory = os.path.join(self.data_dir, SLOTS_DIR)
+        for month in months:
+            shutil.rmtree(os.path.join(directory, month), ignore_errors=True)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+    def recover(self):
+        """Replay the write-ahead log over the data files, then checkpoint.
+
+        Returns the number of entries replayed.
+        """
+        with self.wal.exclusive(), self._lock:
+            replayed = 0
+            for entry in self.wal.entries():
+                if entry['op'] == 'save':
+                    self._apply_save(entry['type'], entry['id'], entry['data'])
+                else:
+                    self._apply_delete(entry['type'], entry['id'])
+                replayed += 1
+            self._checkpoint_locked()
+            # Replay went through the caches; let first use read them afresh
+            self.invalidate()
+        if replayed:
+            logger.info('Replayed %d write-ahead log entries from %s', replayed, self.wal.path)
+        return replayed
+
+    def checkpoint(self):
+        """Sync the data files and empty the write-ahead log"""
+        with self.wal.exclusive(), self._lock:
+            self._checkpoint_locked()
+
+    def _checkpoint_locked(self):
+        if not self.wal.size():
+            return
+        # Sync what the logged writes touched, then the directories up to
+        # the data directory so renames, removals and new partitions stick
+        files, directories = set(), set()
+        for entry in self.wal.entries():
+            for path in self._logged_paths(entry):
+                files.add(path)
+                directory = os.path.dirname(path)
+                while directory and directory not in directories:
+                    directories.add(directory)
+                    if directory == self.data_dir:
+                        break
+                    directory = os.path.dirname(directory)
+        for path in files:
+            fsync_path(path)
+        for directory in directories:
+            fsync_path(directory)
+        self.wal.truncate()
+
+    def _logged_paths(self, entry):
+        """Data files a logged write may have written or removed"""
+        data_type, data_id = entry['type'], entry['id']
+        if data_type not in self.partitioned:
+            return [self._path(data_type, data_id)]
+        store = self._store(data_type)
+        paths = [os.path.join(store.directory, f'{data_id}.json')]
+        if entry['op'] == 'save':
+            paths.append(store.path_of(data_id, entry['data']))
+        if entry.get('from'):
+            paths.append(store.path(*entry['from'], data_id))
+        return paths
+
+
+def create_repository(backend='json', data_dir='data', sqlite_path=None, snapshot_path=None,
+                      wal_path=None, checkpoint_bytes=16 * 1024 * 1024):
+    """Build the storage backend named by `backend` ('json' or 'sqlite')"""
+    if backend == 'json':
+        return Repository(data_dir, snapshot_path=snapshot_path, wal_path=wal_path,
+                          checkpoint_bytes=checkpoint_bytes)
+    if backend == 'sqlite':
+        from sqlite_store import SQLiteRepository
+        return SQLiteRepository(sqlite_path or os.path.join(data_dir, 'medislot.sqlite3'))
+    raise ValueError(f'Unknown storage backend: {backend}')
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Per-doctor schedule documents.
+
+A doctor's hours live in one `schedules` record keyed by the doctor id:
+
+    {'doctor_id': ..., 'version': 3, 'updated_at': ...,
+     'weekly': [{'id', 'day_of_week', 'start_time', 'end_time', 'is_available'}],
+     'overrides': [{'id', 'date', 'start_time', 'end_time', 'is_available'}]}
+
+`weekly` rules repeat every week. `overrides` apply to one date: open
+overrides replace that day's weekly hours, closed ones block their window
+(or the whole day when they have no times), which covers holidays and
+one-off clinics without extra records.
+"""
+import re
+import uuid
+from datetime import datetime
+
+DEFAULT_WEEKLY_HOURS = [(day, '09:00', '17:00') for day in range(5)]
+_DATE = re.compile(r'\d{4}-\d{2}-\d{2}$')
+_TIME = re.compile(r'([01]\d|2[0-3]):[0-5]\d$')
+
+
+def _weekly_key(rule):
+    return (rule['day_of_week'], rule['start_time'], rule['end_time'], bool(rule.get('is_available', True)))
+
+
+def _override_key(rule):
+    return (rule['date'], rule.get('start_time') or '', rule.get('end_time') or '',
+            bool(rule.get('is_available', False)))
+
+
+def weekly_rule(day_of_week, start_time, end_time, is_available=True):
+    return {
+        'id': str(uuid.uuid4()),
+        'day_of_week': int(day_of_week),
+        'start_time': start_time,
+        'end_time': end_time,
+        'is_available': is_available
+    }
+
+
+def override_rule(date, start_time=None, end_time=None, is_available=False):
+    return {
+        'id': str(uuid.uuid4()),
+        'date': date,
+        'start_time': start_time or None,
+        'end_time': end_time or None,
+        'is_available': is_available
+    }
+
+
+def date_error(value):
+    """Why `value` is not a YYYY-MM-DD date, or None if it is"""
+    try:
+        if not _DATE.match(value):
+            raise ValueError
+        datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return f'{value} is not a valid date; use YYYY-MM-DD'
+    return None
+
+
+def time_error(value):
+    """Why `value` is not an HH:MM time, or None if it is"""
+    if not isinstance(value, str) or not _TIME.match(value):
+        return f'{value} is not a valid time; use HH:MM'
+    return None
+
+
+def rule_error(rule):
+    """Why a weekly or override rule cannot be saved, or None if it can"""
+    if 'date' in rule:
+        error = date_error(rule['date'])
+        if error:
+            return error
+    elif rule['day_of_week'] not in range(7):
+        return 'Unknown day of the week'
+    start_time, end_time = rule.get('start_time'), rule.get('end_time')
+    if not start_time and not end_time and 'date' in rule:
+        return None
+    if not (start_time and end_time):
+        return 'Give both a start and an end time'
+    for value in (start_time, end_time):
+        error = time_error(value)
+        if error:
+            return error
+    if start_time >= end_time:
+        return f'The start time {start_time} must be before the end time {end_time}'
+    return None
+
+
+def new_schedule(doctor_id, weekly=None, overrides=None):
+    if weekly is None:
+        weekly = [weekly_rule(*hours) for hours in DEFAULT_WEEKLY_HOURS]
+    return {
+        'id': doctor_id,
+        'doctor_id': doctor_id,
+        'version': 1,
+        'updated_at': datetime.now().isoformat(),
+        'weekly': weekly,
+        'overrides': overrides or []
+    }
+
+
+def load_schedule(repository, doctor_id):
+    """Return the doctor's schedule, building it from legacy availability rows if needed"""
+    schedule = repository.load('schedules', doctor_id)
+    if schedule is not None:
+        return schedule
+    legacy = repository.filter('availability', {'doctor_id': doctor_id})
+    weekly = [{
+        'id': avail['id'],
+        'day_of_week': avail['day_of_week'],
+        'start_time': avail['start_time'],
+        'end_time': avail['end_time'],
+        'is_available': avail.get('is_available', True)
+    } for avail in legacy]
+    schedule = new_schedule(doctor_id, weekly=weekly)
+    schedule['version'] = 0
+    return schedule
+
+
+def _diff_rules(old_rules, new_rules, key):
+    old_by_key = {key(rule): rule for rule in old_rules}
+    new_keys = set()
+    kept, added = [], []
+    for rule in new_rules:
+        rule_key = key(rule)
+        if rule_key in new_keys:
+            continue
+        new_keys.add(rule_key)
+        if rule_key in old_by_key:
+            # Unchanged rules keep their identity across saves
+            kept.append(old_by_key[rule_key])
+        else:
+            added.append(rule)
+    removed = [rule for rule_key, rule in old_by_key.items() if rule_key not in new_keys]
+    return kept, added, removed
+
+
+def diff_schedule(old, weekly, overrides):
+    """Compare a stored schedule with submitted rules.
+
+    Returns a dict with the merged `weekly`/`overrides` lists and the
+    `added`/`removed` rules; `changed` is False when nothing differs.
+    """
+    weekly_kept, weekly_added, weekly_removed = _diff_rules(old['weekly'], weekly, _weekly_key)
+    override_kept, override_added, override_removed = _diff_rules(
+        old.get('overrides', []), overrides, _override_key)
+    added = weekly_added + override_added
+    removed = weekly_removed + override_removed
+    return {
+        'weekly': weekly_kept + weekly_added,
+        'overrides': override_kept + override_added,
+        'added': added,
+        'removed': removed,
+        'changed': bool(added or removed)
+    }
+
+
+def updated_schedule(old, diff):
+    """Build the next version of a schedule document from a diff"""
+    schedule = dict(old)
+    schedule['weekly'] = sorted(diff['weekly'], key=lambda r: (r['day_of_week'], r['start_time']))
+    schedule['overrides'] = sorted(diff['overrides'],
+                                   key=lambda r: (r['date'], r.get('start_time') or ''))
+    schedule['version'] = old['version'] + 1
+    schedule['updated_at'] = datetime.now().isoformat()
+    return schedule
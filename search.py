@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""In-process full-text index over doctor profiles.
+
+Every token of a doctor's name, specialization, location and bio points
+at the doctors carrying it, with a weight for the fields it came from.
+A query term matches tokens exactly, as a prefix, or within a small edit
+distance (found through a table of deletion variants, so typo lookups
+never scan the vocabulary); a doctor's score is the sum over query terms
+of its best match. Every term has to match for a doctor to be returned.
+"""
+import re
+import time
+import heapq
+import bisect
+import threading
+import unicodedata
+from itertools import combinations
+
+# Weight of a token by the field it was found in
+FIELD_WEIGHTS = {'full_name': 3.0, 'specialization': 2.0, 'location': 2.0, 'bio': 1.0}
+EXACT, PREFIX, FUZZY = 1.0, 0.75, 0.5
+# Prefix and typo candidates considered per query term; terms shorter
+# than MIN_PREFIX only match whole tokens
+MAX_EXPANSIONS = 32
+MIN_PREFIX = 2
+# A multi-word search that walks WALK_BUDGET doctors without finishing
+# scores every full match outright when there are at most DIRECT_SCORING
+DIRECT_SCORING = 1000
+WALK_BUDGET = 256
+_WORD = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """Lowercase `text` and strip accents, so 'Müller' matches 'muller'"""
+    text = text or ''
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    return _WORD.findall(normalize(text))
+
+
+def max_typos(token):
+    """Edit distance tolerated for a token of this length"""
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 8 else 2
+
+
+def deletions(token, distance):
+    """Every string made by removing up to `distance` characters"""
+    variants = set()
+    for n in range(1, distance + 1):
+        for positions in combinations(range(len(token)), n):
+            variants.add(''.join(c for i, c in enumerate(token) if i not in positions))
+    return variants
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance, or limit + 1 once it exceeds `limit`"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class _Index:
+    """The index data proper; DoctorSearchIndex swaps whole instances on rebuild"""
+
+    def __init__(self):
+        self.labels = {}        # doctor id -> (id, full_name, specialization, location)
+        self.names = {}         # doctor id -> normalized name, the tie-breaker
+        self.tokens = {}        # doctor id -> {token: weight}
+        self.weights = {}       # token -> {doctor id: weight}
+        self.ranked = {}        # token -> [(-weight, name, doctor id)], best first
+        self.vocabulary = []    # sorted tokens, for prefix ranges
+        self.variants = {}      # deletion variant -> tokens it came from
+
+    def add(self, doctor, ordered=True):
+        """Index a doctor; a bulk load passes ordered=False and calls `sort` once at the end"""
+        doctor_id = doctor['id']
+        if doctor_id in self.labels:
+            self.remove(doctor_id)
+        name = normalize(doctor.get('full_name'))
+        token_weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in set(tokenize(doctor.get(field))):
+                token_weights[token] = token_weights.get(token, 0.0) + weight
+        self.names[doctor_id] = name
+        self.labels[doctor_id] = (doctor_id, doctor.get('full_name'),
+                                  doctor.get('specialization'), doctor.get('location'))
+        self.tokens[doctor_id] = token_weights
+        for token, weight in token_weights.items():
+            postings = self.weights.get(token)
+            if postings is None:
+                postings = self.weights[token] = {}
+                self.ranked[token] = []
+                if ordered:
+                    bisect.insort(self.vocabulary, token)
+                else:
+                    self.vocabulary.append(token)
+                for variant in deletions(token, max_typos(token)) | {token}:
+                    self.variants.setdefault(variant, set()).add(token)
+            postings[doctor_id] = weight
+            if ordered:
+                bisect.insort(self.ranked[token], (-weight, name, doctor_id))
+            else:
+                self.ranked[token].append((-weight, name, doctor_id))
+
+    def sort(self):
+        self.vocabulary.sort()
+        for ranked in self.ranked.values():
+            ranked.sort()
+
+    def remove(self, doctor_id):
+        if self.labels.pop(doctor_id, None) is None:
+            return
+        name = self.names.pop(doctor_id)
+        for token, weight in self.tokens.pop(doctor_id).items():
+            postings = self.weights[token]
+            del postings[doctor_id]
+            ranked = self.ranked[token]
+            del ranked[bisect.bisect_left(ranked, (-weight, name, doctor_id))]
+            if not postings:
+                del self.weights[token], self.ranked[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+                for variant in deletions(token, max_typos(token)) | {token}:
+                    tokens = self.variants[variant]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self.variants[variant]
+
+    def completions(self, prefix):
+        """Vocabulary tokens starting with `prefix`, in order"""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        matches = []
+        for token in self.vocabulary[start:start + MAX_EXPANSIONS]:
+            if not token.startswith(prefix):
+                break
+            matches.append(token)
+        return matches
+
+    def expand(self, term):
+        """{token: factor} of the index tokens a query term matches"""
+        matches = {}
+        if term in self.weights:
+            matches[term] = EXACT
+        if len(term) >= MIN_PREFIX:
+            for token in self.completions(term):
+                matches.setdefault(token, PREFIX)
+        limit = max_typos(term)
+        if limit:
+            candidates = set()
+            for variant in deletions(term, limit) | {term}:
+                candidates.update(self.variants.get(variant, ()))
+            for token in sorted(candidates):
+                if token not in matches and edit_distance(term, token, limit) <= limit:
+                    matches[token] = FUZZY
+                    if len(matches) >= 2 * MAX_EXPANSIONS:
+                        break
+        return matches
+
+
+class DoctorSearchIndex:
+    """Thread-safe doctor search index, updated incrementally as doctors change.
+
+    `refresh` (re)builds it from storage when it is missing or older than a
+    given age. The index only knows the writes it is told about, through
+    `add` and `remove`; it lives in one process.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.built_at = None
+        self._clock = clock
+        self._index = _Index()
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._replay = None
+
+    def __len__(self):
+        return len(self._index.labels)
+
+    def refresh(self, load, max_age):
+        """Rebuild from `load()` (all doctor records) if the index is stale"""
+        if self.built_at is not None and self._clock() - self.built_at <= max_age:
+            return
+        with self._build_lock:
+            if self.built_at is not None and self._clock() - self.built_at <= max_age:
+                return
+            with self._lock:
+                # Writes during the build are replayed on top of it
+                self._replay = []
+            index = _Index()
+            for doctor in load():
+                index.add(doctor, ordered=False)
+            index.sort()
+            with self._lock:
+                for doctor_id, doctor in self._replay:
+                    if doctor is None:
+                        index.remove(doctor_id)
+                    else:
+                        index.add(doctor)
+                self._replay = None
+                self._index = index
+                self.built_at = self._clock()
+
+    def expire(self):
+        """Have the next `refresh` rebuild the index"""
+        self.built_at = None
+
+    def add(self, doctor):
+        """Index a new or edited doctor"""
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((doctor['id'], doctor))
+            self._index.add(doctor)
+
+    def remove(self, doctor_id):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((doctor_id, None))
+            self._index.remove(doctor_id)
+
+    def search(self, text, limit=10, specialization=None, location=None):
+        """Best matches for `text` as (label, score) pairs, highest score first.
+
+        A label is (id, full_name, specialization, location); results can be
+        narrowed to an exact specialization and/or location. Ties go to the
+        alphabetically first name.
+        """
+        terms = tokenize(text)
+        if not terms or limit <= 0:
+            return []
+        with self._lock:
+            index = self._index
+            expansions = [index.expand(term) for term in dict.fromkeys(terms)]
+            if len(terms[-1]) < MIN_PREFIX and not expansions[-1] and len(expansions) > 1:
+                # Still typing: a stray letter doesn't empty the results
+                expansions.pop()
+            if not all(expansions):
+                return []
+            return self._top(index, expansions, limit, specialization, location)
+
+    @staticmethod
+    def _top(index, expansions, limit, specialization, location):
+        def size(matches):
+            return sum(len(index.weights[token]) for token in matches)
+        rarest, *others = sorted(expansions, key=size)
+
+        def score(doctor_id, total):
+            """`total` plus the other terms' best scores, or None if one doesn't match"""
+            for matches in others:
+                best = max(index.weights[token].get(doctor_id, 0.0) * factor
+                           for token, factor in matches.items())
+                if not best:
+                    return None
+                total += best
+            label = index.labels[doctor_id]
+            if ((specialization and label[2] != specialization)
+                    or (location and label[3] != location)):
+                return None
+            return total
+
+        # Walk the rarest term's doctors best first, looking the other terms
+        # up per doctor, and stop once even a perfect match on the other
+        # terms could not enter the top `limit`. Each token's postings are
+        # sorted best first, so merging them yields every doctor at its best
+        # score before any lower one.
+        ceiling = sum(max(-index.ranked[token][0][0] * factor for token, factor in matches.items())
+                      for matches in others)
+        walk = heapq.merge(*[((negative * factor, name, doctor_id)
+                              for negative, name, doctor_id in index.ranked[token])
+                             for token, factor in rarest.items()])
+        best = []
+        seen = set()
+        candidates = None
+        for step, (negative, name, doctor_id) in enumerate(walk):
+            if len(best) >= limit and (negative - ceiling, name, doctor_id) >= best[-1]:
+                break
+            if step == WALK_BUDGET and others:
+                # A long walk means few doctors match every term; find them
+                # with set intersections and, if few enough, score them all
+                candidates = set()
+                for token in rarest:
+                    candidates.update(index.weights[token])
+                for matches in others:
+                    candidates = set().union(*(candidates & index.weights[token].keys()
+                                               for token in matches))
+                if len(candidates) <= DIRECT_SCORING:
+                    scored = []
+                    for candidate in candidates:
+                        total = score(candidate, max(
+                            index.weights[token].get(candidate, 0.0) * factor
+                            for token, factor in rarest.items()))
+                        if total is not None:
+                            scored.append((-total, index.names[candidate], candidate))
+                    best = heapq.nsmallest(limit, scored)
+                    break
+            if doctor_id in seen or (candidates is not None and doctor_id not in candidates):
+                continue
+            seen.add(doctor_id)
+            total = score(doctor_id, -negative)
+            if total is not None:
+                bisect.insort(best, (-total, name, doctor_id))
+                del best[limit:]
+        return [(index.labels[doctor_id], -negative) for negative, _, doctor_id in best]
+
+    def complete(self, text, limit=5):
+        """Whole words completing the last word of `text`, most common first"""
+        terms = tokenize(text)
+        if not terms or text[-1:].isspace():
+            return []
+        with self._lock:
+            index = self._index
+            tokens = index.completions(terms[-1])
+            return heapq.nlargest(limit, tokens, key=lambda token: len(index.weights[token]))
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Server-side sessions.
+
+The session cookie only carries a random session id; the session data
+lives in a store, keyed by a hash of that id so a leaked store cannot be
+replayed as cookies. `MemorySessionStore` is a bounded LRU for a single
+process, `SQLiteSessionStore` a shared file for several workers.
+
+Expiry slides: a session lives for `lifetime` seconds after it was last
+used. To keep reads cheap the expiry is only pushed back once at least
+`refresh_interval` seconds have passed since the last push, so a busy
+session costs one store write a minute rather than one per request.
+Expired sessions are dropped on read and by batched sweeps.
+"""
+import os
+import time
+import hashlib
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+
+def session_key(sid):
+    return hashlib.sha256(sid.encode('utf-8')).hexdigest()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data plus the id and expiry of its store record"""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = sid is None
+        self.modified = False
+        self.rotated = None
+
+    def regenerate(self):
+        """Move the session to a fresh id, e.g. on login against session fixation"""
+        if self.sid is not None and self.rotated is None:
+            self.rotated = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class MemorySessionStore:
+    """In-process sessions, least recently used first.
+
+    Every session has the same lifetime, so the LRU order is also expiry
+    order and a sweep only looks at sessions that have actually expired.
+    """
+
+    def __init__(self, maxsize=100000, clock=time.time):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data = OrderedDict()  # key -> [expires, data, user_id]
+        self._users = {}            # user id -> keys of its sessions
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """(data, expires) of a live session, or None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self._clock():
+                self._remove(key)
+                return None
+            return entry[1], entry[0]
+
+    def set(self, key, data, expires, user_id=None):
+        with self._lock:
+            previous = self._data.get(key)
+            if previous is not None and previous[2] != user_id:
+                self._unlink(key, previous[2])
+            self._data[key] = [expires, data, user_id]
+            self._data.move_to_end(key)
+            if user_id is not None:
+                self._users.setdefault(user_id, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def touch(self, key, expires):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                entry[0] = expires
+                self._data.move_to_end(key)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def revoke_user(self, user_id):
+        """End every session of `user_id`; returns how many there were"""
+        with self._lock:
+            keys = self._users.pop(user_id, ())
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def sweep(self, limit=1000):
+        """Drop up to `limit` expired sessions; returns how many were dropped"""
+        now = self._clock()
+        removed = 0
+        with self._lock:
+            while removed < limit and self._data:
+                key, entry = next(iter(self._data.items()))
+                if entry[0] > now:
+                    break
+                self._remove(key)
+                removed += 1
+        return removed
+
+    def _remove(self, key):
+        _, _, user_id = self._data.pop(key)
+        self._unlink(key, user_id)
+
+    def _unlink(self, key, user_id):
+        keys = self._users.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._users[user_id]
+
+
+class SQLiteSessionStore:
+    """Sessions in a SQLite file shared by every worker on the host"""
+
+    def __init__(self, path='data/sessions.sqlite3', clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                         '(key TEXT PRIMARY KEY, user_id TEXT, expires REAL NOT NULL, '
+                         'data TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection must never be shared with a forked child process
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT data, expires FROM sessions WHERE key = ? AND expires > ?',
+            (key, self._clock())).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, key, data, expires, user_id=None):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (key, user_id, expires, data) '
+                         'VALUES (?, ?, ?, ?)', (key, user_id, expires, data))
+
+    def touch(self, key, expires):
+        with self._connection() as conn:
+            conn.execute('UPDATE sessions SET expires = ? WHERE key = ?', (expires, key))
+
+    def delete(self, key):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def revoke_user(self, user_id):
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,)).rowcount
+
+    def sweep(self, limit=1000):
+        with self._connection() as conn:
+            return conn.execute('DELETE FROM sessions WHERE key IN '
+                                '(SELECT key FROM sessions WHERE expires <= ? LIMIT ?)',
+                                (self._clock(), limit)).rowcount
+
+
+def create_session_store(kind='memory', path=None, maxsize=100000):
+    if kind == 'memory':
+        return MemorySessionStore(maxsize)
+    if kind == 'sqlite':
+        return SQLiteSessionStore(path or 'data/sessions.sqlite3')
+    raise ValueError(f'Unknown session store: {kind}')
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface over a session store.
+
+    One store read per request opens the session; requests without a
+    session cookie never touch the store. Every `sweep_interval` seconds
+    a request also sweeps up to `sweep_batch` expired sessions.
+    """
+
+    serializer = session_json_serializer
+
+    def __init__(self, store, refresh_interval=60, sweep_interval=60, sweep_batch=1000,
+                 clock=time.time):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._clock = clock
+        self._next_sweep = clock() + sweep_interval
+
+    def lifetime(self, app):
+        return app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            record = self.store.get(session_key(sid))
+            if record is not None:
+                data, expires = record
+                try:
+                    return ServerSession(self.serializer.loads(data), sid, expires)
+                except ValueError:
+                    pass
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = self._clock()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.store.sweep(self.sweep_batch)
+        if session.rotated is not None:
+            self.store.delete(session_key(session.rotated))
+            session.rotated = None
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session_key(session.sid))
+            if not session.new:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Reads of the session vary the response even when it is unchanged
+        if session.accessed:
+            response.vary.add('Cookie')
+        expires = now + self.lifetime(app)
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            session.new = True
+        if session.modified or session.new:
+            self.store.set(session_key(session.sid), self.serializer.dumps(dict(session)),
+                           expires, session.get('user_id'))
+        elif session.expires is not None and expires - session.expires >= self.refresh_interval:
+            self.store.touch(session_key(session.sid), expires)
+        else:
+            return
+        session.expires = expires
+        if session.new or session.permanent:
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Bitmap slot engine.
+
+A doctor's day is a row of fixed-width slots. Bit ``i`` of a mask stands
+for the slot starting ``i * slot_minutes`` after midnight, so a weekly
+schedule is seven integers and a day's bookings are one more; the free
+slots are ``weekly[day_of_week] & ~booked``.
+"""
+import heapq
+import logging
+import threading
+from datetime import date as date_type, timedelta
+from functools import lru_cache
+
+from schedules import load_schedule
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def to_minutes(hhmm):
+    """Convert an 'HH:MM' string to minutes after midnight"""
+    hours, minutes = hhmm.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+@lru_cache(maxsize=None)
+def slot_labels(slot_minutes):
+    """Return the 'HH:MM' label of every slot in a day"""
+    return tuple(f'{m // 60:02d}:{m % 60:02d}'
+                 for m in range(0, MINUTES_PER_DAY - slot_minutes + 1, slot_minutes))
+
+
+def window_mask(start_time, end_time, slot_minutes):
+    """Mask of the slots that fit entirely inside [start_time, end_time)"""
+    first = -(-to_minutes(start_time) // slot_minutes)
+    last = min(to_minutes(end_time) // slot_minutes, len(slot_labels(slot_minutes)))
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def booking_mask(time, slot_minutes):
+    """Mask of the slots overlapped by a booking starting at `time`"""
+    start = to_minutes(time)
+    first = start // slot_minutes
+    last = -(-(start + slot_minutes) // slot_minutes)
+    last = min(last, len(slot_labels(slot_minutes)))
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def mask_from(minute, slot_minutes):
+    """Mask of every slot starting at or after `minute`"""
+    first = -(-minute // slot_minutes)
+    return ~((1 << first) - 1) if first > 0 else -1
+
+
+def mask_to_times(mask, slot_minutes):
+    """List the 'HH:MM' labels of the set bits of `mask`, in order"""
+    labels = slot_labels(slot_minutes)
+    times = []
+    while mask:
+        low = mask & -mask
+        times.append(labels[low.bit_length() - 1])
+        mask ^= low
+    return times
+
+
+class SlotEngine:
+    """Serve free slots from per-doctor schedule masks and per-day booking masks.
+
+    A doctor's schedule is turned into seven weekly masks plus one mask per
+    date override, built once and kept until the schedule changes. Booking
+    masks come from the repository's (doctor_id, date, status) index on
+    every call, so they are never stale. Cached plans are checked against
+    the repository on use, so schedule writes from other processes drop
+    them too.
+    """
+
+    def __init__(self, repository, slot_minutes=30, cache=True):
+        if slot_minutes <= 0 or MINUTES_PER_DAY % slot_minutes:
+            raise ValueError('slot_minutes must divide a day evenly')
+        self.repository = repository
+        self.slot_minutes = slot_minutes
+        self.cache = cache
+        self._plans = {}
+        self._lock = threading.Lock()
+        if cache:
+            repository.add_listener(lambda data_type, data_id, data: self.invalidate(data_type, data))
+
+    def _plan(self, doctor_id):
+        """(weekly masks, {date: (open mask or None, blocked mask)}) for a doctor"""
+        if self.cache:
+            # Hands schedule writes from other processes to the listener above
+            self.repository.refresh('schedules')
+            self.repository.refresh('availability')
+        plan = self._plans.get(doctor_id)
+        if plan is not None:
+            return plan
+        schedule = load_schedule(self.repository, doctor_id)
+        weekly = [0] * 7
+        for rule in schedule['weekly']:
+            if rule.get('is_available', True):
+                weekly[rule['day_of_week']] |= window_mask(
+                    rule['start_time'], rule['end_time'], self.slot_minutes)
+        overrides = {}
+        full_day = (1 << len(slot_labels(self.slot_minutes))) - 1
+        for rule in schedule.get('overrides', []):
+            opened, blocked = overrides.get(rule['date'], (None, 0))
+            if rule.get('start_time') and rule.get('end_time'):
+                mask = window_mask(rule['start_time'], rule['end_time'], self.slot_minutes)
+            else:
+                mask = full_day
+            if rule.get('is_available'):
+                opened = (opened or 0) | mask
+            else:
+                blocked |= mask
+            overrides[rule['date']] = (opened, blocked)
+        plan = (weekly, overrides)
+        if self.cache:
+            with self._lock:
+                self._plans[doctor_id] = plan
+        return plan
+
+    def weekly_masks(self, doctor_id):
+        """Seven masks, Monday first, of the doctor's recurring working slots"""
+        return self._plan(doctor_id)[0]
+
+    def _working(self, plan, date, day_of_week):
+        weekly, overrides = plan
+        override = overrides.get(date)
+        if override is None:
+            return weekly[day_of_week]
+        opened, blocked = override
+        return (weekly[day_of_week] if opened is None else opened) & ~blocked
+
+    def working_mask(self, doctor_id, date, day_of_week=None):
+        """Mask of the doctor's working slots on an ISO date, overrides applied"""
+        if day_of_week is None:
+            day_of_week = date_type.fromisoformat(date).weekday()
+        return self._working(self._plan(doctor_id), date, day_of_week)
+
+    def working_counts(self, doctor_id):
+        """(working slots per weekday, {date ordinal: change from the weekday's count})"""
+        plan = self._plan(doctor_id)
+        weekly = [bin(mask).count('1') for mask in plan[0]]
+        overrides = {}
+        for date in plan[1]:
+            day = date_type.fromisoformat(date)
+            change = bin(self._working(plan, date, day.weekday())).count('1') - weekly[day.weekday()]
+            if change:
+                overrides[day.toordinal()] = change
+        return weekly, overrides
+
+    def _working_days(self, doctor_id, start_date, days):
+        """Yield (iso_date, working mask) for the days in range with working slots"""
+        plan = self._plan(doctor_id)
+        weekly, overrides = plan
+        if not any(weekly) and not overrides:
+            return
+        first_weekday = start_date.weekday()
+        for i in range(days):
+            day_of_week = (first_weekday + i) % 7
+            if not weekly[day_of_week] and not overrides:
+                continue
+            day = (start_date + timedelta(days=i)).isoformat()
+            working = self._working(plan, day, day_of_week)
+            if working:
+                yield day, working
+
+    def booked_mask(self, doctor_id, date):
+        """Mask of the booked slots; appointments with an unreadable time are skipped"""
+        mask = 0
+        for appt in self.repository.filter('appointments', {
+            'doctor_id': doctor_id,
+            'date': date,
+            'status': 'booked'
+        }):
+            try:
+                mask |= booking_mask(appt.get('time'), self.slot_minutes)
+            except (AttributeError, TypeError, ValueError):
+                logger.warning('Ignoring appointment %s: unreadable time %r',
+                               appt.get('id'), appt.get('time'))
+        return mask
+
+    def free_mask(self, doctor_id, date, day_of_week=None):
+        working = self.working_mask(doctor_id, date, day_of_week)
+        if not working:
+            return 0
+        return working & ~self.booked_mask(doctor_id, date)
+
+    def free_slots(self, doctor_id, date, day_of_week=None):
+        """Free 'HH:MM' slot times for a doctor on an ISO date"""
+        return mask_to_times(self.free_mask(doctor_id, date, day_of_week), self.slot_minutes)
+
+    def free_slots_range(self, doctor_id, start_date, days):
+        """Yield (iso_date, times) for each day with free slots.
+
+        `start_date` is a `datetime.date`; the doctor's schedule masks are
+        fetched once for the whole range.
+        """
+        for day, working in self._working_days(doctor_id, start_date, days):
+            free = working & ~self.booked_mask(doctor_id, day)
+            if free:
+                yield day, mask_to_times(free, self.slot_minutes)
+
+    def _first_working_slot(self, doctor_id, start_date, days, first_minute):
+        """Earliest working slot ignoring bookings: a lower bound on the first free one"""
+        today = start_date.isoformat()
+        for day, working in self._working_days(doctor_id, start_date, days):
+            if day == today:
+                working &= mask_from(first_minute, self.slot_minutes)
+            if working:
+                return day, mask_to_times(working & -working, self.slot_minutes)[0]
+        return None
+
+    def _iter_free(self, doctor_id, start_date, days, first_minute):
+        today = start_date.isoformat()
+        cutoff = f'{first_minute // 60:02d}:{first_minute % 60:02d}'
+        for day, times in self.free_slots_range(doctor_id, start_date, days):
+            for time in times:
+                if day != today or time >= cutoff:
+                    yield day, time
+
+    def earliest_slots(self, doctor_ids, start_date, days=30, limit=10, first_minute=0):
+        """Return the `limit` earliest free (doctor_id, date, time) tuples.
+
+        Every doctor enters a heap keyed on their first *working* slot, which
+        only needs the cached schedule masks. Bookings are looked up when a
+        doctor reaches the top of the heap, so the work done is roughly
+        proportional to `limit`, not to the number of doctors.
+        `first_minute` hides slots earlier than that on `start_date`.
+        """
+        heap = []
+        for order, doctor_id in enumerate(doctor_ids):
+            bound = self._first_working_slot(doctor_id, start_date, days, first_minute)
+            if bound is not None:
+                heap.append((bound[0], bound[1], order, doctor_id, None))
+        heapq.heapify(heap)
+
+        results = []
+        while heap and len(results) < limit:
+            day, time, order, doctor_id, slots = heapq.heappop(heap)
+            if slots is None:
+                # Lower bound reached the top; switch to the real free slots
+                slots = self._iter_free(doctor_id, start_date, days, first_minute)
+            else:
+                results.append((doctor_id, day, time))
+            following = next(slots, None)
+            if following is not None:
+                heapq.heappush(heap, (following[0], following[1], order, doctor_id, slots))
+        return results
+
+    def invalidate(self, data_type, data=None):
+        """Forget cached masks affected by a write to `data_type`"""
+        if data_type not in ('availability', 'schedules'):
+            return
+        with self._lock:
+            if data and data.get('doctor_id'):
+                self._plans.pop(data['doctor_id'], None)
+            else:
+                self._plans.clear()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped snapshot of JSON collections and their indexes.
+
+A cold JSON repository has to open and parse every file of a collection
+before it can answer a query. A snapshot stores the parsed indexes plus
+each record's JSON in one file, so a fresh process maps it and only
+decodes the records it actually touches:
+
+    MSNAP1\\n | header length (8 bytes, big endian) | header JSON | record bytes
+
+The header holds, per collection, the `(offset, length)` of every record
+(relative to the start of the record bytes), the secondary and sorted
+indexes, and the collection directory's mtime. Every write to a
+collection replaces a file in that directory, so a changed mtime marks
+the collection stale and it is read from disk again.
+"""
+import os
+import json
+import mmap
+import struct
+import logging
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MSNAP1\n'
+_LENGTH = struct.Struct('>Q')
+
+
+def _dir_mtime(data_dir, data_type):
+    try:
+        return os.stat(os.path.join(data_dir, data_type)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class SnapshotRecords(MutableMapping):
+    """Record mapping backed by the snapshot; records are decoded on first access"""
+
+    def __init__(self, buffer, base, offsets):
+        self._buffer = buffer
+        self._base = base
+        self._offsets = offsets
+        self._decoded = {}
+        self._removed = set()
+
+    def __getitem__(self, data_id):
+        item = self._decoded.get(data_id)
+        if item is not None:
+            return item
+        if data_id in self._removed:
+            raise KeyError(data_id)
+        offset, length = self._offsets[data_id]
+        offset += self._base
+        item = self._decoded[data_id] = json.loads(self._buffer[offset:offset + length])
+        return item
+
+    def __setitem__(self, data_id, item):
+        self._decoded[data_id] = item
+        self._removed.discard(data_id)
+
+    def __delitem__(self, data_id):
+        if data_id not in self:
+            raise KeyError(data_id)
+        self._decoded.pop(data_id, None)
+        self._removed.add(data_id)
+
+    def __contains__(self, data_id):
+        if data_id in self._decoded:
+            return True
+        return data_id in self._offsets and data_id not in self._removed
+
+    def __iter__(self):
+        for data_id in self._offsets:
+            if data_id not in self._removed:
+                yield data_id
+        for data_id in self._decoded:
+            if data_id not in self._offsets:
+                yield data_id
+
+    def __len__(self):
+        added = sum(1 for data_id in self._decoded if data_id not in self._offsets)
+        return len(self._offsets) - len(self._removed) + added
+
+
+class Snapshot:
+    """An opened snapshot file; `load` hands out one collection at a time"""
+
+    def __init__(self, path, buffer, base, header):
+        self.path = path
+        self._buffer = buffer
+        self._base = base
+        self._header = header
+
+    @classmethod
+    def open(cls, path):
+        """Map the snapshot at `path`, or return None if it is missing or unreadable"""
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        start = len(MAGIC) + _LENGTH.size
+        if buffer[:len(MAGIC)] != MAGIC:
+            logger.warning('Ignoring %s: not a snapshot file', path)
+            return None
+        (header_length,) = _LENGTH.unpack(buffer[len(MAGIC):start])
+        try:
+            header = json.loads(buffer[start:start + header_length])
+        except ValueError:
+            logger.warning('Ignoring %s: corrupt header', path)
+            return None
+        return cls(path, buffer, start + header_length, header)
+
+    def collections(self):
+        return list(self._header['collections'])
+
+    def load(self, data_type, data_dir, indexes, sorted_indexes):
+        """(records, index data, sorted data) for a collection, or None if stale.
+
+        `indexes` and `sorted_indexes` are the repository's definitions for
+        the collection; a snapshot built with different ones is not used.
+        """
+        entry = self._header['collections'].get(data_type)
+        if entry is None or entry['mtime'] != _dir_mtime(data_dir, data_type):
+            return None
+        index_fields = [list(fields) for fields in indexes]
+        if [fields for fields, _ in entry['indexes']] != index_fields:
+            return None
+        if {field: list(order_by) for field, order_by in sorted_indexes.items()} != entry['sorted_by']:
+            return None
+        records = SnapshotRecords(self._buffer, self._base, entry['records'])
+        index_data = {tuple(fields): {tuple(key): set(ids) for key, ids in values}
+                      for fields, values in entry['indexes']}
+        sorted_data = {field: {value: [tuple(sort_key) for sort_key in entries]
+                               for value, entries in values}
+                       for field, values in entry['sorted'].items()}
+        return records, index_data, sorted_data
+
+
+def write_snapshot(repository, path, collections):
+    """Snapshot `collections` of a JSON `Repository` to `path`; returns record counts"""
+    header = {'collections': {}}
+    body = []
+    offset = 0
+    counts = {}
+    for data_type in collections:
+        if data_type in repository.partitioned:
+            # Read a partition at a time already; one directory mtime
+            # could not tell when they go stale
+            continue
+        # Taken before reading so a write during the scan leaves it stale
+        mtime = _dir_mtime(repository.data_dir, data_type)
+        if mtime is None:
+            continue
+        repository.invalidate(data_type)
+        records = repository._collection(data_type)
+        with repository._lock:
+            offsets = {}
+            for data_id, item in records.items():
+                encoded = json.dumps(item, separators=(',', ':')).encode('utf-8')
+                offsets[data_id] = (offset, len(encoded))
+                body.append(encoded)
+                offset += len(encoded)
+            header['collections'][data_type] = {
+                'mtime': mtime,
+                'records': offsets,
+                'indexes': [[list(fields), [[list(key), sorted(ids)] for key, ids in index.items()]]
+                            for fields, index in repository._index_data[data_type].items()],
+                'sorted_by': {field: list(order_by) for field, order_by
+                              in repository.sorted_indexes.get(data_type, {}).items()},
+                'sorted': {field: [[value, entries] for value, entries in index.items()]
+                           for field, index in repository._sorted_data[data_type].items()},
+            }
+        counts[data_type] = len(offsets)
+    encoded_header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_LENGTH.pack(len(encoded_header)))
+        f.write(encoded_header)
+        for encoded in body:
+            f.write(encoded)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return counts
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import logging
+import sqlite3
+import threading
+
+from metrics import record_io
+from repository import INDEXES, SORTED_INDEXES, PARTITIONED
+
+logger = logging.getLogger(__name__)
+
+# Fields copied out of the JSON document into real columns so SQLite can
+# filter and index them. Every other field lives only in the `data` blob.
+COLUMNS = {
+    'patients': ['email'],
+    'doctors': ['email', 'specialization', 'location'],
+    'appointments': ['doctor_id', 'patient_id', 'date', 'time', 'status'],
+    'availability': ['doctor_id', 'day_of_week', 'is_available'],
+    'schedules': ['doctor_id'],
+}
+
+# At most one booked appointment per doctor slot, enforced by SQLite itself
+BOOKED_SLOT_INDEX = ('CREATE UNIQUE INDEX IF NOT EXISTS "uniq_appointments_booked_slot" '
+                     'ON "appointments" ("doctor_id", "date", "time") '
+                     "WHERE \"status\" = 'booked'")
+
+COLLECTIONS = ['patients', 'doctors', 'appointments', 'availability', 'schedules']
+
+
+def _decode(data):
+    record_io(nbytes=len(data))
+    return json.loads(data)
+
+
+def _is_placeholder(filename):
+    """Template files such as `{doctor_id}.json` are checked in as examples"""
+    return filename.startswith('{')
+
+
+class SQLiteRepository:
+    """SQLite storage with the same interface as `repository.Repository`.
+
+    Each collection is a table holding the JSON document plus the queried
+    fields as indexed columns. Connections are per thread and the database
+    runs in WAL mode so readers never block the writer.
+    """
+
+    def __init__(self, path='data/medislot.sqlite3', columns=None):
+        self.path = path
+        self.columns = COLUMNS if columns is None else columns
+        self._local = threading.local()
+        self._tables = set()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection must never be shared with a forked child process
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            record_io(files=1)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _ensure_table(self, data_type):
+        if data_type in self._tables:
+            return
+        with self._lock:
+            if data_type in self._tables:
+                return
+            columns = self.columns.get(data_type, [])
+            column_sql = ''.join(f', "{column}"' for column in columns)
+            conn = self._connection()
+            with conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{data_type}" '
+                             f'(id TEXT PRIMARY KEY{column_sql}, data TEXT NOT NULL)')
+                for fields in INDEXES.get(data_type, []):
+                    if all(field in columns for field in fields):
+                        name = f'idx_{data_type}_' + '_'.join(fields)
+                        field_sql = ', '.join(f'"{field}"' for field in fields)
+                        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" '
+                                     f'ON "{data_type}" ({field_sql})')
+                for field, order_by in SORTED_INDEXES.get(data_type, {}).items():
+                    fields = (field,) + order_by
+                    if all(f in columns for f in fields):
+                        name = f'idx_{data_type}_' + '_'.join(fields) + '_sorted'
+                        field_sql = ', '.join(f'"{f}"' for f in fields)
+                        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" '
+                                     f'ON "{data_type}" ({field_sql}, id)')
+            if data_type == 'appointments':
+                try:
+                    with conn:
+                        conn.execute(BOOKED_SLOT_INDEX)
+                except sqlite3.IntegrityError:
+                    logger.warning('appointments contain double-booked slots; '
+                                   'the booked-slot unique index was not created')
+            self._tables.add(data_type)
+
+    def _row(self, data_type, data_id, data):
+        values = [data.get(column) for column in self.columns.get(data_type, [])]
+        return [data_id] + values + [json.dumps(data)]
+
+    def _insert_sql(self, data_type, upsert=True):
+        columns = ['id'] + self.columns.get(data_type, []) + ['data']
+        placeholders = ', '.join('?' for _ in columns)
+        column_sql = ', '.join(f'"{column}"' for column in columns)
+        sql = f'INSERT INTO "{data_type}" ({column_sql}) VALUES ({placeholders})'
+        if upsert:
+            # An upsert, unlike INSERT OR REPLACE, fails on a unique-index
+            # conflict instead of silently deleting the other row
+            updates = ', '.join(f'"{column}" = excluded."{column}"' for column in columns[1:])
+            sql += f' ON CONFLICT(id) DO UPDATE SET {updates}'
+        return sql
+
+    def save(self, data_type, data_id, data):
+        self._ensure_table(data_type)
+        conn = self._connection()
+        with conn:
+            conn.execute(self._insert_sql(data_type), self._row(data_type, data_id, data))
+
+    def save_many(self, data_type, items):
+        """Insert `(data_id, data)` pairs in a single transaction"""
+        self._ensure_table(data_type)
+        conn = self._connection()
+        with conn:
+            conn.executemany(self._insert_sql(data_type),
+                             (self._row(data_type, data_id, data) for data_id, data in items))
+
+    def book_slot(self, appointment):
+        """Insert a booked appointment unless its slot is already taken.
+
+        Returns True when the appointment was stored, False on a conflict.
+        """
+        self._ensure_table('appointments')
+        conn = self._connection()
+        try:
+            with conn:
+                conn.execute(self._insert_sql('appointments', upsert=False),
+                             self._row('appointments', appointment['id'], appointment))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def delete(self, data_type, data_id):
+        self._ensure_table(data_type)
+        conn = self._connection()
+        with conn:
+            conn.execute(f'DELETE FROM "{data_type}" WHERE id = ?', (data_id,))
+
+    def load(self, data_type, data_id):
+        self._ensure_table(data_type)
+        row = self._connection().execute(
+            f'SELECT data FROM "{data_type}" WHERE id = ?', (data_id,)).fetchone()
+        return _decode(row[0]) if row else None
+
+    def load_all(self, data_type):
+        self._ensure_table(data_type)
+        rows = self._connection().execute(f'SELECT data FROM "{data_type}"')
+        return [_decode(row[0]) for row in rows]
+
+    def scan(self, data_type, archived=False):
+        """Yield a table's records row by row; there is no archive here"""
+        self._ensure_table(data_type)
+        for row in self._connection().execute(f'SELECT data FROM "{data_type}"'):
+            yield _decode(row[0])
+
+    def find(self, data_type, field, value):
+        results = self.filter(data_type, {field: value}, limit=1)
+        return results[0] if results else None
+
+    def filter(self, data_type, filters, limit=None):
+        self._ensure_table(data_type)
+        columns = self.columns.get(data_type, [])
+        clauses = []
+        params = []
+        remaining = {}
+        for field, value in filters.items():
+            if field not in columns:
+                remaining[field] = value
+            elif value is None:
+                clauses.append(f'"{field}" IS NULL')
+            else:
+                clauses.append(f'"{field}" = ?')
+                params.append(value)
+        sql = f'SELECT data FROM "{data_type}"'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if limit is not None and not remaining:
+            sql += f' LIMIT {int(limit)}'
+        results = []
+        for row in self._connection().execute(sql, params):
+            item = _decode(row[0])
+            if all(item.get(field) == value for field, value in remaining.items()):
+                results.append(item)
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    def load_many(self, data_type, data_ids, chunk_size=500):
+        """Load several records at once; returns a dict keyed by id"""
+        self._ensure_table(data_type)
+        data_ids = list(set(data_ids))
+        results = {}
+        conn = self._connection()
+        for i in range(0, len(data_ids), chunk_size):
+            chunk = data_ids[i:i + chunk_size]
+            placeholders = ', '.join('?' for _ in chunk)
+            for data_id, data in conn.execute(
+                    f'SELECT id, data FROM "{data_type}" WHERE id IN ({placeholders})', chunk):
+                results[data_id] = _decode(data)
+        return results
+
+    def ordered(self, data_type, field, value, start=None, reverse=False,
+                limit=None, predicate=None):
+        """Records with `field == value` in sort-index order.
+
+        Same contract as `Repository.ordered`; rows are read lazily from an
+        index-ordered cursor so the scan stops at `limit`.
+        """
+        self._ensure_table(data_type)
+        order_by = [f'"{f}"' for f in SORTED_INDEXES[data_type][field]] + ['id']
+        sql = f'SELECT data FROM "{data_type}" WHERE "{field}" = ?'
+        params = [value]
+        if start:
+            bound = order_by[:len(start)]
+            sql += f' AND ({", ".join(bound)}) {"<" if reverse else ">="} ({", ".join("?" for _ in bound)})'
+            params.extend(start)
+        direction = ' DESC' if reverse else ''
+        sql += ' ORDER BY ' + ', '.join(column + direction for column in order_by)
+        results = []
+        for row in self._connection().execute(sql, params):
+            item = _decode(row[0])
+            if predicate is not None and not predicate(item):
+                continue
+            results.append(item)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def invalidate(self, data_type=None):
+        """Nothing is cached in-process; kept for interface parity"""
+
+    def add_listener(self, callback):
+        """Every read goes to the database, so there is nothing to hear about"""
+
+    def refresh(self, data_type):
+        """Reads always see other processes' writes; kept for interface parity"""
+
+
+def iter_json_records(data_dir, data_type):
+    """Yield `(data_id, data)` for every valid JSON file of a collection"""
+    directory = os.path.join(data_dir, data_type)
+    if data_type in PARTITIONED:
+        from partitions import PartitionStore
+        yield from PartitionStore(directory).records()
+        return
+    if not os.path.isdir(directory):
+        return
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.json') or _is_placeholder(entry.name):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if data:
+                yield entry.name[:-5], data
+
+
+def _import_batch(store, data_type, batch):
+    """Write a batch, falling back to row-by-row when a row conflicts.
+
+    Returns the number of rows skipped because they double-book a slot.
+    """
+    try:
+        store.save_many(data_type, batch)
+        return 0
+    except sqlite3.IntegrityError:
+        skipped = 0
+        for data_id, data in batch:
+            try:
+                store.save(data_type, data_id, data)
+            except sqlite3.IntegrityError:
+                skipped += 1
+        return skipped
+
+
+def migrate_json(data_dir, store, batch_size=1000, collections=None):
+    """Stream the JSON tree under `data_dir` into `store` in batches.
+
+    Returns the number of records imported per collection.
+    """
+    counts = {}
+    for data_type in collections or COLLECTIONS:
+        count = 0
+        batch = []
+        for data_id, data in iter_json_records(data_dir, data_type):
+            batch.append((data_id, data))
+            if len(batch) >= batch_size:
+                count += len(batch) - _import_batch(store, data_type, batch)
+                batch = []
+        if batch:
+            count += len(batch) - _import_batch(store, data_type, batch)
+        counts[data_type] = count
+    return counts
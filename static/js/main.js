@@ -1,3 +1,94 @@
+// Slots are fetched two weeks at a time through the batch API and cached
+// per doctor, so changing the date usually needs no round trip.
+const SLOT_PREFETCH_DAYS = 14;
+const slotCache = {};
+
+function fetchSlots(doctorId, date) {
+    const cache = slotCache[doctorId] || (slotCache[doctorId] = {});
+    if (!(date in cache)) {
+        const request = fetch(`/api/slots?doctor_id=${doctorId}&start=${date}&days=${SLOT_PREFETCH_DAYS}`)
+            .then(response => response.json())
+            .then(data => (data.doctors && data.doctors[doctorId]) || {});
+        const start = new Date(date + 'T00:00:00Z');
+        for (let i = 0; i < SLOT_PREFETCH_DAYS; i++) {
+            const day = new Date(start.getTime() + i * 86400000).toISOString().split('T')[0];
+            cache[day] = request.then(days => days[day] || []);
+        }
+    }
+    return cache[date].then(slots => ({slots: slots}));
+}
+window.fetchSlots = fetchSlots;
+
+// The selected doctor-day is followed so slots booked by someone else
+// disappear without a reload: over server-sent events when `live` (the
+// server streams them), otherwise by polling every SLOT_POLL_SECONDS while
+// the page is visible. One doctor-day is followed at a time; every
+// listener gets {slots: [...]} on each change.
+const SLOT_POLL_SECONDS = 30;
+let slotStream = null;
+
+function stopWatchingSlots() {
+    if (slotStream) {
+        if (slotStream.source) {
+            slotStream.source.close();
+        }
+        clearInterval(slotStream.timer);
+        slotStream = null;
+    }
+}
+
+function watchSlots(doctorId, date, onSlots, live) {
+    const key = `${doctorId}|${date}`;
+    if (!slotStream || slotStream.key !== key) {
+        stopWatchingSlots();
+        const stream = slotStream = {key: key, listeners: [], slots: null};
+        const publish = slots => {
+            stream.slots = slots;
+            (slotCache[doctorId] || (slotCache[doctorId] = {}))[date] = Promise.resolve(slots);
+            stream.listeners.forEach(listener => listener({slots: slots}));
+        };
+        if (!live || !window.EventSource) {
+            stream.timer = setInterval(() => {
+                if (document.hidden) {
+                    return;
+                }
+                fetch(`/api/doctor/${doctorId}/slots?date=${date}`)
+                    .then(response => response.ok ? response.json() : null)
+                    .then(data => {
+                        const slots = data && data.slots;
+                        if (slots && slotStream === stream && String(slots) !== String(stream.slots)) {
+                            publish(slots);
+                        }
+                    });
+            }, SLOT_POLL_SECONDS * 1000);
+        } else {
+            stream.source = new EventSource(`/api/doctor/${doctorId}/slots/stream?date=${date}`);
+            stream.source.addEventListener('snapshot', event => publish(JSON.parse(event.data).slots));
+            stream.source.addEventListener('delta', event => {
+                if (!stream.slots) {
+                    return;
+                }
+                const delta = JSON.parse(event.data);
+                const slots = stream.slots.filter(time => time !== delta.time);
+                if (delta.available) {
+                    slots.push(delta.time);
+                    slots.sort();
+                }
+                publish(slots);
+            });
+        }
+    }
+    const stream = slotStream;
+    stream.listeners.push(onSlots);
+    return fetchSlots(doctorId, date).then(data => {
+        if (!stream.slots) {
+            onSlots(data);
+        }
+    });
+}
+window.watchSlots = watchSlots;
+window.addEventListener('pagehide', stopWatchingSlots);
+
 document.addEventListener('DOMContentLoaded', function() {
     // Time slot selection
     document.querySelectorAll('.time-slot').forEach(slot => {
@@ -16,24 +107,37 @@ document.addEventListener('DOMContentLoaded', function() {
             const date = this.value;
             
             if (doctorId && date) {
-                fetch(`/api/doctor/${doctorId}/slots?date=${date}`)
-                    .then(response => response.json())
-                    .then(data => {
-                        const slotsContainer = document.getElementById('time-slots');
-                        slotsContainer.innerHTML = '';
-                        
-                        if (data.slots && data.slots.length > 0) {
-                            data.slots.forEach(slot => {
-                                const slotElement = document.createElement('span');
-                                slotElement.className = 'time-slot';
-                                slotElement.dataset.time = slot;
-                                slotElement.textContent = slot;
-                                slotsContainer.appendChild(slotElement);
+                watchSlots(doctorId, date, data => {
+                    const slotsContainer = document.getElementById('time-slots');
+                    slotsContainer.innerHTML = '';
+                    
+                    // Keep the chosen slot selected across updates, or drop it once taken
+                    const timeInput = document.getElementById('time');
+                    if (!(data.slots || []).includes(timeInput.value)) {
+                        timeInput.value = '';
+                    }
+                    
+                    if (data.slots && data.slots.length > 0) {
+                        data.slots.forEach(slot => {
+                            const slotElement = document.createElement('span');
+                            slotElement.className = 'time-slot';
+                            slotElement.dataset.time = slot;
+                            slotElement.textContent = slot;
+                            if (slot === timeInput.value) {
+                                slotElement.classList.add('selected');
+                            }
+                            slotsContainer.appendChild(slotElement);
+                            
+                            slotElement.addEventListener('click', function() {
+                                document.querySelectorAll('.time-slot').forEach(s => s.classList.remove('selected'));
+                                this.classList.add('selected');
+                                timeInput.value = this.dataset.time;
                             });
-                        } else {
-                            slotsContainer.innerHTML = '<p>No available slots for this date</p>';
-                        }
-                    });
+                        });
+                    } else {
+                        slotsContainer.innerHTML = '<div class="alert alert-info">No available slots for this date</div>';
+                    }
+                }, this.dataset.stream === '1');
             }
         });
     }
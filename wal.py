@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Write-ahead log for the JSON repository.
+
+Every write is appended here and synced before the data files change.
+The data files themselves are then written without an fsync of their
+own, so a write costs one log append and concurrent writers share a
+single fsync (group commit): whoever finds no sync in flight syncs
+everything appended so far, the rest wait for it.
+
+One entry per line, ``<crc32 hex> <json>``, with a full copy of the
+record saved (or just its id for a delete), so replaying an entry twice
+is harmless. After a crash the data files may miss writes the log has;
+`entries` stops at the first torn or corrupt line and the repository
+replays the rest. A checkpoint syncs the data files and empties the log.
+
+Processes share the log: writers hold it shared from their append
+until the data files are written, and checkpoints hold it exclusively,
+so the log is never emptied under a write it still has to cover. The
+flock is taken once per process and counted across its threads.
+"""
+import os
+import json
+import zlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from metrics import record_io
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def encode_entry(entry):
+    data = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(data), data)
+
+
+def decode_entry(line):
+    """The entry on a log line, or None if the line is torn or corrupt"""
+    if not line.endswith(b'\n') or line[8:9] != b' ':
+        return None
+    data = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+class WriteAheadLog:
+    """Append-only log file with group-committed syncs"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+        self._synced_cond = threading.Condition(self._lock)
+        self._written = 0   # appends made by this process
+        self._synced = 0    # of which known to be on disk
+        self._syncing = False
+        self._holders = 0   # threads inside `shared`
+        self._exclusive = 0    # threads holding or waiting for `exclusive`
+        self._exclusive_held = False
+        self._holders_cond = threading.Condition()
+
+    def close(self):
+        os.close(self._fd)
+
+    def size(self):
+        return os.fstat(self._fd).st_size
+
+    def _flock(self, operation):
+        if fcntl is not None:
+            fcntl.flock(self._fd, operation)
+
+    @contextmanager
+    def shared(self):
+        """Held from `append` until the data files are written"""
+        with self._holders_cond:
+            while self._exclusive:
+                self._holders_cond.wait()
+            if not self._holders:
+                self._flock(fcntl.LOCK_SH if fcntl else None)
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._holders_cond:
+                self._holders -= 1
+                if not self._holders:
+                    self._flock(fcntl.LOCK_UN if fcntl else None)
+                    self._holders_cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """Held while replaying or checkpointing; waits for this process's writers too"""
+        with self._holders_cond:
+            # Waiting here also holds back new writers, so a checkpoint
+            # is not starved by a steady stream of them
+            self._exclusive += 1
+            while self._holders or self._exclusive_held:
+                self._holders_cond.wait()
+            self._exclusive_held = True
+            self._flock(fcntl.LOCK_EX if fcntl else None)
+        try:
+            yield
+        finally:
+            with self._holders_cond:
+                self._flock(fcntl.LOCK_UN if fcntl else None)
+                self._exclusive_held = False
+                self._exclusive -= 1
+                self._holders_cond.notify_all()
+
+    def append(self, entries):
+        """Append entries in one write; returns the ticket to pass to `sync`"""
+        data = b''.join(encode_entry(entry) for entry in entries)
+        with self._lock:
+            os.write(self._fd, data)
+            self._written += 1
+            record_io(nbytes=len(data))
+            return self._written
+
+    def sync(self, ticket):
+        """Return once the append that got `ticket` is on disk"""
+        with self._lock:
+            while self._synced < ticket:
+                if self._syncing:
+                    self._synced_cond.wait()
+                    continue
+                # Lead a sync covering every append made so far
+                self._syncing = True
+                target = self._written
+                self._lock.release()
+                try:
+                    _fdatasync(self._fd)
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                    self._synced_cond.notify_all()
+                self._synced = max(self._synced, target)
+
+    def entries(self):
+        """Every intact entry in the log, in order; hold `exclusive` while using it"""
+        with open(self.path, 'rb') as f:
+            for number, line in enumerate(f, 1):
+                entry = decode_entry(line)
+                if entry is None:
+                    logger.warning('%s: ignoring torn or corrupt entries from line %d on',
+                                   self.path, number)
+                    return
+                yield entry
+
+    def truncate(self):
+        """Empty the log; the data files must already be synced"""
+        with self._lock:
+            os.ftruncate(self._fd, 0)
+            _fdatasync(self._fd)